@@ -0,0 +1,55 @@
+'''
+offline benchmarks for kybyz
+
+run from the top of the source tree, e.g. `python3 -m benchmarks.peer`.
+
+importing this package points HOME and KB_LOGDIR at a scratch directory
+before any kybyz module is loaded, so that benchmarks never touch a real
+~/.kybyz; the scratch directory is removed at exit.
+'''
+import os, sys, atexit, shutil, tempfile  # pylint: disable=multiple-imports
+
+SCRATCH = tempfile.mkdtemp(prefix='kybyz_bench_')
+os.environ['HOME'] = SCRATCH
+os.environ['KB_LOGDIR'] = os.path.join(SCRATCH, 'log')
+atexit.register(shutil.rmtree, SCRATCH, ignore_errors=True)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from kbcommon import logging, KYBYZ_HOME
+
+def quiet():
+    '''
+    keep log output, which would dominate the timings, to errors
+    '''
+    logging.getLogger().setLevel(logging.ERROR)
+
+def make_post(index, size=0):
+    '''
+    return kwargs for a synthetic, valid, netmeme post
+
+    `size` pads bottomtext to roughly that many characters
+    '''
+    return {
+        'type': 'netmeme',
+        'author': 'bench%d' % (index % 97),
+        'fingerprint': '%016X' % (index % 89),
+        'image': 'ipfs/QmW2WQi7j6c7UgJTarActp7tDNikE4B2qXtFCfLPdsgaTQ/cat.jpg',
+        'mimetype': 'image/jpeg',
+        'timestamp': '2021-09-13T16:%02d:%02d.%06d+00:00' % (
+            index // 60 % 60, index % 60, index),
+        'toptext': 'synthetic post number %d' % index,
+        'bottomtext': ('lorem ipsum %d ' % index * (size // 14 + 1))[:size],
+    }
+
+def populate(count, size=0, start=0):
+    '''
+    create `count` synthetic posts in KYBYZ_HOME, returning their hashes
+
+    `start` numbers them on from an earlier call, so as to add new posts
+    '''
+    # pylint: disable=import-outside-toplevel
+    from kbutils import create
+    os.makedirs(KYBYZ_HOME, exist_ok=True)
+    return [create(None, **make_post(index, size))
+            for index in range(start, start + count)]
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+'''
+run benchmarks, each in its own interpreter and scratch directory, and
+print their results as one JSON object; optionally save them as a
+baseline, or compare them with one saved earlier
+
+usage: python3 -m benchmarks [--save FILE] [--compare FILE]
+        [--threshold PERCENT] [NAME[=ARG,...] ...|all]
+
+NAME is a module of this package, hotpaths if none is given; ARGs are
+passed on, as on its own command line. when comparing, timings and
+sizes that grew by more than PERCENT (default 10), or rates that fell
+by as much, are listed as regressions, and the exit status is 1.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, sys, json, argparse, subprocess  # pylint: disable=multiple-imports
+
+PACKAGE = os.path.dirname(os.path.abspath(__file__))
+# suffixes of the results that are compared, and which way is better
+LOWER, HIGHER = ('_us', '_ms', '_seconds', '_kb', '_bytes', '_wakeups'), (
+    '_per_second',)
+
+def benchmarks():
+    '''
+    names of all the benchmark modules
+    '''
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(PACKAGE)
+                  if name.endswith('.py') and not name.startswith('_'))
+
+def measure(name, args):
+    '''
+    run one benchmark module and return its results
+    '''
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.' + name] + args, check=True,
+        cwd=os.path.dirname(PACKAGE), stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL).stdout
+    return json.loads(output)
+
+def flatten(results, prefix=''):
+    '''
+    {'a': {'b_us': 1}} as {'a.b_us': 1}, keeping only compared results
+
+    >>> flatten({'a': {'b_us': 1, 'posts': 9}, 'c_per_second': 2.5})
+    {'a.b_us': 1, 'c_per_second': 2.5}
+    '''
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif key.endswith(LOWER + HIGHER) and \
+                isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+def compare(baseline, results, threshold=10):
+    '''
+    percent change of each result from the baseline, positive if worse,
+    and the names of those worse by more than `threshold` percent
+
+    >>> compare({'a_us': 10, 'b_per_second': 10, 'c_us': 10},
+    ...         {'a_us': 12, 'b_per_second': 12, 'd_us': 1})
+    ({'a_us': 20.0, 'b_per_second': -20.0}, ['a_us'])
+    '''
+    old, new = flatten(baseline), flatten(results)
+    changes = {}
+    for key in [key for key in new if old.get(key)]:
+        change = (new[key] - old[key]) / old[key] * 100
+        changes[key] = -change if key.endswith(HIGHER) else change
+    return changes, [key for key, change in changes.items()
+                     if change > threshold]
+
+def main(args=None):
+    '''
+    run the benchmarks asked for, and save or compare the results
+    '''
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks')
+    parser.add_argument('--save', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--threshold', type=float, default=10)
+    parser.add_argument('names', nargs='*', default=['hotpaths'])
+    options = parser.parse_args(args)
+    if options.names == ['all']:
+        options.names = benchmarks()
+    results = {}
+    for name in options.names:
+        name, arguments = (name.split('=', 1) + [''])[:2]
+        results[name] = measure(name, arguments.split(',') if arguments
+                                else [])
+    if options.save:
+        with open(options.save, 'w', encoding='utf-8') as outfile:
+            json.dump(results, outfile, indent=2)
+    regressions = []
+    if options.compare:
+        with open(options.compare, encoding='utf-8') as infile:
+            baseline = json.load(infile)
+        changes, regressions = compare(
+            {name: baseline[name] for name in results if name in baseline},
+            results, options.threshold)
+        results = {'results': results, 'percent_worse': changes,
+                   'regressions': regressions}
+    print(json.dumps(results, indent=2))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
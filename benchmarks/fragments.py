@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+'''
+time to assemble the timeline: loading and rendering every post, as
+before, vs. concatenating cached fragments in index order
+
+usage: python3 -m benchmarks.fragments [COUNT [SIZE]]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import sys, json, timeit  # pylint: disable=multiple-imports
+from benchmarks import quiet, populate
+from kbutils import loadposts, timeline, fragment
+from kbtemplate import FRAGMENTS
+
+def run(count=1000, size=200):
+    '''
+    return milliseconds to build the posts column each way
+    '''
+    populate(count, size)
+    def rerendered():
+        return ''.join(['<div>%s</div>' % post
+                        for post in loadposts()]).encode()
+    def assembled():
+        return [b'<div>%s</div>' % fragment(hashed) for hashed in timeline()]
+    assembled()  # fill the cache outside of the timing
+    return {'posts': count,
+            'rerendered_ms': min(timeit.repeat(
+                rerendered, number=1, repeat=3)) * 1000,
+            'assembled_ms': min(timeit.repeat(
+                assembled, number=1, repeat=3)) * 1000,
+            'cache': FRAGMENTS.stats()}
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+'''
+bytes moved per new post, broadcasting whole posts on the channel vs.
+gossiping hashes and pulling bodies, among local nodes on a fake IRC
+server
+
+usage: python3 -m benchmarks.gossip [NODES [POSTS [SIZE]]]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, sys, json, time  # pylint: disable=multiple-imports
+from benchmarks import quiet, populate, SCRATCH, KYBYZ_HOME
+from kbcommon import read, CHANNEL
+from kbflood import OutboundScheduler
+from kbfakeirc import FakeIRCServer
+from kbpeer import PeerServer, HEADER
+from kbgossip import Gossip
+from ircbot import IRCBot
+
+def node(index, ircd, directory):
+    '''
+    start a node: post directory, peer server, gossip, and IRC connection
+    '''
+    os.makedirs(directory, exist_ok=True)
+    server = PeerServer(directory, host='127.0.0.1', port=0)
+    def deliver(hashed, body):
+        with open(os.path.join(directory, hashed), 'wb') as outfile:
+            outfile.write(body)
+    gossip = Gossip(directory, '127.0.0.1:%d' % server.port, deliver,
+                    private=True)
+    bot = IRCBot('127.0.0.1', ircd.port, 'node%d' % index, 'bench',
+                 scheduler=OutboundScheduler(rate=0), gossip=gossip)
+    gossip.announce = lambda message: bot.privmsg(CHANNEL, message)
+    return server, gossip, bot
+
+def channel_bytes(ircd):
+    '''
+    bytes into and out of the IRC server so far
+    '''
+    return ircd.bytes_in + ircd.bytes_out
+
+def run(nodes=10, count=50, size=1000):
+    '''
+    return bytes per post each way of publishing
+    '''
+    # pylint: disable=too-many-locals
+    hashes = populate(count, size)
+    paths = [os.path.join(KYBYZ_HOME, hashed) for hashed in hashes]
+    ircd = FakeIRCServer()
+    network = [node(0, ircd, KYBYZ_HOME)] + [
+        node(index, ircd, os.path.join(SCRATCH, 'node%d' % index))
+        for index in range(1, nodes)]
+    ircd.wait_idle()
+    publisher = network[0][2]
+    results = {'nodes': nodes, 'posts': count,
+               'post_bytes': sum(map(os.path.getsize, paths)) / count}
+
+    before = channel_bytes(ircd)
+    for path in paths:
+        publisher.privmsg(CHANNEL, read(path).decode()).result(timeout=60)
+    ircd.wait_idle()
+    results['broadcast'] = {
+        'channel_bytes_per_post': (channel_bytes(ircd) - before) / count}
+
+    before = channel_bytes(ircd)
+    start = time.perf_counter()
+    for hashed, path in zip(hashes, paths):
+        message = network[0][1].publish(hashed, os.path.getsize(path),
+                                        'netmeme')
+        publisher.privmsg(CHANNEL, message)
+    for server, gossip, bot in network[1:]:
+        while not all(map(gossip.have, hashes)):
+            time.sleep(.05)
+    ircd.wait_idle()
+    elapsed = time.perf_counter() - start
+    fetched = sum(gossip.stats['fetched'] for server, gossip, bot in network)
+    peer = sum(server.bytes_sent for server, gossip, bot in network)
+    peer += fetched * (HEADER.size + len(hashes[0]))  # requests
+    channel = channel_bytes(ircd) - before
+    results['gossip'] = {
+        'seconds': elapsed,
+        'announcements': sum(gossip.stats['announced']
+                             for server, gossip, bot in network),
+        'channel_bytes_per_post': channel / count,
+        'peer_bytes_per_post': peer / count,
+        'total_bytes_per_post': (channel + peer) / count}
+    for server, gossip, bot in network:
+        bot.stop()
+        server.close()
+    ircd.close()
+    return results
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
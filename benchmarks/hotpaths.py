@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+'''
+the hot paths, each on its own: hashing, base58, posts, loading the
+store, serving each route, reassembling IRC messages, and ingesting
+posts from a fake IRC server
+
+times are microseconds per call (`_us`), the best of five runs of as
+many calls as take a fifth of a second.
+
+usage: python3 -m benchmarks.hotpaths [MAXPOSTS [INGEST]]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, sys, json, time, timeit  # pylint: disable=multiple-imports
+import subprocess
+from benchmarks import quiet, make_post, populate, KYBYZ_HOME
+from kbcommon import read, CHANNEL, POSTS_QUEUE
+from kbflood import OutboundScheduler
+from kbfakeirc import FakeIRCServer
+from kbutils import kbhash, loadposts
+from canonical_json import canonicalize
+from post import BasePost
+from ircbot import IRCBot, ReassemblyBuffers
+import base58
+
+STAGES = (100, 1000, 10000)  # store sizes at which loadposts() is timed
+SIZES = (16, 35, 256, 4096)  # bytes base58 encoded; 35 is a kbz hash
+
+SERVER = '''
+import os, sys, json, timeit, logging
+from io import BytesIO
+sys.argv = ['pydoc3']  # import without initializing
+import kybyz
+logging.getLogger().setLevel(logging.ERROR)
+kybyz.load_indexes()
+kybyz.TEMPLATES.preload()
+def request(uri, body):
+    env = {'REQUEST_URI': uri, 'wsgi.input': BytesIO(body.encode())}
+    return b''.join(kybyz.serve(env, lambda *args: None))
+results = {}
+for name, (uri, body) in json.load(sys.stdin).items():
+    request(uri, body)  # renders posts into the fragment cache
+    timer = timeit.Timer(lambda: request(uri, body))
+    number = timer.autorange()[0]
+    results[name + '_us'] = min(timer.repeat(number=number, repeat=5)) \
+        / number * 1e6
+print(json.dumps(results), flush=True)
+os._exit(0)
+'''
+
+def per_call(function):
+    '''
+    microseconds per call of `function`, best of five runs
+    '''
+    timer = timeit.Timer(function)
+    number = timer.autorange()[0]
+    return min(timer.repeat(number=number, repeat=5)) / number * 1e6
+
+def hashing():
+    '''
+    canonical JSON and kbz hashes of a post
+    '''
+    post = make_post(0, 200)
+    return {'canonicalize_us': per_call(lambda: canonicalize(post)),
+            'kbhash_us': per_call(lambda: kbhash(post))}
+
+def encoding():
+    '''
+    base58 both ways, at each of SIZES
+    '''
+    results = {}
+    for size in SIZES:
+        data = os.urandom(size)
+        encoded = base58.encode(data)
+        results['encode_%d_us' % size] = per_call(
+            lambda: base58.encode(data))
+        results['decode_%d_us' % size] = per_call(
+            lambda: base58.decode(encoded))
+    return results
+
+def posts():
+    '''
+    making (and so validating) a post, and writing it out each way
+    '''
+    kwargs = make_post(0, 200)
+    post = BasePost(None, **kwargs)
+    return {'construct_us': per_call(lambda: BasePost(None, **kwargs)),
+            'validate_us': per_call(post.validate),
+            'to_json_us': per_call(lambda: post.to_json(True)),
+            'to_html_us': per_call(post.to_html)}
+
+def loading(maxposts):
+    '''
+    loadposts() as the store grows through STAGES, up to `maxposts`
+    '''
+    results, hashes = {}, []
+    for stage in [count for count in STAGES if count <= maxposts]:
+        hashes += populate(stage - len(hashes), start=len(hashes))
+        results['loadposts_%d_us' % stage] = min(timeit.repeat(
+            loadposts, number=1, repeat=3)) * 1e6
+    return results, hashes
+
+def serving(hashes):
+    '''
+    serve() for each route, in a fresh interpreter, as uwsgi runs it
+    '''
+    routes = {'timeline': ('/', ''),
+              'thread': ('/thread/' + hashes[0], ''),
+              'author': ('/author/bench1', ''),
+              'search': ('/search?q=synthetic', ''),
+              'update': ('/update/', 'name=posts&hash=stale'),
+              'static': ('/kybyz.css', ''),
+              'missing': ('/nonexistent', '')}
+    output = subprocess.run(
+        [sys.executable, '-c', SERVER], check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        input=json.dumps(routes).encode(), stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL).stdout
+    return json.loads(output)
+
+def reassembly(senders=10000, chunks=3):
+    '''
+    lines into the reassembly buffers, from `senders` interleaved senders
+    whose messages complete, and from as many whose messages never do
+    '''
+    line = 'x' * 400
+    def interleaved():
+        buffers = ReassemblyBuffers()
+        for index in range(chunks):
+            for sender in range(senders):
+                buffers.append(sender, line, now=index)
+        for sender in range(senders):
+            buffers.pop(sender)
+    def spray():
+        buffers = ReassemblyBuffers(maxtotal=len(line) * 1000)
+        for sender in range(senders * chunks):
+            buffers.append(sender, line, now=sender)
+    lines = senders * chunks
+    return {'senders': senders,
+            'interleaved_line_us': per_call(interleaved) / lines,
+            'evicting_line_us': per_call(spray) / lines}
+
+def ingest(hashes, count):
+    '''
+    posts per second received through a fake IRC server, whole, into
+    POSTS_QUEUE
+    '''
+    messages = [read(os.path.join(KYBYZ_HOME, hashed)).decode()
+                for hashed in hashes[:count]]
+    ircd = FakeIRCServer()
+    sender = IRCBot('127.0.0.1', ircd.port, 'sender', 'bench',
+                    scheduler=OutboundScheduler(rate=0))
+    IRCBot('127.0.0.1', ircd.port, 'receiver', 'bench')
+    ircd.wait_idle()
+    POSTS_QUEUE.clear()
+    start = time.perf_counter()
+    for message in messages:
+        sender.privmsg(CHANNEL, message)
+    deadline = time.monotonic() + 60
+    while len(POSTS_QUEUE) < len(messages) and time.monotonic() < deadline:
+        time.sleep(.001)
+    elapsed = time.perf_counter() - start
+    received = len(POSTS_QUEUE)
+    POSTS_QUEUE.clear()
+    ircd.close()
+    return {'posts': len(messages), 'received': received,
+            'posts_per_second': received / elapsed}
+
+def run(maxposts=10000, count=500):
+    '''
+    return timings of each hot path, with up to `maxposts` posts stored,
+    and `count` of them ingested over IRC
+    '''
+    results = {'hashing': hashing(), 'base58': encoding(), 'post': posts()}
+    results['loadposts'], hashes = loading(maxposts)
+    results['serve'] = serving(hashes)
+    results['reassembly'] = reassembly()
+    results['ingest'] = ingest(hashes, min(count, POSTS_QUEUE.maxlen))
+    return results
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
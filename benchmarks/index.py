@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+'''
+query times of the post indexes on a large store
+
+usage: python3 -m benchmarks.index [COUNT]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import sys, json, timeit  # pylint: disable=multiple-imports
+from benchmarks import quiet, make_post
+from kbindex import FieldIndex, ThreadIndex, SearchIndex
+
+def run(count=100000):
+    '''
+    return build time and microseconds per query for `count` posts
+    '''
+    posts = [('kbz%d' % index, make_post(index, 40))
+             for index in range(count)]
+    for index, (hashed, fields) in enumerate(posts):
+        if index % 10:  # nine in ten posts reply to one a little older
+            fields['in-reply-to'] = [posts[index * 7 // 8][0]]
+    fields_index, threads = FieldIndex(None), ThreadIndex(None)
+    search = SearchIndex(None)
+    results = {'posts': count, 'build_seconds': timeit.timeit(
+        lambda: [(fields_index.ingest(*post), threads.ingest(*post))
+                 for post in posts], number=1),
+               'search_build_seconds': timeit.timeit(
+                   lambda: [search.ingest(*post) for post in posts],
+                   number=1)}
+    before = posts[count // 2][1]['timestamp']
+    queries = {
+        'author_first_page': lambda: fields_index.query('author', 'bench1'),
+        'author_later_page': lambda: fields_index.query(
+            'author', 'bench1', before),
+        'type_first_page': lambda: fields_index.query('type', 'netmeme'),
+        'fingerprint_page': lambda: fields_index.query(
+            'fingerprint', '%016X' % 1, before),
+        'thread_root': lambda: threads.root(posts[-1][0]),
+        'search_rare_word': lambda: search.search('synthetic 12345'),
+        'search_common_words': lambda: search.search('lorem ipsum'),
+    }
+    for name, query in queries.items():
+        results[name + '_microseconds'] = min(
+            timeit.repeat(query, number=100, repeat=3)) * 10000
+    return results
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
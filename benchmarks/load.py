@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+'''
+end to end load on one node: simulated peers on a fake IRC server
+publishing posts and chunked encrypted messages at set rates, while
+browsers fetch the timeline and poll for updates over HTTP
+
+the node runs in its own interpreter, as uwsgi would run it, served by
+wsgiref and connected to the fake IRC server by an IRCBot. the messages
+are random bytes, base58 encoded, as messages encrypted to someone else
+would be, so the node tries and fails to decrypt each of them.
+
+page latency is measured first with the peers idle, then under load.
+drops are posts pushed out of POSTS_QUEUE before the node stored them;
+page lines are the messages added to the node's MESSAGE_STORE.
+
+usage: python3 -m benchmarks.load [PEERS [POSTS [MESSAGES [BROWSERS
+        [SECONDS]]]]]
+
+POSTS and MESSAGES are per second, from each peer.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, sys, json, time, statistics  # pylint: disable=multiple-imports
+import subprocess, threading  # pylint: disable=multiple-imports
+from http.client import HTTPConnection
+from itertools import count
+from benchmarks import quiet, make_post, populate
+from base58 import b58encode
+from kbcommon import CHANNEL
+from kbflood import OutboundScheduler
+from kbfakeirc import FakeIRCServer
+from ircbot import IRCBot
+
+MESSAGE_SIZE = 1500  # bytes of "ciphertext", some five IRC lines
+
+NODE = '''
+import os, sys, json, time, threading
+from io import BytesIO
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+PORT = int(sys.argv[1])
+sys.argv = ['pydoc3']  # import without initializing
+import kybyz
+from kbcommon import POSTS_QUEUE, MESSAGE_STORE
+from ircbot import IRCBot
+kybyz.load_indexes()
+kybyz.TEMPLATES.preload()
+class Server(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+class Handler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+def application(env, start_response):
+    length = int(env.get('CONTENT_LENGTH') or 0)
+    env['wsgi.input'] = BytesIO(env['wsgi.input'].read(length))
+    env['REQUEST_URI'] = env['PATH_INFO'] + (
+        env['QUERY_STRING'] and '?' + env['QUERY_STRING'])
+    return kybyz.serve(env, start_response)
+server = make_server('127.0.0.1', 0, application, Server, Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+IRCBot('127.0.0.1', PORT, 'node', 'kybyz')
+print(server.server_port, flush=True)
+sys.stdin.readline()  # until the load is over
+start = time.monotonic()
+while True:  # until the backlog of IRC lines is processed
+    lines = POSTS_QUEUE.appended + MESSAGE_STORE.latest
+    time.sleep(1)
+    if POSTS_QUEUE.appended + MESSAGE_STORE.latest == lines:
+        break
+print(json.dumps({'backlog_seconds': time.monotonic() - start - 1,
+                  'posts_queued': POSTS_QUEUE.appended,
+                  'posts_dropped': POSTS_QUEUE.dropped,
+                  'posts_waiting': len(POSTS_QUEUE),
+                  'page_lines': MESSAGE_STORE.latest}), flush=True)
+os._exit(0)
+'''
+
+def percentiles(latencies):
+    '''
+    median, 90th and 99th percentile, and worst, in milliseconds
+
+    >>> percentiles([.001 * n for n in range(1, 101)])['p90_ms']
+    90.9
+    '''
+    if len(latencies) < 2:
+        return {'requests': len(latencies)}
+    cuts = statistics.quantiles(latencies, n=100)
+    return {'requests': len(latencies),
+            'p50_ms': round(cuts[49] * 1000, 3),
+            'p90_ms': round(cuts[89] * 1000, 3),
+            'p99_ms': round(cuts[98] * 1000, 3),
+            'max_ms': round(max(latencies) * 1000, 3)}
+
+def browse(port, seconds, latencies):
+    '''
+    as a browser would: load the timeline, then poll for updates
+    '''
+    connection = HTTPConnection('127.0.0.1', port, timeout=60)
+    requests = [('timeline', 'GET', '/', None)] + [
+        ('update', 'POST', '/update/', 'name=%s&hash=stale' % name)
+        for name in ('messages', 'posts')]
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for route, method, path, body in requests:
+            start = time.perf_counter()
+            connection.request(method, path, body, {
+                'Content-Type': 'application/x-www-form-urlencoded'})
+            connection.getresponse().read()
+            latencies.setdefault(route, []).append(
+                time.perf_counter() - start)
+
+def browsing(port, browsers, seconds):
+    '''
+    latency percentiles of each route, with `browsers` at once
+    '''
+    latencies = {}
+    threads = [threading.Thread(target=browse,
+                                args=(port, seconds, latencies))
+               for index in range(browsers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {route: percentiles(times) for route, times in latencies.items()}
+
+def publish(bot, rate, seconds, make):
+    '''
+    send `make(n)` on the channel `rate` times a second
+    '''
+    if not rate:
+        return
+    start = time.monotonic()
+    for number in count():
+        due = start + number / rate
+        if due >= start + seconds:
+            break
+        time.sleep(max(0, due - time.monotonic()))
+        bot.privmsg(CHANNEL, make(number))
+
+def run(peers=10, posts=2, messages=2, browsers=4, seconds=10):
+    '''
+    return ingest rates, drops, and page latencies without and with load
+    '''
+    # pylint: disable=too-many-arguments, too-many-locals
+    populate(1000)
+    ircd = FakeIRCServer()
+    # pylint: disable=consider-using-with
+    node = subprocess.Popen(
+        [sys.executable, '-c', NODE, str(ircd.port)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+    port = int(node.stdout.readline())
+    bots = [IRCBot('127.0.0.1', ircd.port, 'peer%d' % index, 'bench',
+                   scheduler=OutboundScheduler(rate=0))
+            for index in range(peers)]
+    ircd.wait_idle()
+    results = {'peers': peers, 'posts_per_peer_second': posts,
+               'messages_per_peer_second': messages, 'browsers': browsers,
+               'idle': browsing(port, browsers, seconds)}
+    publishers = []
+    for index, bot in enumerate(bots):
+        def post(number, index=index):
+            return json.dumps(make_post(1000 + number * peers + index))
+        def message(number):  # pylint: disable=unused-argument
+            return b58encode(os.urandom(MESSAGE_SIZE)).decode()
+        publishers += [
+            threading.Thread(target=publish,
+                             args=(bot, posts, seconds, post)),
+            threading.Thread(target=publish,
+                             args=(bot, messages, seconds, message))]
+    start, lines = time.perf_counter(), ircd.lines
+    for thread in publishers:
+        thread.start()
+    results['loaded'] = browsing(port, browsers, seconds)
+    for thread in publishers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    node.stdin.write(b'\n')
+    node.stdin.flush()
+    results.update(json.loads(node.stdout.readline()))
+    elapsed += results['backlog_seconds']
+    node.wait()
+    ircd.close()
+    ingested = results['posts_queued'] - results['posts_dropped'] \
+        - results['posts_waiting']
+    results.update(posts_sent=posts * peers * seconds,
+                   messages_sent=messages * peers * seconds,
+                   posts_ingested=ingested,
+                   posts_ingested_per_second=ingested / elapsed,
+                   irc_lines_per_second=(ircd.lines - lines) / elapsed)
+    return results
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
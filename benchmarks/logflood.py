@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+'''
+logging throughput under an IRC flood: threads logging every received
+line, as ircbot does, through synchronous handlers, as before, vs. the
+queued, batched, rate-limited pipeline of kblog
+
+usage: python3 -m benchmarks.logflood [THREADS [LINES]]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, sys, json, time, glob, logging  # pylint: disable=multiple-imports
+from threading import Thread
+from benchmarks import quiet, SCRATCH
+from kbcommon import PageHandler, EXTENDED_LOG_FORMAT, BASE_LOG_FORMAT
+from kblog import BufferedRotatingFileHandler, Formatter, pipeline
+
+def handlers(filename, filehandler, formatter):
+    '''
+    screen (here /dev/null), file and page handlers, as kbcommon has them
+    '''
+    # pylint: disable=consider-using-with
+    screen = logging.StreamHandler(open(os.devnull, 'w', encoding='utf-8'))
+    screen.setLevel(logging.INFO)
+    screen.setFormatter(logging.Formatter(BASE_LOG_FORMAT))
+    logfile = filehandler(os.path.join(SCRATCH, filename))
+    logfile.setFormatter(formatter(EXTENDED_LOG_FORMAT))
+    page = PageHandler()
+    page.setLevel(logging.INFO)
+    return [screen, logfile, page]
+
+def flood(logger, threads, lines):
+    '''
+    seconds for `threads` threads to log `lines` received lines each
+    '''
+    received = ':nick!user@host PRIVMSG #kybyz :%s' % ('x' * 160)
+    def receive():
+        for index in range(lines):
+            logger.info('received: %r, length: %d', received, len(received))
+            logger.debug('buffer %s now %r', index, received)
+    workers = [Thread(target=receive) for index in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+def run(threads=4, lines=20000):
+    '''
+    return seconds spent by the logging threads, and until all is written
+    '''
+    records = threads * lines * 2
+    results = {'threads': threads, 'records': records}
+    old, new = (logging.FileHandler, logging.Formatter), (
+        BufferedRotatingFileHandler, Formatter)
+    setups = {  # log file, file handler and formatter, and rate limiting
+        'synchronous': ('sync.log', old, None),
+        'queued': ('queued.log', new, False),
+        'queued_limited': ('limited.log', new, True),
+    }
+    for name, (filename, classes, limit) in setups.items():
+        logger = logging.Logger(name, logging.DEBUG)
+        listener = None
+        if limit is None:
+            for handler in handlers(filename, *classes):
+                logger.addHandler(handler)
+        else:
+            handler, listener = pipeline(
+                handlers(filename, *classes), limit=limit)
+            logger.addHandler(handler)
+        start = time.perf_counter()
+        logging_seconds = flood(logger, threads, lines)
+        if listener is not None:
+            listener.stop()
+        written = time.perf_counter() - start
+        kept = 0
+        for logname in glob.glob(os.path.join(SCRATCH, filename + '*')):
+            with open(logname, encoding='utf-8') as logfile:
+                kept += sum(1 for line in logfile)
+        results[name] = {'logging_seconds': logging_seconds,
+                         'written_seconds': written,
+                         'records_per_second': records / written,
+                         'lines_written': kept}
+    return results
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+'''
+throughput of fetching posts directly from a peer vs. receiving them
+over IRC, between two local nodes
+
+usage: python3 -m benchmarks.peer [COUNT [SIZE]]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import sys, json, time, socket  # pylint: disable=multiple-imports
+from benchmarks import quiet, populate, KYBYZ_HOME
+from kbcommon import read
+from kbflood import OutboundScheduler, FLOOD_RATE
+from kbfakeirc import FakeIRCServer
+from kbpeer import PeerServer, fetch
+from ircbot import IRCBot
+
+def run(count=200, size=1000):
+    '''
+    return timings and bytes moved for `count` posts of about `size` chars
+    '''
+    hashes = populate(count, size)
+    bodies = [read('%s/%s' % (KYBYZ_HOME, hashed)) for hashed in hashes]
+    payload = sum(map(len, bodies))
+    results = {'posts': count, 'payload_bytes': payload}
+
+    server = PeerServer(KYBYZ_HOME, host='127.0.0.1', port=0)
+    start = time.perf_counter()
+    fetched = fetch('127.0.0.1:%d' % server.port, hashes)
+    elapsed = time.perf_counter() - start
+    server.close()
+    assert all(fetched.values())
+    results['direct'] = {'seconds': elapsed,
+                         'bytes_per_second': payload / elapsed}
+
+    ircd = FakeIRCServer()
+    listener = socket.create_connection(('127.0.0.1', ircd.port))
+    listener.sendall(b'USER recv 0 * :recv\r\nNICK recv\r\nJOIN #kybyz\r\n')
+    ircd.wait_idle(quiet=0.1)
+    sender = IRCBot('127.0.0.1', ircd.port, 'send', 'bench',
+                    scheduler=OutboundScheduler(rate=0))
+    ircd.wait_idle(quiet=0.1)
+    start = time.perf_counter()
+    for body in bodies:
+        future = sender.privmsg('#kybyz', body.decode())
+    future.result(timeout=600)
+    lines = sender.stats()['lines'] - sender.stats()['control']
+    received = 0
+    with listener.makefile('rb') as reader:
+        for line in reader:
+            received += b' PRIVMSG #kybyz ' in line
+            if received == lines:
+                break
+    elapsed = time.perf_counter() - start
+    sender.stop()
+    listener.close()
+    ircd.close()
+    results['irc_unthrottled'] = {'seconds': elapsed, 'lines': lines,
+                                  'bytes_per_second': payload / elapsed}
+    results['irc_at_flood_limit'] = {
+        'seconds': lines / FLOOD_RATE,
+        'bytes_per_second': payload / (lines / FLOOD_RATE)}
+    return results
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+'''
+time to render posts to HTML: reading and formatting the template for
+each post, as before, vs. the compiled template registry
+
+usage: python3 -m benchmarks.render [COUNT]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import sys, json, timeit  # pylint: disable=multiple-imports
+from benchmarks import quiet, make_post
+from kbcommon import read
+from kbtemplate import TEMPLATES
+from post import BasePost
+
+def run(count=1000):
+    '''
+    return milliseconds to render `count` posts each way
+    '''
+    posts = [BasePost(None, **make_post(index, 100)) for index in range(count)]
+    def uncompiled():
+        return [read(post.classname + '.html').decode().format(post=post)
+                for post in posts]
+    def compiled():
+        return [TEMPLATES.render(post.classname + '.html', post=post)
+                for post in posts]
+    compiled()  # load the template outside of the timing
+    return {'posts': count,
+            'uncompiled_ms': min(timeit.repeat(
+                uncompiled, number=1, repeat=5)) * 1000,
+            'compiled_ms': min(timeit.repeat(
+                compiled, number=1, repeat=5)) * 1000}
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+'''
+startup time of the post indexes on a large store: replaying the
+journals and scanning the store, as before, vs. loading a snapshot
+
+usage: python3 -m benchmarks.snapshot [COUNT]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, sys, json, timeit  # pylint: disable=multiple-imports
+from hashlib import sha256
+from base58 import b58encode
+from benchmarks import quiet, make_post, SCRATCH
+from kbindex import ThreadIndex, FieldIndex, SearchIndex, load, save
+
+def indexes():
+    '''
+    empty indexes, journaled in the scratch directory
+    '''
+    return [ThreadIndex(os.path.join(SCRATCH, 'threads.log')),
+            FieldIndex(os.path.join(SCRATCH, 'fields.log')),
+            SearchIndex(os.path.join(SCRATCH, 'search.log'))]
+
+def run(count=100000):
+    '''
+    return seconds to load indexes of `count` posts each way
+    '''
+    store = os.path.join(SCRATCH, 'store')
+    snapshot = os.path.join(SCRATCH, 'snapshot')
+    os.makedirs(store)
+    original = os.path.join(SCRATCH, 'post')
+    with open(original, 'w', encoding='utf-8') as outfile:
+        outfile.write(json.dumps(make_post(0)))
+    built = indexes()
+    for index in range(count):
+        hashed = 'kbz' + b58encode(sha256(b'%d' % index).digest()).decode()
+        os.symlink(original, os.path.join(store, hashed))
+        for each in built:
+            each.ingest(hashed, make_post(index, 40))
+    results = {'posts': count,
+               'rebuild_seconds': min(timeit.repeat(
+                   lambda: load(store, indexes(), snapshot),
+                   number=1, repeat=3)),
+               'save_seconds': timeit.timeit(
+                   lambda: save(store, built, snapshot), number=1),
+               'snapshot_bytes': os.path.getsize(snapshot)}
+    results['snapshot_seconds'] = min(timeit.repeat(
+        lambda: load(store, indexes(), snapshot), number=1, repeat=3))
+    os.symlink(original, os.path.join(store, 'kbzNew'))  # store changed
+    results['snapshot_and_scan_seconds'] = min(timeit.repeat(
+        lambda: load(store, indexes(), snapshot), number=1, repeat=3))
+    return results
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
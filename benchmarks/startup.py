@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+'''
+cold start: seconds from launching a fresh interpreter to the first
+page served, as uwsgi would, with the stages reported by
+--startup-profile
+
+usage: python3 -m benchmarks.startup [POSTS [RUNS]]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, sys, json, time, subprocess  # pylint: disable=multiple-imports
+from benchmarks import quiet, populate
+
+SERVER = '''
+import sys, os, json
+sys.argv = ['pydoc3']  # import without initializing, as uwsgi_init does
+import kybyz
+kybyz.PROFILE = True
+kybyz.init()
+page = b''.join(kybyz.serve({'REQUEST_URI': '/'}, lambda *args: None))
+print(json.dumps(dict(kybyz.STARTUP)), flush=True)
+os._exit(0)  # leave helpers still starting, as a request would
+'''
+
+def run(count=1000, runs=5):
+    '''
+    return the fastest of `runs` cold starts, with `count` posts stored
+    '''
+    populate(count)
+    fastest = None
+    for index in range(runs):  # pylint: disable=unused-variable
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, '-c', SERVER], check=True,
+            env=dict(os.environ, KB_DEBUG=''),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        elapsed = time.perf_counter() - start
+        if fastest is None or elapsed < fastest['first_page_seconds']:
+            fastest = {'first_page_seconds': elapsed,
+                       'stages': json.loads(output)}
+    return dict(fastest, posts=count)
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
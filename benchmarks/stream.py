@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+'''
+time to first byte, and peak memory, serving the timeline as one joined
+page, as before, vs. streaming it a post at a time
+
+memory is the peak of Python allocations during the request, by
+tracemalloc; "cold" is the first request, when every post is rendered
+into the fragment cache, "warm" any request after.
+
+usage: python3 -m benchmarks.stream [COUNT [SIZE]]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import sys, json, time, tracemalloc  # pylint: disable=multiple-imports
+from benchmarks import quiet, populate
+from kbutils import loadposts, timeline, stream
+from kbtemplate import TEMPLATES
+
+COLUMN = '<div class="column" id="kbz-posts">', '</div>'
+
+def joined():
+    '''
+    the page as serve() used to build it
+    '''
+    posts = ''.join(['<div>%s</div>' % post for post in loadposts()])
+    posts = posts.join(COLUMN)
+    return [TEMPLATES.render('timeline.html', posts=posts, messages='',
+                             navigation='').encode()]
+
+def streamed():
+    '''
+    the page as serve() now returns it
+    '''
+    head, tail = TEMPLATES.render(
+        'timeline.html', posts='\0', messages='', navigation='',
+    ).encode().split(b'\0')
+    return stream(head + COLUMN[0].encode(), timeline(),
+                  COLUMN[1].encode() + tail)
+
+def measure(respond):
+    '''
+    seconds to first and last chunk, and peak bytes allocated
+    '''
+    start = time.perf_counter()
+    chunks = iter(respond())
+    size = len(next(chunks))
+    first = time.perf_counter() - start
+    size += sum(map(len, chunks))
+    last = time.perf_counter() - start
+    tracemalloc.start()
+    for chunk in respond():
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'ttfb_ms': first * 1000, 'total_ms': last * 1000,
+            'peak_kb': peak / 1024, 'page_kb': size / 1024}
+
+def run(count=10000, size=200):
+    '''
+    return first-byte times and memory for a timeline of `count` posts
+    '''
+    populate(count, size)
+    joined()  # load the templates and warm the page cache
+    results = {'posts': count, 'joined': measure(joined)}
+    tracemalloc.start()  # the cold run fills the cache while traced
+    cold = time.perf_counter()
+    chunks = streamed()
+    next(chunks)
+    cold = time.perf_counter() - cold
+    for chunk in chunks:
+        pass
+    results['streamed_cold'] = {
+        'ttfb_ms': cold * 1000,
+        'peak_kb': tracemalloc.get_traced_memory()[1] / 1024}
+    tracemalloc.stop()
+    results['streamed_warm'] = measure(streamed)
+    return results
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+'''
+idle wakeups of the helper threads, sleep-polling as before vs. the
+event-driven supervisor, and recovery of a helper that keeps crashing
+
+usage: python3 -m benchmarks.supervisor [SECONDS]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import sys, json, time, resource, threading  # pylint: disable=multiple-imports
+from benchmarks import quiet
+from kbsupervisor import Supervisor
+
+def switches():
+    '''
+    voluntary context switches of this process so far
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_nvcsw
+
+def polling(seconds):
+    '''
+    the old background, nginx and tor loops, idling
+    '''
+    running = threading.Event()
+    running.set()
+    def loop(delay):
+        while running.is_set():
+            time.sleep(delay)
+    threads = [threading.Thread(target=loop, args=(delay,), daemon=True)
+               for delay in (1.1, 1.3, 1.5)]
+    before = switches()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    running.clear()
+    return switches() - before
+
+def supervised(seconds):
+    '''
+    the supervisor, with its two ten-minute timers, idling
+    '''
+    supervisor = Supervisor()
+    before = switches()
+    supervisor.start(signals=False)
+    supervisor.every(600, lambda: None, now=True)
+    supervisor.every(600, lambda: None)
+    time.sleep(seconds)
+    supervisor.stop()
+    return switches() - before
+
+def crashing(seconds):
+    '''
+    restarts of a helper that exits at once, in `seconds`
+    '''
+    supervisor = Supervisor()
+    supervisor.start(signals=False)
+    supervisor.add('crasher', [sys.executable, '-c', 'raise SystemExit(1)'])
+    time.sleep(seconds)
+    restarts = supervisor.helpers['crasher'].restarts
+    supervisor.stop()
+    return restarts
+
+def run(seconds=10):
+    '''
+    return context switches while idle each way, and restarts
+    '''
+    return {'seconds': seconds,
+            'polling_wakeups': polling(seconds),
+            'supervised_wakeups': supervised(seconds),
+            'crashing_helper_restarts': crashing(seconds)}
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+'''
+metadata moved by kbsync between two local nodes sharing most posts
+
+one scenario has the second node miss the most recent posts, as after
+an outage; the other scatters the missing posts at random.
+
+usage: python3 -m benchmarks.sync [COUNT [MISSING_PERCENT]]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import sys, json, time, random  # pylint: disable=multiple-imports
+from datetime import datetime, timedelta
+from benchmarks import quiet, SCRATCH
+from kbpeer import PeerServer
+from kbsync import PostSet, serve, sync
+
+def synthetic(count):
+    '''
+    (hash, timestamp) pairs for `count` posts over about a year
+    '''
+    generator = random.Random(count)
+    start, step = datetime(2021, 1, 1), timedelta(days=365) / count
+    return [('kbz%044x' % generator.getrandbits(176),
+             (start + step * index).isoformat())
+            for index in range(count)]
+
+def scenario(posts, missing):
+    '''
+    sync a node lacking `missing` posts from one that has them all
+    '''
+    complete, partial = PostSet(), PostSet()
+    complete.update(posts)
+    partial.update(post for post in posts if post not in missing)
+    server = PeerServer(SCRATCH, host='127.0.0.1', port=0)
+    serve(server, complete)
+    complete.start()  # builds prefix sums ahead of the timing
+    partial.start()
+    start = time.perf_counter()
+    stats = sync('127.0.0.1:%d' % server.port, partial)
+    stats['seconds'] = time.perf_counter() - start
+    server.close()
+    assert stats['needed'] == len(missing)
+    stats['metadata_bytes'] = stats['bytes_sent'] + stats['bytes_received']
+    return stats
+
+def run(count=100000, percent=1):
+    '''
+    return sync statistics for both scenarios
+    '''
+    posts = synthetic(count)
+    missing = count * percent // 100
+    naive = len(json.dumps([hashed for hashed, timestamp in posts]))
+    return {
+        'posts': count,
+        'missing': missing,
+        'full_hash_list_bytes': naive,
+        'recent_outage': scenario(posts, set(posts[-missing:])),
+        'scattered': scenario(posts, set(random.Random(0).sample(
+            posts, missing))),
+    }
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
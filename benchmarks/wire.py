@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+'''
+bytes on the wire, and time to deliver, of posts published on the
+channel as JSON, as now, and as compact frames; and the size of
+encrypted messages as base58, as now, and as compact frames
+
+bytes are those of the PRIVMSG lines the sender sent, CRLF included.
+delivery is timed from privmsg() until the post is in the receiver's
+POSTS_QUEUE, the sender being paced by the default flood limits, as it
+would be in use; each format starts with a full burst allowance. posts
+not delivered within TIMEOUT are counted as lost, not timed.
+
+posts are padded with words of the README, so as to compress as text
+does. encrypted messages are stood in for by random bytes, as GPG's
+compressed output is, so only their encodings differ.
+
+usage: python3 -m benchmarks.wire [COUNT [SIZE ...]]
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, sys, json, time, statistics  # pylint: disable=multiple-imports
+from benchmarks import quiet, make_post
+from base58 import b58encode
+from kbcommon import CHANNEL, POSTS_QUEUE, read
+from kbflood import FLOOD_BURST, FLOOD_RATE
+from kbfakeirc import FakeIRCServer
+from kbwire import frame
+from ircbot import IRCBot
+
+SIZES = (0, 1000, 4000)  # characters of text in the posts
+TIMEOUT = 20  # seconds to wait for a post before counting it lost
+WORDS = read(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'README.md')).decode().split()
+
+def body(index, size):
+    '''
+    JSON of a post with about `size` characters of text
+    '''
+    post = make_post(index)
+    start = index * 37 % len(WORDS)
+    post['bottomtext'] = ' '.join((WORDS * 2)[start:start + size])[:size]
+    return json.dumps(post)
+
+def deliver(sender, messages):
+    '''
+    mean bytes and lines sent, and median time to deliver, of the
+    messages sent in turn, and how many were lost
+    '''
+    time.sleep(FLOOD_BURST / FLOOD_RATE)  # for a full burst allowance
+    POSTS_QUEUE.clear()
+    totals = dict(sender.scheduler.totals)
+    latencies = []
+    for message in messages:
+        start, waiting = time.perf_counter(), len(POSTS_QUEUE)
+        sender.privmsg(CHANNEL, message)
+        deadline = time.monotonic() + TIMEOUT
+        while len(POSTS_QUEUE) == waiting and time.monotonic() < deadline:
+            time.sleep(.001)
+        if len(POSTS_QUEUE) > waiting:
+            latencies.append(time.perf_counter() - start)
+    POSTS_QUEUE.clear()
+    sent = sender.scheduler.totals
+    return {'lost': len(messages) - len(latencies),
+            'bytes': (sent['bytes'] - totals['bytes']) / len(messages),
+            'lines': (sent['lines'] - totals['lines']) / len(messages),
+            'ms': statistics.median(latencies) * 1000 if latencies else None}
+
+def run(count=5, *sizes):  # pylint: disable=keyword-arg-before-vararg
+    '''
+    per post, bytes and lines sent and median delivery time of each
+    format, and encoded sizes of encrypted messages
+    '''
+    ircd = FakeIRCServer()
+    sender = IRCBot('127.0.0.1', ircd.port, 'sender', 'bench')
+    IRCBot('127.0.0.1', ircd.port, 'receiver', 'bench')
+    ircd.wait_idle()
+    results = {'posts': {}, 'encrypted': {}}
+    for size in sizes or SIZES:
+        bodies = [body(index, size) for index in range(count)]
+        measured = {'json': deliver(sender, bodies),
+                    'compact': deliver(sender, [
+                        frame(text.encode()) for text in bodies])}
+        results['posts'][str(size)] = {
+            '%s_%s' % (name, key): value if value is None else round(value, 3)
+            for name, figures in measured.items()
+            for key, value in figures.items()}
+        data = os.urandom(size + 300)  # GPG adds some 300 bytes
+        results['encrypted'][str(size)] = {
+            'base58_bytes': len(b58encode(data)),
+            'compact_bytes': len(frame(
+                b'', lambda payload, data=data: data))}
+    ircd.close()
+    return results
+
+if __name__ == '__main__':
+    quiet()
+    print(json.dumps(run(*map(int, sys.argv[1:])), indent=2))
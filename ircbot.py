@@ -5,17 +5,127 @@ IRC communications for server discovery
 # pylint: disable=multiple-imports
 # the following is for newer, pip-installed pylint
 # pylint: disable=bad-option-value, consider-using-f-string
-import sys, os, socket, pwd, threading, time
-from kbcommon import CACHED, logging, TO_PAGE, CHANNEL, JSON, POSTS_QUEUE
+import sys, os, socket, pwd, threading, time, selectors, random
+from concurrent.futures import Future
+from hashlib import sha256
+from kbcommon import STATE, logging, TO_PAGE, CHANNEL, JSON, POSTS_QUEUE
+from kbcommon import SeenSet, OrderedDict
 from kbutils import decrypt, check_username
+from kbgossip import Gossip
+from kbflood import OutboundScheduler
+from kbwire import Wire, ADVERTISEMENT, unwrap
 
 IRCSERVER = 'irc.lfnet.org'
 PORT = 6667
+# comma-separated host[:port] list; servers should belong to one IRC network
+IRCSERVERS = (os.getenv('KB_IRCSERVERS') or IRCSERVER).split(',')
 BUFFERSIZE = 16 * 1024  # make it big enough to get full banner from IRC server
+CONNECT_TIMEOUT = 30  # seconds; socket is nonblocking once connected
 CRLF = '\r\n'
 TIMEOUT = int(os.getenv('KB_DELAY') or 600)
-MAXSIZE = 1024 * 1024
-MAXCACHE = MAXSIZE * 1024
+MAXSIZE = 1024 * 1024  # largest message we'll reassemble from one sender
+MAXCACHE = MAXSIZE * 1024  # total for all partial messages
+BUFFER_TIMEOUT = 300  # seconds before an unfinished message is abandoned
+BACKOFF_BASE = 1  # seconds before first reconnect attempt
+BACKOFF_MAX = 300  # longest wait between reconnect attempts
+SEEN_MESSAGES = 4096  # content hashes remembered for deduplication
+
+class ReassemblyBuffers():
+    '''
+    partial messages being reassembled from their chunks
+
+    keeps a running total, so every operation is O(1) apart from joining
+    a sender's own chunks. buffers are kept in order of last update: when
+    the total is over `maxtotal` the stalest are evicted, as are any not
+    updated for `timeout` seconds, so a spray of fake senders costs each
+    incoming line no more than the line itself.
+
+    >>> buffers = ReassemblyBuffers(maxtotal=100, maxsize=64, timeout=10)
+    >>> buffers.append('a', 'x' * 40, now=0)[-3:]
+    'xxx'
+    >>> buffers.append('b', 'y' * 40, now=1)[-3:]
+    'yyy'
+    >>> buffers.append('a', 'x' * 40, now=2) is None  # 'a' over maxsize
+    True
+    >>> len(buffers), buffers.total
+    (1, 40)
+    >>> buffers.append('c', 'z' * 50, now=3)[-3:]
+    'zzz'
+    >>> buffers.append('d', 'w' * 30, now=4)[-3:]  # evicts stalest, 'b'
+    'www'
+    >>> list(buffers.buffers), buffers.total
+    (['c', 'd'], 80)
+    >>> buffers.append('e', 'v', now=14)  # 'c' and 'd' now abandoned
+    'v'
+    >>> list(buffers.buffers), buffers.total
+    (['e'], 1)
+    >>> buffers.pop('e'), buffers.total
+    ('v', 0)
+    '''
+    def __init__(self, maxtotal=MAXCACHE, maxsize=MAXSIZE,
+                 timeout=BUFFER_TIMEOUT):
+        self.maxtotal = maxtotal
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # key: (list of chunks, total length, time of last update)
+        self.buffers = OrderedDict()
+        self.total = 0
+
+    def append(self, key, chunk, now=None):
+        '''
+        add chunk to key's buffer and return everything received so far
+
+        returns None, discarding the buffer, if it grew beyond `maxsize`
+        '''
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.expire(now)
+            chunks, size = self.buffers.pop(key, ([], 0, now))[:2]
+            chunks.append(chunk)
+            size += len(chunk)
+            self.total += len(chunk)
+            if size > self.maxsize:
+                logging.info('discarding overflowed buffer %s: %r..., '
+                             'length %d', key, chunks[0][:256], size)
+                self.total -= size
+                return None
+            self.buffers[key] = (chunks, size, now)
+            while self.total > self.maxtotal and len(self.buffers) > 1:
+                stalest, evicted = self.buffers.popitem(last=False)
+                logging.warning('evicting buffer %s of length %d',
+                                stalest, evicted[1])
+                self.total -= evicted[1]
+            return ''.join(self.buffers[key][0])
+
+    def expire(self, now):
+        '''
+        drop buffers not updated within `timeout` seconds
+
+        caller must hold the lock
+        '''
+        while self.buffers:
+            oldest, (chunks, size, updated) = next(iter(self.buffers.items()))
+            if updated > now - self.timeout:
+                break
+            logging.info('abandoning partial message %s: %r..., length %d',
+                         oldest, chunks[0][:256], size)
+            del self.buffers[oldest]
+            self.total -= size
+
+    def pop(self, key):
+        '''
+        remove and return a buffer, empty string if there wasn't one
+        '''
+        with self.lock:
+            chunks, size = self.buffers.pop(key, ([], 0, None))[:2]
+            self.total -= size
+            return ''.join(chunks)
+
+    def __len__(self):
+        return len(self.buffers)
+
+BUFFERS = ReassemblyBuffers()
 
 class IRCBot():
     '''
@@ -23,22 +133,58 @@ class IRCBot():
 
     see https://www.techbeamers.com/create-python-irc-bot/
     also https://datatracker.ietf.org/doc/html/rfc2812
+
+    all socket I/O happens in the single `ircbot_daemon` thread; other
+    threads only append lines to the outbound scheduler and wake it up, so
+    `privmsg` returns a Future immediately instead of blocking the caller
+    for the whole transmission. the scheduler paces lines to stay within
+    the server's flood limits.
     '''
-    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
     def __init__(self, server=IRCSERVER, port=PORT,
-                 nickname=None, realname=None):
+                 nickname=None, realname=None, scheduler=None,
+                 seen=None, ignore=(), gossip=None, wire=None):
         '''
         initialize the client
+
+        `seen` is a SeenSet of message hashes shared with other connections
+        to the same network, `ignore` a collection of nicknames (our
+        own, on those other connections) whose messages are dropped,
+        `gossip` the kbgossip.Gossip that handles post announcements, and
+        `wire` the kbwire.Wire that knows which peers read compact frames.
         '''
-        self.client = self.stream = None  # set by connect()
+        self.client = None  # set by connect()
+        self.healthy = False  # True while connected
+        self.irc_id = ''  # our own nick!user@host, as seen on JOIN
+        self.seen = seen
+        self.ignore = ignore
+        self.gossip = gossip or Gossip()
+        self.wire = wire or Wire(reply=self.privmsg)
+        self.buffers = BUFFERS
         self.server = server
         self.port = port
         self.nickname = nickname or pwd.getpwuid(os.geteuid()).pw_name
         # NOTE: when we implement true p2p networking, realname should include
         # connection port (or maybe not, now that we're using KB_COMMS)
         self.realname = realname or pwd.getpwuid(os.geteuid()).pw_gecos
-        self.connect(server, port, self.nickname, self.realname)
+        self.lock = threading.Lock()
+        self.scheduler = scheduler or OutboundScheduler()
+        # (target, line, unsent memoryview, future) being sent; see
+        # OutboundScheduler.get for the meaning of target and future
+        self.pending = None
+        self.received = b''  # partial line from last recv()
+        self.selector = selectors.DefaultSelector()
+        self.waker, self.wakeup = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakeup.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+        self.stopping = threading.Event()
         self.terminate = False
+        try:
+            self.connect(server, port, self.nickname, self.realname)
+        except OSError as problem:
+            logging.warning('cannot connect to %s: %s, will keep trying',
+                            server, problem)
         daemon = threading.Thread(target=self.monitor, name='ircbot_daemon')
         daemon.daemon = True
         daemon.start()
@@ -47,31 +193,38 @@ class IRCBot():
         '''
         set new nickname
         '''
-        self.client.send(('NICK %s\r\n' % nickname).encode())
+        self.nickname = nickname
+        return self.sendcontrol(('NICK %s\r\n' % nickname).encode())
 
     def join(self, channel=CHANNEL):
         '''
         join a new channel
         '''
-        self.client.send(('JOIN %s\r\n' % channel).encode())
+        return self.sendcontrol(('JOIN %s\r\n' % channel).encode())
 
     def leave(self, channel=CHANNEL):
         '''
         join a new channel
         '''
-        self.client.send(('PART %s\r\n' % channel).encode())
+        return self.sendcontrol(('PART %s\r\n' % channel).encode())
 
     def user(self, nickname, realname):
         '''
         tell server the names (the tuple (nickname, realname)) to use
         '''
         names = (nickname, realname)
-        self.client.send(('USER %s 0 * :%s\r\n' % names).encode())
+        return self.sendcontrol(('USER %s 0 * :%s\r\n' % names).encode())
 
     def connect(self, server, port, nickname, realname):
         '''
         connect to the server and identify ourselves
         '''
+        if self.client is not None:
+            try:
+                self.selector.unregister(self.client)
+            except KeyError:
+                pass  # previous connect() attempt never got registered
+            self.client.close()
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # enable keepalives at the socket (SOL_SOCKET) level
         self.client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
@@ -81,11 +234,28 @@ class IRCBot():
         self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 60)
         # quit after 5 consecutive failures
         self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
-        self.stream = self.client.makefile()
+        self.client.settimeout(CONNECT_TIMEOUT)
         self.client.connect((server, port))
-        self.user(nickname, realname)
-        self.nick(nickname)
-        self.join(CHANNEL)
+        self.client.setblocking(False)
+        self.received = b''
+        self.healthy = True
+        with self.lock:
+            if self.pending is not None:
+                # a partially sent line is garbage to the new connection,
+                # so put it back to be sent again from the beginning
+                target, line, unsent, future = self.pending  # pylint: disable=unused-variable
+                if future is False:
+                    self.scheduler.put_control(line, urgent=True)
+                else:
+                    self.scheduler.requeue(target, line, future)
+                self.pending = None
+        self.selector.register(self.client, selectors.EVENT_READ)
+        # identify ourselves ahead of anything already queued
+        for line in reversed([
+                ('USER %s 0 * :%s\r\n' % (nickname, realname)).encode(),
+                ('NICK %s\r\n' % nickname).encode(),
+                ('JOIN %s\r\n' % CHANNEL).encode()]):
+            self.sendcontrol(line, urgent=True)
 
     def privmsg(self, target, message):
         '''
@@ -94,146 +264,405 @@ class IRCBot():
         target should be a channel name preceded by '#', or nick
 
         message should not have any embedded CRLFs, or non-ASCII characters.
+
+        returns a Future which completes when the last chunk has been
+        handed to the kernel.
         '''
         sep = '\xa0'  # separates prefix from message
         logging.debug('message: %r', message)
-        testmsg = ' '.join([CACHED['irc_id'], 'PRIVMSG', target, sep + message])
+        irc_id = self.irc_id or STATE.irc_id
+        testmsg = ' '.join([irc_id, 'PRIVMSG', target, sep + message])
         logging.debug('testmsg: %s', testmsg.replace(sep, ':'))
         if len(testmsg) <= 510:
-            self.sendchunk(('PRIVMSG %s :%s\r\n' % (target, message)).encode())
+            chunks = [message]
         else:
             pieces = testmsg[:510].split(sep)
             chunklength = len(pieces[-1])
-            for chunk in [message[i:i+chunklength]
-                          for i in range(0, len(message), chunklength)]:
-                logging.debug('sending chunk %s', chunk)
-                self.sendchunk(
-                    ('PRIVMSG %s %s\r\n' % (target, chunk)).encode())
+            chunks = [message[i:i+chunklength]
+                      for i in range(0, len(message), chunklength)]
+            logging.debug('queueing %d chunks', len(chunks))
+        future = Future()
+        self.scheduler.put(
+            target,
+            [('PRIVMSG %s :%s\r\n' % (target, chunk)).encode()
+             for chunk in chunks],
+            future)
+        self.wake()
+        return future
 
     def sendchunk(self, chunk):
         '''
-        send a chunk. it must already be UTF8 encoded
+        queue a chunk for sending. it must already be UTF8 encoded
+
+        returns a Future which completes once the chunk is sent
+        '''
+        future = Future()
+        target = (chunk.split(None, 2)[1:2] or [b''])[0].decode()
+        self.scheduler.put(target, [chunk], future)
+        self.wake()
+        return future
+
+    def sendcontrol(self, line, urgent=False):
+        '''
+        queue a control line ahead of all bulk data
+
+        `urgent` puts it ahead of other control lines as well
+        '''
+        self.scheduler.put_control(line, urgent)
+        self.wake()
+
+    def wake(self):
+        '''
+        interrupt the I/O thread's select() so it notices queued lines
+        '''
+        try:
+            self.wakeup.send(b'\0')
+        except BlockingIOError:
+            pass  # already enough wakeups pending
+
+    def stop(self):
+        '''
+        tell the I/O thread to exit
+        '''
+        self.terminate = True
+        self.stopping.set()
+        self.wake()
+
+    def flush(self):
+        '''
+        send as much queued data as the socket and the flood limits allow
+
+        control lines are chosen first at every line boundary, so a PONG
+        never waits for more than the remainder of the line being sent.
         '''
-        sent, tries = False, 0
-        while not sent:
+        while True:
+            with self.lock:
+                if self.pending is None:
+                    target, line, future = self.scheduler.get()[:3]
+                    if line is None:
+                        return
+                    self.pending = (target, line, memoryview(line), future)
+                target, line, unsent, future = self.pending
             try:
-                self.client.send(chunk)
-                sent = True
-                tries = 0  # only abandon after several *consecutive* tries
-            except BrokenPipeError:
-                logging.debug('lost connection, waiting for monitor to rejoin')
-                tries += 1
-                if tries == 5:
-                    raise
-                time.sleep(3)
+                sent = self.client.send(unsent)
+            except BlockingIOError:
+                return
+            with self.lock:
+                if sent < len(unsent):
+                    self.pending = (target, line, unsent[sent:], future)
+                    continue
+                self.pending = None
+            if future and not future.done():
+                future.set_result(len(line))
 
-    def monitor(self):
+    def wants_write(self):
+        '''
+        return (True, None) if something may be sent right now, otherwise
+        (False, seconds until the flood limit allows the next line, or
+        None if nothing is queued)
         '''
-        wait for input. send a PONG for every PING
+        with self.lock:
+            if self.pending is not None:
+                return True, None
+        delay = self.scheduler.delay()
+        return delay == 0, (delay or None)
 
-        intended to run in a daemon thread
+    def stats(self):
+        '''
+        outbound queue depth and throughput
+        '''
+        return self.scheduler.stats()
 
-        set ircbot.terminate to True in order to shut it down
+    def receive(self):
         '''
-        logging.debug('ircbot monitoring incoming traffic')
-        tries = 0
-        while tries < 10:
+        read whatever is available and process each complete line
+        '''
+        data = self.client.recv(BUFFERSIZE)
+        if not data:
+            raise ConnectionResetError('server closed connection')
+        lines = (self.received + data).split(b'\n')
+        self.received = lines.pop()
+        for line in lines:
+            try:
+                self.process(line.decode(errors='replace').rstrip())
+            except Exception:  # pylint: disable=broad-except
+                # a bad line must not take down the connection
+                logging.exception('failed processing %r', line)
+
+    def reconnect(self):
+        '''
+        keep trying to connect, with jittered exponential backoff,
+        until connected or told to stop
+        '''
+        attempt = 0
+        while not self.terminate:
             try:
-                received = self.stream.readline().rstrip()
-                tries = 0
-            except ConnectionResetError:
-                tries += 1
                 self.connect(self.server, self.port,
                              self.nickname, self.realname)
+                return
+            except OSError as problem:
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+                delay *= random.uniform(0.5, 1.5)
+                attempt += 1
+                logging.warning('reconnect to %s failed (%s), next try in'
+                                ' %.1f seconds', self.server, problem, delay)
+                self.stopping.wait(delay)
+
+    def monitor(self):
+        '''
+        the single I/O thread: wait for input, send queued output.
+        send a PONG for every PING
+
+        intended to run in a daemon thread
+
+        call ircbot.stop() in order to shut it down
+        '''
+        logging.debug('ircbot monitoring incoming traffic')
+        while not self.terminate:
+            if not self.healthy:
+                self.reconnect()
                 continue
-            logging.info('received: %r, length: %d', received, len(received))
-            end_message = len(received) < 510
-            # make sure all words[n] references are accounted for
-            words = received.split() + ['', '', '']
-            nickname, matched = check_username(words[0])
-            if words[0] == 'PING':
-                pong = received.replace('I', 'O', 1).rstrip() + CRLF
-                logging.info('sending: %r', pong)
-                self.client.send(pong.encode())
-            elif words[1] == 'JOIN' and matched:
-                CACHED['irc_id'] = words[0]
-                logging.info("CACHED['irc_id'] = %s", CACHED['irc_id'])
-            elif words[1] == 'PRIVMSG':
-                sender = nickname
-                privacy = 'public' if words[2] == CHANNEL else 'private'
-                logging.info('%s message received from %s:', privacy, sender)
-                # chop preceding ':' from ':this is a private message'
-                CACHED[sender] += ' '.join(words[3:])[1:].rstrip()
-                # try decoding what we have so far
-                # gnupg will log a warning if unsuccessful
-                logging.debug('attempting to decode %s', CACHED[sender])
-                text, trustlevel = decrypt(CACHED[sender].encode())
-                logging.debug('text: %s, trustlevel: %s', text, trustlevel)
-                if text or end_message:
-                    text = text or CACHED[sender][:256].encode()
-                    logging.info('(ignore any warnings above from gnupg; '
-                                 'the message, once complete, was '
-                                 'successfully decrypted)')
-                    logging.info(
-                        '%s %s message from %s: %s',
-                        trustlevel,
-                        privacy,
-                        sender,
-                        text.decode().replace('<', '&lt;').replace('>', '&gt;'),
-                        **TO_PAGE)
-                    if JSON.match(CACHED[sender]):
-                        POSTS_QUEUE.append(CACHED[sender])
-                        logging.debug('appended %r to POSTS_QUEUE',
-                                      CACHED[sender])
-                    else:
-                        logging.debug('Not JSON: %s', CACHED[sender])
-                    CACHED[sender] = ''
-                elif len(CACHED[sender]) > MAXSIZE:
-                    logging.info(
-                        'clearing overflow CACHED[%s]: %r..., length %d',
-                        sender, CACHED[sender][:256], len(CACHED[sender]))
-                    CACHED[sender] = ''
-                else:
-                    logging.debug('CACHED[%s] now %r', sender, CACHED[sender])
-            clearcache()
+            events = selectors.EVENT_READ
+            ready, timeout = self.wants_write()
+            if ready:
+                events |= selectors.EVENT_WRITE
+            self.selector.modify(self.client, events)
+            try:
+                for key, mask in self.selector.select(timeout):
+                    if key.fileobj is self.waker:
+                        while True:
+                            try:
+                                self.waker.recv(BUFFERSIZE)
+                            except BlockingIOError:
+                                break
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self.receive()
+                    if mask & selectors.EVENT_WRITE:
+                        self.flush()
+            except OSError as problem:  # includes ConnectionResetError
+                logging.warning('lost connection to %s (%s), reconnecting',
+                                self.server, problem)
+                self.healthy = False
         logging.warning('ircbot terminated from launching thread')
 
+    def process(self, received):
+        '''
+        act on a single line received from the server
+        '''
+        logging.info('received: %r, length: %d', received, len(received))
+        end_message = len(received) < 510
+        # make sure all words[n] references are accounted for
+        words = received.split() + ['', '', '']
+        nickname, matched = check_username(words[0])
+        if words[0] == 'PING':
+            pong = received.replace('I', 'O', 1).rstrip() + CRLF
+            logging.info('sending: %r', pong)
+            self.sendcontrol(pong.encode(), urgent=True)
+        elif words[1] == 'JOIN' and nickname == self.nickname:
+            self.irc_id = words[0]
+            if matched:
+                STATE.irc_id = words[0]
+                logging.info('STATE.irc_id = %s', STATE.irc_id)
+            self.privmsg(CHANNEL, ADVERTISEMENT)
+        elif words[1] == 'PRIVMSG' and nickname in self.ignore:
+            logging.debug('ignoring our own message relayed via %s',
+                          self.server)
+        elif words[1] == 'PRIVMSG':
+            sender = nickname
+            privacy = 'public' if words[2] == CHANNEL else 'private'
+            logging.info('%s message received from %s:', privacy, sender)
+            # reassemble per sender *and* target, since chunks of a
+            # channel post and of a private message may now interleave;
+            # and per receiving connection, since a pool may get each line
+            # twice, and a process may run several bots
+            buffered = (nickname, words[2], self.nickname,
+                        self.server, self.port)
+            # chop preceding ':' from ':this is a private message'
+            message = self.buffers.append(
+                buffered, ' '.join(words[3:])[1:].rstrip())
+            if message is None:
+                return  # overflowed and discarded by the buffer store
+            if self.wire.heard(sender, message, privacy == 'private'):
+                self.buffers.pop(buffered)
+                return
+            message = unwrap(message)  # if a whole unencrypted frame
+            # try decoding what we have so far
+            # gnupg will log a warning if unsuccessful
+            logging.debug('attempting to decode %s', message)
+            text, trustlevel = decrypt(message.encode())
+            if trustlevel == 'unencoded' and not end_message:
+                text = b''  # plain text, so only a short line ends it
+            logging.debug('text: %s, trustlevel: %s', text, trustlevel)
+            # the same words from another sender, or to another target,
+            # are another message; only relays of this one are duplicates
+            duplicate = (text or end_message) and self.seen is not None and \
+                not self.seen.add(sha256(' '.join(
+                    (sender, words[2], message)).encode()).digest())
+            if duplicate:
+                logging.debug('dropping duplicate of message already'
+                              ' received via another server')
+                self.buffers.pop(buffered)
+            elif text or end_message:
+                text = text or message[:256].encode()
+                logging.info('(ignore any warnings above from gnupg; '
+                             'the message, once complete, was '
+                             'successfully decrypted)')
+                logging.info(
+                    '%s %s message from %s: %s',
+                    trustlevel,
+                    privacy,
+                    sender,
+                    text.decode().replace('<', '&lt;').replace('>', '&gt;'),
+                    extra=dict(TO_PAGE['extra'], conversation=sender
+                               if privacy == 'private' else CHANNEL))
+                if self.gossip.heard(message):
+                    logging.debug('handled announcement %s', message)
+                elif JSON.match(message):
+                    POSTS_QUEUE.append(message)
+                    logging.debug('appended %r to POSTS_QUEUE', message)
+                else:
+                    logging.debug('Not JSON: %s', message)
+                self.buffers.pop(buffered)
+            else:
+                logging.debug('buffer %s now %r', buffered, message)
+
+class IRCPool():
+    '''
+    connections to several servers of one IRC network, used as one IRCBot
+
+    each connection has its own flood limits, so whole messages are
+    spread across the healthy connections, least backlogged first.
+    (chunks of one message must stay together: receivers reassemble per
+    sender, and relaying servers don't preserve order between them.)
+    messages arriving through more than one server are delivered once.
+
+    >>> from kbfakeirc import FakeIRCServer
+    >>> servers = [FakeIRCServer(), FakeIRCServer()]
+    >>> pool = IRCPool(['127.0.0.1:%d' % server.port for server in servers],
+    ...                nickname='pooled', realname='doctest')
+    >>> sorted(pool.nicknames)
+    ['pooled', 'pooled_1']
+    >>> servers[0].wait_idle() and servers[1].wait_idle()
+    True
+    >>> POSTS_QUEUE.clear()
+    >>> peers = [socket.create_connection(('127.0.0.1', server.port))
+    ...          for server in servers]
+    >>> for peer in peers:  # same post relayed by both servers
+    ...     peer.sendall(b'USER peer 0 * :peer\\r\\nNICK peer\\r\\n'
+    ...                  b'JOIN #kybyz\\r\\nPRIVMSG #kybyz :{"a":1}\\r\\n')
+    >>> while not POSTS_QUEUE:
+    ...     time.sleep(.1)
+    >>> time.sleep(.5); list(POSTS_QUEUE)
+    ['{"a":1}']
+    >>> other = socket.create_connection(('127.0.0.1', servers[0].port))
+    >>> other.sendall(b'USER other 0 * :other\\r\\nNICK other\\r\\n'
+    ...               b'JOIN #kybyz\\r\\nPRIVMSG #kybyz :{"a":1}\\r\\n')
+    >>> while len(POSTS_QUEUE) < 2:  # same words, another sender
+    ...     time.sleep(.1)
+    >>> other.close(); list(POSTS_QUEUE)
+    ['{"a":1}', '{"a":1}']
+    >>> servers[0].close()
+    >>> while pool.bots[0].healthy:
+    ...     time.sleep(.1)
+    >>> pool.privmsg('#kybyz', 'still here').result(timeout=10) > 0
+    True
+    >>> pool.stop(); servers[1].close()
+    >>> for peer in peers:
+    ...     peer.close()
+    '''
+    def __init__(self, servers=None, nickname=None, realname=None):
+        self.seen = SeenSet(SEEN_MESSAGES)
+        self.gossip = Gossip(
+            announce=lambda message: self.privmsg(CHANNEL, message))
+        self.wire = Wire(reply=lambda target, message: self.privmsg(
+            target, message))
+        nickname = nickname or pwd.getpwuid(os.geteuid()).pw_name
+        # the same nick cannot be on two servers of one network at once
+        self.nicknames = set()
+        names = [self.alias(nickname, index)
+                 for index in range(len(servers or IRCSERVERS))]
+        self.nicknames.update(names)
+        self.bots = []
+        for name, server in zip(names, servers or IRCSERVERS):
+            host, port = (server.split(':') + [PORT])[:2]
+            self.bots.append(IRCBot(host, int(port), name, realname,
+                                    seen=self.seen, ignore=self.nicknames,
+                                    gossip=self.gossip, wire=self.wire))
+
+    @staticmethod
+    def alias(nickname, index):
+        '''
+        nickname to use on the `index`th connection
+        '''
+        return nickname if index == 0 else '%s_%d' % (nickname, index)
+
+    def healthy(self):
+        '''
+        connections currently up
+        '''
+        return [bot for bot in self.bots if bot.healthy]
+
+    def privmsg(self, target, message):
+        '''
+        send message via the least backlogged healthy connection
+
+        if none is up, it waits in the first one's queue for reconnection
+        '''
+        bots = self.healthy() or self.bots[:1]
+        bot = min(bots, key=lambda bot: bot.stats()['queued_bytes'])
+        return bot.privmsg(target, message)
+
+    def nick(self, nickname):
+        '''
+        set new nickname on all connections
+        '''
+        names = [self.alias(nickname, index) for index in range(len(self.bots))]
+        self.nicknames.update(names)  # ignore old and new while changing
+        for name, bot in zip(names, self.bots):
+            bot.nick(name)
+
+    def join(self, channel=CHANNEL):
+        '''
+        join a channel on all connections
+        '''
+        for bot in self.bots:
+            bot.join(channel)
+
+    def leave(self, channel=CHANNEL):
+        '''
+        leave a channel on all connections
+        '''
+        for bot in self.bots:
+            bot.leave(channel)
+
+    def stats(self):
+        '''
+        per-server connection state and outbound queue figures
+        '''
+        return {bot.server: dict(bot.stats(), healthy=bot.healthy)
+                for bot in self.bots}
+
+    def stop(self):
+        '''
+        shut down all connections
+        '''
+        for bot in self.bots:
+            bot.stop()
+
 def test(nickname=None, realname=None):
     '''
     run a bot from the command line, for testing
     '''
     ircbot = type('IRCBot', (), {'terminate': False})()
     try:
-        ircbot = IRCBot(nickname=nickname, realname=realname)
+        ircbot = IRCPool(nickname=nickname, realname=realname)
         time.sleep(TIMEOUT)
     except KeyboardInterrupt:
         logging.warning('Telling monitor to terminate')
         ircbot.terminate = True
-
-def clearcache(maxcache=MAXCACHE):
-    '''
-    delete entries if CACHED size is greater than MAXCACHE
-
-    >>> CACHED.update({':2': 'x' * 1024, ':1': 'y' * 64, ':3': 'z' * 2048})
-    >>> logging.debug('sum of lengths: %d', sum(map(len,
-    ...  [v for k, v in CACHED.items() if k.startswith(':')])))
-    >>> logging.info('doctest CACHED.keys(): %s', list(CACHED.keys()))
-    >>> clearcache(100)
-    >>> {k: v for k, v in CACHED.items() if k.startswith(':')}
-    {':1': 'yyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyy'}
-    >>> len(CACHED[':1'])
-    64
-    '''
-    logging.debug('CACHED.keys(): %s', list(CACHED.keys()))
-    while sum(map(len, [v for k, v in CACHED.items()
-                        if k.startswith(':')])) > maxcache:
-        next_biggest = max({k: v for k, v in CACHED.items()
-                            if k.startswith(':')},
-                           key=lambda k: len(CACHED[k]))
-        logging.debug('next_biggest: %s', next_biggest)
-        logging.warning('deleting CACHED[%s] of length %d', next_biggest,
-                        len(CACHED[next_biggest]))
-        del CACHED[next_biggest]
+        if hasattr(ircbot, 'stop'):
+            ircbot.stop()
 
 if __name__ == '__main__':
     sys.argv.extend(['', ''])  # in case no args given
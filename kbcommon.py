@@ -2,14 +2,15 @@
 '''
 common data structures needed by various parts of kybyz
 '''
-import sys, os, logging, re  # pylint: disable=multiple-imports
-from collections import defaultdict, deque, namedtuple
+import sys, os, logging, re, threading  # pylint: disable=multiple-imports
+from collections import deque, namedtuple, OrderedDict
 from datetime import datetime, timezone
+from kblog import BufferedRotatingFileHandler, Formatter, pipeline
+from kbmessages import MessageStore
 
 COMMAND = os.path.splitext(os.path.basename(sys.argv[0]))[0]
 ARGS = sys.argv[1:]
 EXAMPLE = 'example.kybyz'  # subdirectory with sample posts
-CACHED = defaultdict(str, {'uptime': None})
 HOME = os.path.expanduser('~')
 CACHE = os.path.join(HOME, '.kybyz')
 KYBYZ_HOME = os.path.join(CACHE, 'home')
@@ -24,42 +25,178 @@ LOGSTREAM_HANDLER = logging.StreamHandler()
 LOGLEVEL = logging.DEBUG if ARGS or os.getenv('KB_DEBUG') else logging.INFO
 if not os.path.split(sys.argv[0])[1].endswith(('doctest', 'doctest.py')):
     LOGSTREAM_HANDLER.setLevel(LOGLEVEL)
-LOGFILE_HANDLER = logging.FileHandler(LOGFILE)
+LOGFILE_HANDLER = BufferedRotatingFileHandler(LOGFILE)
 LOGFILE_HANDLER.setLevel(logging.DEBUG)
-LOGFILE_HANDLER.setFormatter(logging.Formatter(EXTENDED_LOG_FORMAT))
-MESSAGE_QUEUE = deque(maxlen=1024)
-POSTS_QUEUE = deque(maxlen=1024)
+LOGFILE_HANDLER.setFormatter(Formatter(EXTENDED_LOG_FORMAT))
 TO_PAGE = {'extra': {'to_page': True}}
 REGISTRATION = namedtuple('registration', ('username', 'email', 'gpgkey'))
 CHANNEL = '#kybyz'
+PAGESIZE = int(os.getenv('KB_PAGESIZE', '20'))  # posts per page of a listing
 JSON = re.compile(r'^\{.*\}$')
 
-class DequeHandler(logging.NullHandler):
+class BoundedQueue(deque):
     '''
-    simple handler to append log record to queue
+    deque with a maxlen, counting what is appended and what is dropped
+    off the other end to make room
+
+    >>> queue = BoundedQueue(maxlen=2)
+    >>> for item in 'abc':
+    ...     queue.append(item)
+    >>> list(queue), queue.appended, queue.dropped
+    (['b', 'c'], 3, 1)
+    '''
+    appended = dropped = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()  # so the counts stay true
+
+    def append(self, item):
+        '''
+        append item on the right, counting any dropped from the left
+        '''
+        with self.lock:
+            self.appended += 1
+            if len(self) == self.maxlen:
+                self.dropped += 1
+            super().append(item)
+
+class Snapshot():
+    '''
+    an immutable value, such as the REGISTRATION, replaced whole
+
+    readers take `value` without a lock, and see either the old or the
+    new, never a mix of the two
+
+    >>> registered = Snapshot(REGISTRATION(None, None, None))
+    >>> registered.replace(username='jc')
+    registration(username='jc', email=None, gpgkey=None)
+    >>> registered.value.username
+    'jc'
+    '''
+    def __init__(self, value):
+        self.value = value
+        self.lock = threading.Lock()  # for writers only
+
+    def set(self, value):
+        '''
+        replace the value
+        '''
+        self.value = value
+
+    def replace(self, **changes):
+        '''
+        replace some fields of the value, returning the new value
+        '''
+        with self.lock:
+            self.value = self.value._replace(**changes)
+            return self.value
+
+class Tally():
+    '''
+    counter that any thread may increment, and read without a lock
+
+    >>> tally = Tally()
+    >>> tally.increment(), tally.increment(), tally.value
+    (1, 2, 2)
+    '''
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def increment(self, count=1):
+        '''
+        add to the count, returning the new count
+        '''
+        with self.lock:
+            self.value += count
+            return self.value
+
+class State():  # pylint: disable=too-few-public-methods
+    '''
+    what kybyz has found out while running
+
+    each attribute is set whole, so it can be read without a lock
+    '''
+    uptime = None  # seconds, as of the last report
+    javascript = ''  # how the page's script is doing, shown on the page
+    irc_id = ''  # our own nick!user@host on IRC, as seen on JOIN
+    ircbot = None  # the IRCPool, once connected
+
+    def __repr__(self):
+        return '<State uptime=%r javascript=%r irc_id=%r ircbot=%r>' % (
+            self.uptime, self.javascript, self.irc_id, self.ircbot)
+
+POSTS_QUEUE = BoundedQueue(maxlen=1024)
+REGISTERED = Snapshot(REGISTRATION(None, None, None))  # set by init()
+STATE = State()
+# messages for the page, kept only in memory while running doctests
+MESSAGE_STORE = MessageStore(None if COMMAND == 'doctest' else
+                             os.path.join(CACHE, 'messages.log'))
+
+class PageHandler(logging.NullHandler):
+    '''
+    simple handler to add log records meant for the page to the
+    MESSAGE_STORE, in the conversation given by `conversation`, if any
 
     >>> logging.debug('test')
     >>> logging.debug('test to page', **TO_PAGE)
     '''
     def handle(self, record):
         if hasattr(record, 'to_page') and record.to_page:
-            #logging.debug('adding to MESSAGE_QUEUE: %s', record)
-            MESSAGE_QUEUE.append(':'.join([
+            MESSAGE_STORE.append(':'.join([
                 record.name,
                 record.levelname,
-                record.msg % record.args
-            ]))
+                record.getMessage()
+            ]), getattr(record, 'conversation', ''))
 
-LOGQUEUE_HANDLER = DequeHandler()
+LOGQUEUE_HANDLER = PageHandler()
 LOGQUEUE_HANDLER.setLevel(logging.INFO)
+LOGSTREAM_HANDLER.setFormatter(logging.Formatter(BASE_LOG_FORMAT))
+# the handlers are written by a listener thread, behind a queue
+LOGGING_HANDLER, LOG_LISTENER = pipeline(
+    [LOGSTREAM_HANDLER, LOGFILE_HANDLER, LOGQUEUE_HANDLER])
 
 logging.basicConfig(
     level=logging.DEBUG if __debug__ else logging.INFO,
-    format=BASE_LOG_FORMAT,
-    handlers=[LOGSTREAM_HANDLER, LOGFILE_HANDLER, LOGQUEUE_HANDLER]
+    handlers=[LOGGING_HANDLER]
 )
 logging.info('COMMAND: %s, ARGS: %s', COMMAND, ARGS)
 
+class SeenSet():
+    '''
+    bounded set remembering only the `maxlen` most recently added items
+
+    >>> seen = SeenSet(2)
+    >>> seen.add('a'), seen.add('a'), seen.add('b'), seen.add('c')
+    (True, False, True, True)
+    >>> 'a' in seen, 'c' in seen, len(seen)
+    (False, True, 2)
+    '''
+    def __init__(self, maxlen=4096):
+        self.maxlen = maxlen
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, item):
+        '''
+        add item, returning False if it was already there
+        '''
+        with self.lock:
+            if item in self.items:
+                self.items.move_to_end(item)
+                return False
+            self.items[item] = None
+            if len(self.items) > self.maxlen:
+                self.items.popitem(last=False)
+            return True
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __len__(self):
+        return len(self.items)
+
 def read(filename):
     '''
     read and return file contents
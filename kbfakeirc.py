@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+'''
+local stand-in IRC server for doctests, benchmarks, and load testing
+
+speaks only the subset of RFC 2812 that IRCBot uses: USER, NICK, JOIN,
+PART, PRIVMSG, PING, PONG and QUIT. it binds to localhost only.
+
+optionally enforces a flood rule the way ircds do, counting (and, if
+asked, disconnecting) clients that send lines faster than allowed.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import sys, socket, threading, time  # pylint: disable=multiple-imports
+from collections import defaultdict
+from kbcommon import logging
+from kbflood import TokenBucket
+
+SERVERNAME = 'irc.kybyz.test'
+FLOOD_TOLERANCE = 1  # lines of slack for network jitter
+
+class FakeIRCServer():
+    '''
+    threaded IRC server, one thread per client
+
+    >>> server = FakeIRCServer()
+    >>> client = socket.create_connection(('127.0.0.1', server.port))
+    >>> client.sendall(b'USER test 0 * :tester\\r\\nNICK test\\r\\n')
+    >>> client.sendall(b'JOIN #kybyz\\r\\nPING :hello\\r\\n')
+    >>> reader = client.makefile('rb')
+    >>> reader.readline().split()[1]
+    b'001'
+    >>> reader.readline().split()[1:]
+    [b'JOIN', b'#kybyz']
+    >>> reader.readline().split()[1:]
+    [b'PONG', b'irc.kybyz.test', b':hello']
+    >>> client.close(); server.close()
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, host='127.0.0.1', port=0, rate=0, burst=5, kick=False):
+        '''
+        start listening; `rate` lines per second with `burst`, 0 for no limit
+        '''
+        self.listener = socket.create_server((host, port))
+        self.port = self.listener.getsockname()[1]
+        self.rate, self.burst, self.kick = rate, burst, kick
+        self.lock = threading.Lock()
+        self.clients = {}  # nickname: socket
+        self.channels = defaultdict(set)  # channel: set of nicknames
+        self.violations = 0
+        self.lines = self.privmsgs = 0
+        self.bytes_in = self.bytes_out = 0
+        self.last_activity = time.monotonic()
+        self.running = True
+        threading.Thread(target=self.accept, name='fakeirc',
+                         daemon=True).start()
+
+    def accept(self):
+        '''
+        hand each incoming connection to its own thread
+        '''
+        while self.running:
+            try:
+                connection = self.listener.accept()[0]
+            except OSError:
+                break
+            threading.Thread(target=self.handle, args=(connection,),
+                             name='fakeirc_client', daemon=True).start()
+
+    def send(self, nickname, line):
+        '''
+        send a line to a client, ignoring any that have gone away
+        '''
+        with self.lock:
+            connection = self.clients.get(nickname)
+        if connection is not None:
+            data = line.encode() + b'\r\n'
+            with self.lock:
+                self.bytes_out += len(data)
+            try:
+                connection.sendall(data)
+            except OSError:
+                logging.debug('fake IRC client %s went away', nickname)
+
+    def broadcast(self, channel, line, exclude=None):
+        '''
+        send a line to every member of a channel
+        '''
+        with self.lock:
+            members = set(self.channels[channel]) - {exclude}
+        for member in members:
+            self.send(member, line)
+
+    def handle(self, connection):
+        '''
+        process lines from one client until it disconnects
+        '''
+        # pylint: disable=too-many-branches
+        bucket = TokenBucket(self.rate, self.burst)
+        nickname = username = None
+        prefix = ''
+        with connection, connection.makefile('rb') as reader:
+            for raw in self.lines_from(reader):
+                line = raw.decode(errors='replace').rstrip('\r\n')
+                with self.lock:
+                    self.lines += 1
+                    self.bytes_in += len(raw)
+                    self.last_activity = time.monotonic()
+                if self.rate:
+                    bucket.take(1)
+                    if bucket.tokens < -FLOOD_TOLERANCE:
+                        with self.lock:
+                            self.violations += 1
+                        logging.warning('flood violation by %s', nickname)
+                        if self.kick:
+                            connection.sendall(b'ERROR :Excess Flood\r\n')
+                            break
+                words, trailing = (line.split(' :', 1) + [None])[:2]
+                words = words.split()
+                if trailing is not None:
+                    words.append(trailing)
+                command = (words or [''])[0].upper()
+                if command == 'USER':
+                    username = words[1]
+                elif command == 'NICK':
+                    with self.lock:
+                        self.clients.pop(nickname, None)
+                        nickname = words[1]
+                        self.clients[nickname] = connection
+                    prefix = ':%s!%s@127.0.0.1' % (nickname, username)
+                    self.send(nickname, ':%s 001 %s :Welcome' % (
+                        SERVERNAME, nickname))
+                elif command == 'JOIN':
+                    with self.lock:
+                        self.channels[words[1]].add(nickname)
+                    self.broadcast(words[1], '%s JOIN %s' % (prefix, words[1]))
+                elif command == 'PART':
+                    self.broadcast(words[1], '%s PART %s' % (prefix, words[1]))
+                    with self.lock:
+                        self.channels[words[1]].discard(nickname)
+                elif command == 'PRIVMSG' and len(words) > 2:
+                    with self.lock:
+                        self.privmsgs += 1
+                    relayed = '%s PRIVMSG %s :%s' % (prefix, words[1], words[2])
+                    if words[1].startswith('#'):
+                        self.broadcast(words[1], relayed, exclude=nickname)
+                    else:
+                        self.send(words[1], relayed)
+                elif command == 'PING':
+                    self.send(nickname, ':%s PONG %s :%s' % (
+                        SERVERNAME, SERVERNAME, words[-1]))
+                elif command == 'QUIT':
+                    break
+        with self.lock:
+            if self.clients.get(nickname) is connection:
+                del self.clients[nickname]
+            for members in self.channels.values():
+                members.discard(nickname)
+
+    @staticmethod
+    def lines_from(reader):
+        '''
+        yield lines until the client disconnects, however it does so
+        '''
+        try:
+            yield from reader
+        except OSError:
+            return
+
+    def ping(self, token='kybyz'):
+        '''
+        PING every connected client, as a real server does periodically
+        '''
+        with self.lock:
+            nicknames = list(self.clients)
+        for nickname in nicknames:
+            self.send(nickname, 'PING :%s' % token)
+
+    def wait_idle(self, quiet=0.2, timeout=30):
+        '''
+        wait until no line has arrived for `quiet` seconds
+        '''
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                idle = time.monotonic() - self.last_activity
+            if idle >= quiet:
+                return True
+            time.sleep(quiet - idle)
+        return False
+
+    def close(self):
+        '''
+        stop accepting connections and drop the ones we have
+        '''
+        self.running = False
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)  # wakes up accept()
+        except OSError:
+            pass
+        self.listener.close()
+        with self.lock:
+            connections = list(self.clients.values())
+            self.clients.clear()
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+if __name__ == '__main__':
+    SERVER = FakeIRCServer(port=int((sys.argv[1:] or ['6667'])[0]))
+    logging.info('fake IRC server listening on port %d', SERVER.port)
+    try:
+        while True:
+            time.sleep(60)
+            SERVER.ping()
+    except KeyboardInterrupt:
+        SERVER.close()
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
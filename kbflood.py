@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+'''
+outbound flood control for IRC
+
+IRC servers throttle or disconnect ("Excess Flood") clients that send
+lines faster than their flood rules allow, so every line IRCBot sends
+goes through an OutboundScheduler.
+
+set KB_FLOOD_RATE (lines per second), KB_FLOOD_BURST (lines), and
+optionally KB_FLOOD_BYTES (bytes per second) to match the server's rules.
+
+>>> from kbfakeirc import FakeIRCServer
+>>> from ircbot import IRCBot
+>>> server = FakeIRCServer(rate=20, burst=5)
+>>> bot = IRCBot('127.0.0.1', server.port, 'polite', 'doctest',
+...              scheduler=OutboundScheduler(rate=20, burst=5))
+>>> bot.privmsg('#kybyz', 'x' * 8000).result(timeout=30) > 0
+True
+>>> server.wait_idle()
+True
+>>> server.violations
+0
+>>> bot.stats()['lines'] > 16
+True
+>>> rude = IRCBot('127.0.0.1', server.port, 'rude', 'doctest',
+...               scheduler=OutboundScheduler(rate=0))
+>>> rude.privmsg('#kybyz', 'x' * 8000).result(timeout=30) > 0
+True
+>>> server.wait_idle()
+True
+>>> server.violations > 0
+True
+>>> bot.stop(); rude.stop(); server.close()
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, time, threading  # pylint: disable=multiple-imports
+from collections import deque, OrderedDict
+
+FLOOD_RATE = float(os.getenv('KB_FLOOD_RATE') or 1)  # lines per second
+FLOOD_BURST = int(os.getenv('KB_FLOOD_BURST') or 5)  # lines
+FLOOD_BYTES = int(os.getenv('KB_FLOOD_BYTES') or 0)  # bytes/second, 0=any
+MAXLINE = 512  # bytes, including CRLF, per RFC 2812
+METRICS_WINDOW = 60  # seconds over which to average bytes/second
+
+class TokenBucket():
+    '''
+    classic token bucket; a rate of 0 means no limit
+
+    >>> bucket = TokenBucket(rate=1, burst=2, now=0)
+    >>> bucket.delay(1, now=0)
+    0
+    >>> bucket.take(1, now=0); bucket.take(1, now=0)
+    >>> bucket.delay(1, now=0)
+    1.0
+    >>> bucket.delay(1, now=0.5)
+    0.5
+    '''
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now=None):
+        '''
+        add tokens for the time elapsed since last refill
+        '''
+        now = time.monotonic() if now is None else now
+        elapsed = max(0, now - self.updated)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now=None):
+        '''
+        seconds until `amount` tokens are available, 0 if they are now
+
+        anything bigger than the whole bucket only waits for a full bucket
+        '''
+        if not self.rate:
+            return 0
+        self.refill(now)
+        shortfall = min(amount, self.burst) - self.tokens
+        return 0 if shortfall <= 0 else shortfall / self.rate
+
+    def take(self, amount, now=None):
+        '''
+        remove tokens. the bucket may go into debt, for lines that cannot
+        wait, in which case following lines wait longer
+        '''
+        if self.rate:
+            self.refill(now)
+            self.tokens -= amount
+
+class OutboundScheduler():
+    '''
+    decide which queued line goes out next, and when
+
+    control lines (PONG, NICK, JOIN...) always go first and are never
+    throttled, though they use up tokens. bulk lines are queued per target
+    and the targets are served round-robin a line at a time, so one big
+    `publish()` to the channel cannot starve a short private message.
+
+    >>> scheduler = OutboundScheduler(rate=1, burst=3)
+    >>> scheduler.put('#kybyz', [b'a1', b'a2', b'a3'])
+    >>> scheduler.put('bob', [b'b1'])
+    >>> scheduler.put_control(b'PONG')
+    >>> [scheduler.get(now=0)[1] for i in range(3)]
+    [b'PONG', b'a1', b'b1']
+    >>> scheduler.get(now=0)[3]
+    1.0
+    >>> scheduler.get(now=1)[1]
+    b'a2'
+    >>> scheduler.stats(now=1)['queued_lines']
+    1
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, rate=FLOOD_RATE, burst=FLOOD_BURST,
+                 byterate=FLOOD_BYTES):
+        self.lock = threading.Lock()
+        self.lines = TokenBucket(rate, burst)
+        self.bytes = TokenBucket(byterate, max(byterate, MAXLINE * burst))
+        self.control = deque()
+        self.queues = OrderedDict()  # target: deque of (line, future)
+        self.queued_lines = self.queued_bytes = 0
+        self.window = deque()  # (time sent, bytes) for the last minute
+        self.totals = {'lines': 0, 'bytes': 0, 'control': 0}
+        self.started = time.monotonic()
+
+    def put(self, target, lines, future=None):
+        '''
+        queue lines for target; `future` goes with the last line
+        '''
+        with self.lock:
+            queue = self.queues.setdefault(target, deque())
+            for line in lines[:-1]:
+                queue.append((line, None))
+            queue.append((lines[-1], future))
+            self.queued_lines += len(lines)
+            self.queued_bytes += sum(map(len, lines))
+
+    def requeue(self, target, line, future):
+        '''
+        put a line back at the head of its target's queue
+        '''
+        with self.lock:
+            self.queues.setdefault(target, deque()).appendleft((line, future))
+            self.queues.move_to_end(target, last=False)
+            self.queued_lines += 1
+            self.queued_bytes += len(line)
+
+    def put_control(self, line, urgent=False):
+        '''
+        queue a control line ahead of all bulk data
+
+        `urgent` puts it ahead of other control lines as well
+        '''
+        with self.lock:
+            if urgent:
+                self.control.appendleft(line)
+            else:
+                self.control.append(line)
+
+    def delay(self, now=None):
+        '''
+        seconds until the next line may be sent; None if nothing is queued
+        '''
+        with self.lock:
+            if self.control:
+                return 0
+            if not self.queues:
+                return None
+            line = next(iter(self.queues.values()))[0][0]
+            return max(self.lines.delay(1, now),
+                       self.bytes.delay(len(line), now))
+
+    def get(self, now=None):
+        '''
+        return (target, line, future, 0) for the next line to send,
+        or (None, None, None, delay) if nothing may be sent yet
+
+        a target of None, with a future of False, marks a control line
+        '''
+        wait = self.delay(now)
+        with self.lock:
+            if self.control:
+                line = self.control.popleft()
+                self.totals['control'] += 1
+                self.sent(line, now)
+                return None, line, False, 0
+            if wait != 0:  # includes None when queues are empty
+                return None, None, None, wait
+            target, queue = next(iter(self.queues.items()))
+            line, future = queue.popleft()
+            if queue:
+                self.queues.move_to_end(target)
+            else:
+                del self.queues[target]
+            self.queued_lines -= 1
+            self.queued_bytes -= len(line)
+            self.sent(line, now)
+            return target, line, future, 0
+
+    def sent(self, line, now=None):
+        '''
+        charge the buckets and record metrics for a line leaving
+
+        caller must hold the lock
+        '''
+        now = time.monotonic() if now is None else now
+        self.lines.take(1, now)
+        self.bytes.take(len(line), now)
+        self.totals['lines'] += 1
+        self.totals['bytes'] += len(line)
+        self.window.append((now, len(line)))
+        while self.window and self.window[0][0] < now - METRICS_WINDOW:
+            self.window.popleft()
+
+    def stats(self, now=None):
+        '''
+        queue depth and throughput figures
+        '''
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            elapsed = max(min(METRICS_WINDOW, now - self.started), 1)
+            recent = sum(count for sent, count in self.window
+                         if sent >= now - METRICS_WINDOW)
+            return dict(self.totals,
+                        control_queued=len(self.control),
+                        queued_lines=self.queued_lines,
+                        queued_bytes=self.queued_bytes,
+                        targets=len(self.queues),
+                        bytes_per_second=recent / elapsed)
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
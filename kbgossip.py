@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+'''
+gossip: announce posts on the channel by hash, and pull what we lack
+
+publishing a post sends only `kbz:have <hash> <size> <type> <host:port>`
+to the channel. a node hearing it fetches the post from that address
+over kbpeer, unless it has it already or is fetching it from someone
+else, in which case the address is kept in case that fetch fails.
+
+having fetched a post, a node waits a random time of up to SUPPRESS
+seconds and then, unless FANOUT others have re-announced it meanwhile,
+re-announces it as another source. so only about FANOUT nodes do so,
+however big the network gets. each node announces a post at most once,
+and fetches it at most once, so re-announcements cannot storm.
+
+fetches run in a pool of FETCHERS threads, and at most PENDING posts
+wait to be fetched; announcements beyond that are dropped. addresses on
+our own network, or names that might resolve to one, are not fetched
+from unless KB_GOSSIP_PRIVATE is set, lest anyone on the channel have
+us connect wherever they like. a source is only synced with later (see
+kbsync) once it has sent a post that matches its hash.
+
+>>> import tempfile
+>>> from kbpeer import PeerServer
+>>> server = PeerServer('example.kybyz', host='127.0.0.1', port=0)
+>>> address = '127.0.0.1:%d' % server.port
+>>> directory, received = tempfile.mkdtemp(), []
+>>> Gossip(directory).heard(announcement('kbzother', 1, 'netmeme', address))
+True
+>>> gossip = Gossip(directory, address='127.0.0.1:1', fanout=0,
+...                 deliver=lambda hashed, body: received.append(hashed),
+...                 private=True)
+>>> message = announcement('kbztestmeme', 302, 'netmeme', address)
+>>> message  # doctest: +ELLIPSIS
+'kbz:have kbztestmeme 302 netmeme 127.0.0.1:...'
+>>> gossip.heard(message, verify=lambda hashed, body: True)
+True
+>>> gossip.wait_idle(); received
+True
+['kbztestmeme']
+>>> gossip.heard(message)  # seen already; not fetched again
+True
+>>> gossip.heard('kbz:has nothing to do with it')
+False
+>>> server.close()
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, re, random, threading, time  # pylint: disable=multiple-imports
+import ipaddress
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from kbcommon import KYBYZ_HOME, POSTS_QUEUE, SeenSet, logging
+from kbpeer import ADDRESS, MAXFRAME, fetch
+from kbsync import remember
+from kbutils import post_hash
+
+ANNOUNCEMENT = re.compile(
+    r'^kbz:have (kb[yz][1-9A-HJ-NP-Za-km-z]+) (\d+) (\w+) (\S+:\d+)$')
+FANOUT = int(os.getenv('KB_GOSSIP_FANOUT') or 2)  # re-announcers per post
+SUPPRESS = float(os.getenv('KB_GOSSIP_SUPPRESS') or 2)  # seconds
+SEEN = 4096  # post hashes remembered
+MAXSOURCES = 4  # addresses remembered per post being fetched
+FETCHERS = int(os.getenv('KB_GOSSIP_FETCHERS') or 4)  # threads fetching
+PENDING = 256  # posts being fetched, or waiting to be, at most
+# fetch from loopback and private addresses, e.g. for a local test network
+PRIVATE = bool(os.getenv('KB_GOSSIP_PRIVATE'))
+
+def announcement(hashed, size, post_type, address=ADDRESS):
+    '''
+    channel message telling others where to get post `hashed`, or None
+    if we aren't reachable for direct transfers
+    '''
+    if address is None:
+        return None
+    return 'kbz:have %s %d %s %s' % (hashed, size, post_type, address)
+
+def routable(address, private=PRIVATE):
+    '''
+    whether we may fetch from `address`: a .onion host or a public IP
+    address, or, if `private`, any host at all
+
+    >>> routable('abc.onion:1'), routable('8.8.8.8:1'), routable('[::1]:1')
+    (True, True, False)
+    >>> routable('10.0.0.1:1'), routable('example.com:1')
+    (False, False)
+    >>> routable('example.com:1', private=True)
+    True
+    '''
+    host = address.rsplit(':', 1)[0].strip('[]')
+    if private or host.endswith('.onion'):
+        return True
+    try:
+        return ipaddress.ip_address(host).is_global
+    except ValueError:  # a name, which could resolve to anything
+        return False
+
+def accept(hashed, body):
+    '''
+    check a fetched post is the one announced
+    '''
+    return post_hash(body) == hashed
+
+def store(hashed, body):  # pylint: disable=unused-argument
+    '''
+    queue a fetched post for caching, like one received over IRC
+    '''
+    POSTS_QUEUE.append(body.decode())
+
+class Gossip():
+    '''
+    what we know of announced posts, and the fetches in progress
+
+    `announce(message)` is set by the owner, e.g. IRCPool, to send a
+    message to the channel
+    '''
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self, directory=KYBYZ_HOME, address=ADDRESS, deliver=store,
+                 announce=None, fanout=FANOUT, private=PRIVATE):
+        self.directory = directory
+        self.address = address
+        self.deliver = deliver
+        self.announce = announce
+        self.fanout = fanout
+        self.private = private
+        self.fetchers = ThreadPoolExecutor(FETCHERS,
+                                           thread_name_prefix='kbgossip')
+        self.seen = SeenSet(SEEN)
+        self.sources = {}  # hash being fetched: addresses to try
+        self.announced = OrderedDict()  # hash: times heard announced
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.stats = {'heard': 0, 'fetched': 0, 'failed': 0, 'announced': 0,
+                      'refused': 0}
+
+    def have(self, hashed):
+        '''
+        True if we already store post `hashed`
+        '''
+        return os.path.lexists(os.path.join(self.directory, hashed))
+
+    def publish(self, hashed, size, post_type):
+        '''
+        return the announcement of one of our own posts, or None if we
+        cannot serve it directly
+
+        marks it seen, so re-announcements of it are ignored
+        '''
+        self.seen.add(hashed)
+        message = announcement(hashed, size, post_type, self.address)
+        if message is not None:
+            self.stats['announced'] += 1
+        return message
+
+    def heard(self, message, verify=accept):
+        '''
+        act on a channel message if it is an announcement
+
+        returns False for other messages
+        '''
+        announced = ANNOUNCEMENT.match(message)
+        if not announced:
+            return False
+        hashed, size, post_type, address = announced.groups()
+        with self.lock:
+            self.stats['heard'] += 1
+            if not routable(address, self.private):
+                self.stats['refused'] += 1
+                logging.warning('not fetching %s from %s', hashed, address)
+                return True
+            self.announced[hashed] = self.announced.get(hashed, 0) + 1
+            self.announced.move_to_end(hashed)
+            while len(self.announced) > SEEN:
+                self.announced.popitem(last=False)
+            if hashed in self.sources:
+                if len(self.sources[hashed]) < MAXSOURCES:
+                    self.sources[hashed].append(address)
+                return True
+            if len(self.sources) >= PENDING:
+                logging.warning('too many fetches pending, dropping %s',
+                                hashed)
+                return True
+            if not self.seen.add(hashed) or self.have(hashed):
+                return True
+            if int(size) > MAXFRAME:
+                logging.warning('ignoring %s, announced as %s bytes',
+                                hashed, size)
+                return True
+            self.sources[hashed] = [address]
+        self.fetchers.submit(self.pull, hashed, post_type, verify)
+        return True
+
+    def pull(self, hashed, post_type, verify):
+        '''
+        fetch a post from each of its sources in turn, till one has it
+        '''
+        body = None
+        while body is None:
+            with self.lock:
+                if not self.sources[hashed]:
+                    del self.sources[hashed]
+                    self.stats['failed'] += 1
+                    self.idle.notify_all()
+                    logging.warning('no source could send %s', hashed)
+                    return
+                address = self.sources[hashed].pop(0)
+            try:
+                body = fetch(address, [hashed])[hashed]
+            except (OSError, ValueError) as problem:
+                logging.warning('failed fetching %s from %s: %s',
+                                hashed, address, problem)
+                continue
+            if body is not None and not verify(hashed, body):
+                logging.warning('%s sent a post not matching %s',
+                                address, hashed)
+                body = None
+        remember(address)
+        self.deliver(hashed, body)
+        with self.lock:
+            del self.sources[hashed]
+            self.stats['fetched'] += 1
+            self.idle.notify_all()
+        message = announcement(hashed, len(body), post_type, self.address)
+        if message and self.announce and self.fanout:
+            threading.Timer(random.uniform(0, SUPPRESS), self.reannounce,
+                            args=(hashed, message)).start()
+
+    def reannounce(self, hashed, message):
+        '''
+        announce a fetched post, unless enough others have done so
+        '''
+        with self.lock:
+            # the original announcement counts as well
+            if self.announced.get(hashed, 0) > self.fanout:
+                return
+            self.stats['announced'] += 1
+        self.announce(message)
+
+    def wait_idle(self, timeout=30):
+        '''
+        wait until no fetch is in progress
+        '''
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.sources and time.monotonic() < deadline:
+                self.idle.wait(deadline - time.monotonic())
+            return not self.sources
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,662 @@
+#!/usr/bin/python3
+'''
+indexes over the post store, kept up to date as posts are cached
+
+each index appends what it learns of a post to its own journal in
+INDEXDIR, next to the post store, and replays the journal at startup;
+posts cached while kybyz wasn't running are picked up by `load`.
+
+so that startup needn't replay whole journals nor look at every post,
+`save` writes a snapshot of all the indexes, which `load` maps into
+memory, checks, and follows with only the journal entries written since;
+if the post store's directory is as it was, it isn't scanned at all. a
+stale or damaged snapshot is ignored, and the indexes rebuilt as before.
+`rebuild` starts them over from a given set of posts, as kbverify does.
+
+ThreadIndex follows `in-reply-to` links, so that a conversation can be
+rendered without looking at every post; FieldIndex finds posts by
+author, fingerprint or type, newest first, a page at a time; and
+SearchIndex is an inverted index of the words in posts' text.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, re, json, math, threading  # pylint: disable=multiple-imports
+import heapq, unicodedata, marshal, mmap  # pylint: disable=multiple-imports
+from hashlib import sha256
+from contextlib import ExitStack
+from bisect import bisect_left, insort
+from itertools import islice
+from collections import defaultdict, Counter
+from kbcommon import CACHE, KYBYZ_HOME, logging, read
+from kbpeer import POSTHASH
+
+INDEXDIR = os.path.join(CACHE, 'index')
+SNAPSHOT = os.path.join(INDEXDIR, 'snapshot')
+SNAPSHOT_INTERVAL = int(os.getenv('KB_SNAPSHOT_INTERVAL') or 600)  # seconds
+MAGIC = b'kybyz index snapshot\n'
+VERSION = 2  # of the snapshot's layout, or of what it holds
+SAVED = {}  # snapshot: journal offsets it was last saved or loaded at
+MAXSCAN = 2000  # most posts a search looks at
+
+class Journaled():
+    '''
+    an index held in memory, with a journal of what was added to it to
+    replay at startup
+
+    `offset` is how much of the journal is in memory, so a snapshot of
+    the index need only be followed by the rest of the journal
+    '''
+    def __init__(self, path):
+        '''
+        `path` is the journal; None keeps the index in memory only
+        '''
+        self.path = path
+        self.lock = threading.RLock()
+        self.timestamps = {}  # hash: timestamp, of posts indexed
+        self.offset = 0  # bytes of journal applied
+
+    def __contains__(self, hashed):
+        return hashed in self.timestamps
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def load(self, offset=0):
+        '''
+        replay the journal, from byte `offset` on
+        '''
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as journal:
+            journal.seek(offset)
+            for line in journal:
+                try:
+                    self.apply(*json.loads(line))
+                except (ValueError, TypeError, AttributeError):
+                    logging.warning('skipping bad %s record %r',
+                                    self.path, line)
+            self.offset = journal.tell()
+
+    def record(self, *entry):
+        '''
+        append an entry to the journal; caller must hold the lock
+        '''
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'ab') as journal:
+                journal.write(json.dumps(
+                    entry, separators=(',', ':')).encode() + b'\n')
+                self.offset = journal.tell()
+
+    def apply(self, hashed, *entry):
+        '''
+        add one post to the index in memory
+        '''
+        raise NotImplementedError
+
+    def state(self):
+        '''
+        contents of the index, as builtin types, for a snapshot
+        '''
+        return {'timestamps': self.timestamps}
+
+    def restore(self, state, offset):
+        '''
+        replace the contents of the index with a snapshot's
+        '''
+        self.timestamps = state['timestamps']
+        self.offset = offset
+
+class ThreadIndex(Journaled):
+    '''
+    reply graph: parent to children adjacency, with root and depth of
+    each post and the number of posts in each thread
+
+    only the first post listed in `in-reply-to` counts as the parent.
+    a reply to a post we don't have is rooted at that missing post,
+    until it arrives.
+
+    >>> index = ThreadIndex(None)
+    >>> index.add('kbzC', ['kbzB'], '2021-09-13T03')
+    True
+    >>> index.root('kbzC'), index.depth('kbzC')
+    ('kbzB', 1)
+    >>> index.add('kbzA', [], '2021-09-13T01')
+    True
+    >>> index.add('kbzB', ['kbzA'], '2021-09-13T02')
+    True
+    >>> index.add('kbzD', ['kbzA'], '2021-09-13T04')
+    True
+    >>> index.root('kbzC'), index.depth('kbzC'), index.size('kbzC')
+    ('kbzA', 2, 4)
+    >>> index.replies('kbzA')
+    2
+    >>> index.thread('kbzC')
+    [('kbzA', 0), ('kbzB', 1), ('kbzC', 2), ('kbzD', 1)]
+    >>> index.add('kbzA', [], '2021-09-13T01')
+    False
+    >>> late = ThreadIndex(None)  # a reply before the post it replies to
+    >>> late.add('kbzC', ['kbzB'], '2021-09-13T03')
+    True
+    >>> late.add('kbzB', [], '2021-09-13T02')
+    True
+    >>> late.size('kbzC'), late.size('kbzB'), late.thread('kbzC')
+    (2, 2, [('kbzB', 0), ('kbzC', 1)])
+    '''
+    def __init__(self, path=os.path.join(INDEXDIR, 'threads.log')):
+        super().__init__(path)
+        self.parents = {}  # hash: parent hash
+        self.children = defaultdict(list)  # hash: replies
+        self.roots = {}  # hash: root of its thread
+        self.depths = {}  # hash: replies between it and its root
+        self.sizes = Counter()  # root: posts in its thread
+
+    def state(self):
+        return dict(super().state(), parents=self.parents,
+                    children=dict(self.children), roots=self.roots,
+                    depths=self.depths, sizes=dict(self.sizes))
+
+    def restore(self, state, offset):
+        super().restore(state, offset)
+        self.parents = state['parents']
+        self.children = defaultdict(list, state['children'])
+        self.roots, self.depths = state['roots'], state['depths']
+        self.sizes = Counter(state['sizes'])
+
+    def ingest(self, hashed, fields):
+        '''
+        index a post, given its fields as a dict
+        '''
+        parents = fields.get('in-reply-to') or []
+        return self.add(hashed, [str(parent) for parent in parents],
+                        fields.get('timestamp', ''))
+
+    def add(self, hashed, parents, timestamp):
+        '''
+        index a post, and record it in the journal
+
+        returns False if it was indexed already
+        '''
+        with self.lock:
+            if hashed in self.timestamps:
+                return False
+            self.apply(hashed, parents, timestamp)
+            self.record(hashed, parents, timestamp)
+            return True
+
+    def apply(self, hashed, parents, timestamp):
+        '''
+        update the graph for one post
+        '''
+        with self.lock:
+            if hashed in self.timestamps:
+                return
+            self.timestamps[hashed] = timestamp
+            parent = parents[0] if parents else None
+            # a parent already rooted at this post would make a cycle
+            if parent is None or self.roots.get(parent) == hashed:
+                root, depth = hashed, 0
+            else:
+                self.parents[hashed] = parent
+                self.children[parent].append(hashed)
+                root = self.roots.get(parent, parent)
+                depth = self.depths.get(parent, 0) + 1
+            self.roots[hashed], self.depths[hashed] = root, depth
+            # replies that arrived first were counted under this post
+            pending = self.sizes.pop(hashed, 0)
+            self.sizes[root] += 1 + pending
+            stack = [hashed] if root != hashed else []
+            while stack:
+                node = stack.pop()
+                for child in self.children.get(node, ()):
+                    self.roots[child] = root
+                    self.depths[child] = self.depths[node] + 1
+                    stack.append(child)
+
+    def root(self, hashed):
+        '''
+        first post of the thread `hashed` is in
+        '''
+        return self.roots.get(hashed, hashed)
+
+    def depth(self, hashed):
+        '''
+        how many replies deep `hashed` is in its thread
+        '''
+        return self.depths.get(hashed, 0)
+
+    def replies(self, hashed):
+        '''
+        number of direct replies to `hashed`
+        '''
+        return len(self.children.get(hashed, ()))
+
+    def size(self, hashed):
+        '''
+        number of posts we have in the thread `hashed` is in
+        '''
+        return self.sizes[self.root(hashed)]
+
+    def thread(self, hashed):
+        '''
+        [(hash, depth), ...] of the whole thread `hashed` is in, in
+        reading order: depth first, replies oldest first
+
+        the root may be a post we don't have
+        '''
+        with self.lock:
+            root = self.root(hashed)
+            if root not in self.timestamps and root not in self.children:
+                return []
+            result, stack, seen = [], [(root, 0)], set()
+            while stack:
+                node, depth = stack.pop()
+                if node in seen:
+                    continue
+                seen.add(node)
+                result.append((node, depth))
+                replies = sorted(self.children.get(node, ()),
+                                 key=lambda child: self.timestamps[child],
+                                 reverse=True)
+                stack.extend((child, depth + 1) for child in replies)
+            return result
+
+class FieldIndex(Journaled):
+    '''
+    posts by value of each of FIELDS, each list kept sorted by timestamp
+
+    >>> index = FieldIndex(None)
+    >>> for n in range(5):
+    ...     index.add('kbz%d' % n, {'author': 'al' if n % 2 else 'bo',
+    ...                             'type': 'netmeme'}, '2021-09-1%d' % n)
+    True
+    True
+    True
+    True
+    True
+    >>> index.query('author', 'bo')
+    ['kbz4', 'kbz2', 'kbz0']
+    >>> index.query('type', 'netmeme', limit=2)
+    ['kbz4', 'kbz3']
+    >>> index.query('type', 'netmeme', before='2021-09-13', limit=2)
+    ['kbz2', 'kbz1']
+    >>> index.count('author', 'al'), index.timestamp('kbz1')
+    (2, '2021-09-11')
+    >>> index.recent(), index.recent('2021-09-12', limit=1)
+    (['kbz4', 'kbz3', 'kbz2', 'kbz1', 'kbz0'], ['kbz1'])
+    '''
+    FIELDS = ('author', 'fingerprint', 'type')
+
+    def __init__(self, path=os.path.join(INDEXDIR, 'fields.log')):
+        super().__init__(path)
+        self.posts = {field: defaultdict(list) for field in self.FIELDS}
+        self.everything = []  # (timestamp, hash) of all posts
+
+    def state(self):
+        return dict(super().state(), everything=self.everything,
+                    posts={field: dict(posts)
+                           for field, posts in self.posts.items()})
+
+    def restore(self, state, offset):
+        super().restore(state, offset)
+        self.everything = state['everything']
+        self.posts = {field: defaultdict(list, state['posts'].get(field, {}))
+                      for field in self.FIELDS}
+
+    def ingest(self, hashed, fields):
+        '''
+        index a post, given its fields as a dict
+        '''
+        return self.add(hashed, {field: str(fields[field])
+                                 for field in self.FIELDS if field in fields},
+                        fields.get('timestamp', ''))
+
+    def add(self, hashed, values, timestamp):
+        '''
+        index a post, and record it in the journal
+
+        returns False if it was indexed already
+        '''
+        with self.lock:
+            if hashed in self.timestamps:
+                return False
+            self.apply(hashed, values, timestamp)
+            self.record(hashed, values, timestamp)
+            return True
+
+    def apply(self, hashed, values, timestamp):
+        '''
+        file a post under each of its values
+        '''
+        with self.lock:
+            if hashed in self.timestamps:
+                return
+            self.timestamps[hashed] = timestamp
+            insort(self.everything, (timestamp, hashed))
+            for field, value in values.items():
+                if field in self.posts:
+                    insort(self.posts[field][value], (timestamp, hashed))
+
+    def query(self, field, value, before=None, limit=20):
+        '''
+        hashes of up to `limit` posts with `field` equal to `value`,
+        newest first, older than timestamp `before` if given
+
+        to page through, pass the timestamp of the last post shown as
+        `before`
+        '''
+        with self.lock:
+            posts = self.posts[field].get(value, [])
+            end = len(posts) if before is None else \
+                bisect_left(posts, (before,))
+            return [hashed for timestamp, hashed in
+                    reversed(posts[max(0, end - limit):end])]
+
+    def recent(self, before=None, limit=None):
+        '''
+        hashes of all posts, or `limit` of them, newest first, older than
+        timestamp `before` if given
+        '''
+        with self.lock:
+            end = len(self.everything) if before is None else \
+                bisect_left(self.everything, (before,))
+            start = 0 if limit is None else max(0, end - limit)
+            return [hashed for timestamp, hashed in
+                    reversed(self.everything[start:end])]
+
+    def count(self, field, value):
+        '''
+        number of posts with `field` equal to `value`
+        '''
+        return len(self.posts[field].get(value, ()))
+
+    def timestamp(self, hashed):
+        '''
+        timestamp of an indexed post
+        '''
+        return self.timestamps.get(hashed)
+
+class SearchIndex(Journaled):
+    '''
+    inverted index of words in the text fields of posts
+
+    words are lowercased and stripped of accents. queries match posts
+    containing every word, ranked by tf-idf and then by recency. only the
+    MAXSCAN posts most recently indexed under the query's rarest word are
+    considered, so that queries of common words stay fast.
+
+    >>> index = SearchIndex(None)
+    >>> index.add('kbz1', tokens('Cats and dogs'), '2021-09-11')
+    True
+    >>> index.add('kbz2', tokens('a cat, a CAT, a café!'), '2021-09-12')
+    True
+    >>> index.add('kbz3', tokens('no cats here... just Dogs'), '2021-09-13')
+    True
+    >>> index.search('cat')
+    ['kbz2']
+    >>> index.search('CAFE cat')
+    ['kbz2']
+    >>> index.search('dogs')
+    ['kbz3', 'kbz1']
+    >>> index.search('dogs', offset=1), index.search('the dogs')
+    (['kbz1'], ['kbz3', 'kbz1'])
+    >>> index.search(''), index.search('dogs wolves')
+    ([], [])
+    '''
+    FIELDS = ('toptext', 'bottomtext', 'text', 'identifier', 'source_uri')
+
+    def __init__(self, path=os.path.join(INDEXDIR, 'search.log')):
+        super().__init__(path)
+        self.postings = defaultdict(dict)  # word: {hash: occurrences}
+
+    def state(self):
+        return dict(super().state(), postings=dict(self.postings))
+
+    def restore(self, state, offset):
+        super().restore(state, offset)
+        self.postings = defaultdict(dict, state['postings'])
+
+    def ingest(self, hashed, fields):
+        '''
+        index a post, given its fields as a dict
+        '''
+        return self.add(hashed, tokens(' '.join(
+            str(fields[field]) for field in self.FIELDS if field in fields)),
+                        fields.get('timestamp', ''))
+
+    def add(self, hashed, words, timestamp):
+        '''
+        index a post's words, and record them in the journal
+
+        returns False if it was indexed already
+        '''
+        counts = dict(Counter(words))
+        with self.lock:
+            if hashed in self.timestamps:
+                return False
+            self.apply(hashed, counts, timestamp)
+            self.record(hashed, counts, timestamp)
+            return True
+
+    def apply(self, hashed, counts, timestamp):
+        '''
+        add a post to the posting list of each of its words
+        '''
+        with self.lock:
+            if hashed in self.timestamps:
+                return
+            self.timestamps[hashed] = timestamp
+            for word, count in counts.items():
+                self.postings[word][hashed] = count
+
+    def search(self, query, offset=0, limit=20):
+        '''
+        hashes of the best matches for `query`, `limit` at a time
+        '''
+        words = set(tokens(query))
+        with self.lock:
+            if not words or not all(word in self.postings for word in words):
+                return []
+            lists = sorted((self.postings[word] for word in words), key=len)
+            total = len(self.timestamps)
+            weights = [math.log(1 + total / len(postings))
+                       for postings in lists]
+            # newest first, so as not to rank every post in the store
+            # when all the words are common ones
+            candidates = islice(reversed(lists[0]), MAXSCAN)
+            matches = ((sum(weight * postings[hashed] for weight, postings
+                            in zip(weights, lists)),
+                        self.timestamps[hashed], hashed)
+                       for hashed in candidates
+                       if all(hashed in postings for postings in lists[1:]))
+            best = heapq.nlargest(offset + limit, matches)
+        return [hashed for score, timestamp, hashed in best[offset:]]
+
+STOPWORDS = frozenset('a an and are as at be by for from has he i in is it '
+                      'its of on or that the to was were will with'.split())
+WORD = re.compile(r'\w+')
+
+def tokens(text):
+    '''
+    words of `text` for indexing, normalized, less those too common
+    to be worth it
+
+    >>> tokens('The Café at the end of the Universe')
+    ['cafe', 'end', 'universe']
+    '''
+    folded = unicodedata.normalize('NFKD', text.casefold())
+    folded = ''.join(char for char in folded
+                     if not unicodedata.combining(char))
+    return [word for word in WORD.findall(folded) if word not in STOPWORDS]
+
+THREADS = ThreadIndex()
+FIELDS = FieldIndex()
+SEARCH = SearchIndex()
+INDEXES = [THREADS, FIELDS, SEARCH]
+
+def ingest(hashed, fields):
+    '''
+    add a newly cached post to every index
+    '''
+    for index in INDEXES:
+        index.ingest(hashed, fields)
+
+def rebuild(posts, indexes=None, snapshot=SNAPSHOT):
+    '''
+    replace the indexes, and their journals, with ones of only `posts`,
+    {hash: fields}; the snapshot, now stale, is removed
+
+    >>> import tempfile
+    >>> scratch = tempfile.mkdtemp()
+    >>> indexes = [FieldIndex(os.path.join(scratch, 'fields.log'))]
+    >>> indexes[0].add('kbz1', {'author': 'al'}, '2021-09-11')
+    True
+    >>> rebuild({'kbz2': {'author': 'bo', 'timestamp': '2021-09-12'}},
+    ...         indexes, os.path.join(scratch, 'snapshot'))
+    >>> later = FieldIndex(indexes[0].path)
+    >>> later.load()
+    >>> later.query('author', 'al'), later.query('author', 'bo')
+    ([], ['kbz2'])
+    '''
+    indexes = INDEXES if indexes is None else indexes
+    for index in indexes:
+        with index.lock:
+            path = index.path
+            if path is not None:
+                index.path = path + '.new'
+                if os.path.exists(index.path):
+                    os.remove(index.path)
+            index.restore(type(index)(None).state(), 0)
+            for hashed, fields in posts.items():
+                index.ingest(hashed, fields)
+            index.path = path
+            if path is not None and os.path.exists(path + '.new'):
+                os.replace(path + '.new', path)
+            elif path is not None and os.path.exists(path):
+                os.remove(path)
+        logging.info('rebuilt %s of %d posts', type(index).__name__,
+                     len(index))
+    SAVED.pop(snapshot, None)
+    if os.path.exists(snapshot):
+        os.remove(snapshot)
+
+def save(directory=KYBYZ_HOME, indexes=None, snapshot=SNAPSHOT):
+    '''
+    write a snapshot of the indexes, unless there is nothing new since
+    the last, to be loaded instead of replaying the journals
+
+    returns the size of the snapshot written
+    '''
+    indexes = INDEXES if indexes is None else indexes
+    offsets = [index.offset for index in indexes]
+    if SAVED.get(snapshot) == offsets and os.path.exists(snapshot):
+        return 0
+    try:
+        mtime = os.stat(directory).st_mtime_ns  # before the indexes are read
+    except OSError:
+        mtime = None
+    with ExitStack() as stack:
+        for index in indexes:
+            stack.enter_context(index.lock)
+        offsets = [index.offset for index in indexes]
+        data = marshal.dumps({
+            'version': VERSION,
+            'directory': (directory, mtime),
+            'indexes': [(index.offset, index.state()) for index in indexes]})
+    os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+    with open(snapshot + '.new', 'wb') as outfile:
+        outfile.write(MAGIC + sha256(data).digest() + data)
+    os.replace(snapshot + '.new', snapshot)
+    SAVED[snapshot] = offsets
+    logging.debug('saved %d byte index snapshot %s', len(data), snapshot)
+    return len(data)
+
+def restore(directory=KYBYZ_HOME, indexes=None, snapshot=SNAPSHOT):
+    '''
+    replace the contents of the indexes with the snapshot's, mapped
+    into memory rather than read
+
+    returns True if the post store is unchanged since the snapshot was
+    taken. raises OSError or ValueError if there is no snapshot fit to use
+    '''
+    indexes = INDEXES if indexes is None else indexes
+    header = len(MAGIC) + sha256().digest_size
+    with open(snapshot, 'rb') as infile, \
+            mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if mapped[:len(MAGIC)] != MAGIC:
+            raise ValueError('not an index snapshot')
+        with memoryview(mapped) as view, view[header:] as data:
+            if sha256(data).digest() != mapped[len(MAGIC):header]:
+                raise ValueError('checksum mismatch')
+            contents = marshal.loads(data)
+    if contents['version'] != VERSION or \
+            len(contents['indexes']) != len(indexes):
+        raise ValueError('snapshot is of other indexes')
+    for index, (offset, state) in zip(indexes, contents['indexes']):
+        if index.path is not None and (not os.path.exists(index.path) or
+                                       os.path.getsize(index.path) < offset):
+            raise ValueError('journal %s is older than snapshot' % index.path)
+    for index, (offset, state) in zip(indexes, contents['indexes']):
+        index.restore(state, offset)
+    SAVED[snapshot] = [offset for offset, state in contents['indexes']]
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        mtime = None
+    return tuple(contents['directory']) == (directory, mtime)
+
+def load(directory=KYBYZ_HOME, indexes=None, snapshot=SNAPSHOT):
+    '''
+    load the snapshot, and replay what the journals have had since, or
+    the whole journals if there is no good snapshot; then index any
+    posts cached since, unless the store hasn't changed
+
+    >>> import tempfile
+    >>> scratch = tempfile.mkdtemp()
+    >>> store = os.path.join(scratch, 'home')
+    >>> os.mkdir(store)
+    >>> indexes = [FieldIndex(os.path.join(scratch, 'fields.log'))]
+    >>> indexes[0].add('kbz1', {'author': 'al'}, '2021-09-11')
+    True
+    >>> snapshot = os.path.join(scratch, 'snapshot')
+    >>> save(store, indexes, snapshot) > 0
+    True
+    >>> indexes[0].add('kbz2', {'author': 'al'}, '2021-09-12')
+    True
+    >>> later = [FieldIndex(indexes[0].path)]
+    >>> restore(store, later, snapshot), later[0].query('author', 'al')
+    (True, ['kbz1'])
+    >>> load(store, later, snapshot)
+    >>> later[0].query('author', 'al')
+    ['kbz2', 'kbz1']
+    >>> with open(snapshot, 'r+b') as damaged:
+    ...     damaged.seek(-1, os.SEEK_END) and damaged.write(b'?')
+    1
+    >>> rebuilt = [FieldIndex(indexes[0].path)]
+    >>> load(store, rebuilt, snapshot)
+    >>> rebuilt[0].query('author', 'al'), len(rebuilt[0])
+    (['kbz2', 'kbz1'], 2)
+    '''
+    indexes = INDEXES if indexes is None else indexes
+    unchanged = False
+    try:
+        unchanged = restore(directory, indexes, snapshot)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, EOFError, TypeError, KeyError) as problem:
+        logging.warning('not using index snapshot %s: %s', snapshot, problem)
+    for index in indexes:
+        index.load(index.offset)
+    if unchanged or not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if POSTHASH.match(name) and os.path.islink(path) and \
+                not all(name in index for index in indexes):
+            try:
+                fields = json.loads(read(path))
+            except (OSError, ValueError) as problem:
+                logging.warning('cannot index %s: %s', name, problem)
+                continue
+            for index in indexes:
+                index.ingest(name, fields)
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+'''
+logging backend: records are queued by the thread that logs them, and
+formatted and written by one listener thread, a batch at a time
+
+the logging thread pays only for making the record and putting it on
+the queue; formatting, which for debug records of whole messages or
+request environments can be most of the cost, happens later in the
+listener, and only for records some handler wants. arguments are kept
+by reference, so an object changed right after being logged may show
+its later value.
+
+below WARNING, records from any one line of code are limited to BURST
+per INTERVAL seconds (KB_LOG_BURST=0 for no limit), so that a flood of
+IRC traffic can't swamp the log file and the page's message column; the
+count of those dropped is added to the next one let through.
+
+this module uses only the standard library, so that kbcommon, which
+configures logging, can import it.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, time, queue, atexit, threading  # pylint: disable=multiple-imports
+import logging, logging.handlers  # pylint: disable=multiple-imports
+from collections import OrderedDict
+
+BURST = int(os.getenv('KB_LOG_BURST') or 20)
+INTERVAL = float(os.getenv('KB_LOG_INTERVAL') or 1.0)
+BATCH = 256  # most records written per flush
+MAXBYTES = int(os.getenv('KB_LOG_MAXBYTES') or 16 * 1024 * 1024)
+BACKUPS = int(os.getenv('KB_LOG_BACKUPS') or 4)
+
+class RateLimit(logging.Filter):
+    '''
+    let through at most `burst` records from each line of code per
+    `interval` seconds, except warnings and worse, and messages meant for
+    the page, which are what the user is there to read
+
+    >>> limit = RateLimit(burst=2, interval=60)
+    >>> records = [logging.makeLogRecord({'msg': 'line %d', 'args': (n,),
+    ...     'levelno': logging.INFO, 'lineno': 7}) for n in range(4)]
+    >>> [limit.filter(record) for record in records]
+    [True, True, False, False]
+    >>> limit.lines[('', 7)][0] -= 60  # a minute later
+    >>> record = records[0]
+    >>> limit.filter(record), record.getMessage()
+    (True, 'line 0 (2 more suppressed)')
+    '''
+    def __init__(self, burst=BURST, interval=INTERVAL, maxlen=1024):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.maxlen = maxlen
+        self.lines = OrderedDict()  # (pathname, lineno): [start, count, lost]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or \
+                getattr(record, 'to_page', False):
+            return True
+        key = (record.pathname or '', record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            window = self.lines.get(key)
+            if window is None:
+                window = self.lines[key] = [now, 0, 0]
+                if len(self.lines) > self.maxlen:
+                    self.lines.popitem(last=False)
+            elif now - window[0] >= self.interval:
+                lost = window[2]
+                window[:] = [now, 0, 0]
+                if lost:
+                    record.msg = '%s (%d more suppressed)' % (
+                        record.getMessage(), lost)
+                    record.args = None
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+            return True
+
+class Formatter(logging.Formatter):
+    '''
+    formatter remembering the last timestamp it made, since a busy log
+    has many records a second
+
+    >>> record = logging.makeLogRecord({'created': 366 * 86400.0})
+    >>> Formatter(datefmt='%Y').formatTime(record)
+    '1971'
+    '''
+    last = (None, None)  # (second, date format), and timestamp made of it
+
+    def formatTime(self, record, datefmt=None):
+        datefmt = datefmt or self.datefmt
+        key = (int(record.created), datefmt)
+        if key != self.last[0]:
+            self.last = (key, time.strftime(
+                datefmt or self.default_time_format,
+                self.converter(record.created)))
+        if datefmt:
+            return self.last[1]
+        return self.default_msec_format % (self.last[1], record.msecs)
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    '''
+    log file written a batch of records at a time, rolled over when it
+    would grow past `maxBytes`
+
+    records are held until `flush()`, which the listener calls after
+    each batch
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'kybyz.log')
+    >>> handler = BufferedRotatingFileHandler(path, maxBytes=16)
+    >>> for text in ('first batch', 'second batch', 'third'):
+    ...     handler.emit(logging.makeLogRecord({'msg': text}))
+    ...     handler.flush()
+    >>> handler.close()
+    >>> [open(name).read() for name in (path + '.2', path + '.1', path)]
+    ['first batch\\n', 'second batch\\n', 'third\\n']
+    '''
+    def __init__(self, filename, maxBytes=MAXBYTES, backupCount=BACKUPS):
+        # pylint: disable=invalid-name
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount,
+                         delay=True)  # opened by the listener, when needed
+        self.pending = []
+
+    def emit(self, record):
+        try:
+            self.pending.append(self.format(record) + self.terminator)
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+    def flush(self):
+        if not self.pending:
+            return
+        text, self.pending = ''.join(self.pending), []
+        with self.lock:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes and self.stream.tell() + len(text) > \
+                    self.maxBytes and self.stream.tell():
+                self.doRollover()
+                if self.stream is None:  # not reopened, as we delay
+                    self.stream = self._open()
+            self.stream.write(text)
+            self.stream.flush()
+
+class Listener():
+    '''
+    thread taking records off `records` and passing them to `handlers`,
+    flushing the handlers after each batch
+
+    a handler that fails reports it with its `handleError`, and the
+    others, and later records, are still written
+
+    >>> class Handler(logging.Handler):
+    ...     def emit(self, record):
+    ...         if record.msg == 'bad':
+    ...             raise OSError('disk full')
+    ...         print('wrote', record.msg)
+    ...     def handleError(self, record):
+    ...         print('failed', record.msg)
+    >>> records = queue.SimpleQueue()
+    >>> listener = Listener(records, Handler())
+    >>> for text in ('bad', 'good', None):
+    ...     records.put(text and logging.makeLogRecord(
+    ...         {'msg': text, 'levelno': logging.INFO}))
+    >>> listener.thread.join()
+    failed bad
+    wrote good
+    '''
+    def __init__(self, records, *handlers):
+        self.records = records
+        self.handlers = handlers
+        self.thread = threading.Thread(target=self.monitor, name='kblog',
+                                       daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def monitor(self):
+        '''
+        write records until the sentinel None arrives
+        '''
+        running = True
+        while running:
+            batch = [self.records.get()]
+            try:
+                while len(batch) < BATCH:
+                    batch.append(self.records.get_nowait())
+            except queue.Empty:
+                pass
+            for record in batch:
+                if record is None:
+                    running = False
+                    continue
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        try:
+                            handler.handle(record)
+                        except Exception:  # pylint: disable=broad-except
+                            handler.handleError(record)
+            for handler in self.handlers:
+                try:
+                    handler.flush()
+                except Exception:  # pylint: disable=broad-except
+                    handler.handleError(logging.makeLogRecord(
+                        {'msg': 'cannot flush %r', 'args': (handler,)}))
+
+    def stop(self):
+        '''
+        write what is queued and end the thread
+        '''
+        if self.thread.is_alive():
+            self.records.put(None)
+            self.thread.join()
+
+class QueueHandler(logging.handlers.QueueHandler):
+    '''
+    queue records as they are, leaving their formatting to the listener
+    '''
+    def prepare(self, record):
+        return record
+
+def pipeline(handlers, limit=BURST > 0):
+    '''
+    handler to give the root logger, and the listener writing
+    to `handlers` behind it
+    '''
+    records = queue.SimpleQueue()
+    handler = QueueHandler(records)
+    if limit:
+        handler.addFilter(RateLimit())
+    return handler, Listener(records, *handlers)
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+'''
+history of the messages shown in the page's message column: those
+received over IRC, and kybyz's own notices
+
+each message is given the next sequence number and appended to a log
+on disk, so the history survives a restart; the newest RING are also
+kept in memory. a page asks only for the messages after the last
+sequence number it has shown, and a conversation, such as the private
+messages from one sender, can be paged through newest first by its own
+index of sequence numbers, read from the log by their offsets.
+
+only the newest KEEP messages are kept for good: once the log holds
+twice that many, it is rewritten with just the newest KEEP, headed by
+the sequence number of the first of them, so numbers carry on as they
+were. so the log, its offsets and the conversation indexes in memory,
+and what is read at startup, never grow past 2 * KEEP messages.
+
+this module uses only the standard library, so that kbcommon can
+import it.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, json, shutil, logging, threading  # pylint: disable=multiple-imports
+from array import array
+from bisect import bisect_left
+from collections import deque
+from itertools import islice
+
+RING = int(os.getenv('KB_MESSAGE_RING') or 1024)  # newest kept in memory
+KEEP = int(os.getenv('KB_MESSAGE_KEEP') or 65536)  # newest kept on disk
+
+class MessageStore():
+    '''
+    message log, with the newest messages in memory
+
+    messages are (sequence, conversation, text); `conversation` is who a
+    private message is from or to, the channel for one sent there, or ''
+    for kybyz's own notices.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'messages.log')
+    >>> store = MessageStore(path, ring=2)
+    >>> [store.append(text, 'bob' if text[0] == 'b' else '')
+    ...  for text in ('a', 'b1', 'c', 'b2')]
+    [1, 2, 3, 4]
+    >>> store.since(2)
+    [(3, '', 'c'), (4, 'bob', 'b2')]
+    >>> store.since(0)  # older than the ring, so read from the log
+    [(1, '', 'a'), (2, 'bob', 'b1'), (3, '', 'c'), (4, 'bob', 'b2')]
+    >>> store.conversation('bob', count=1)
+    [(4, 'bob', 'b2')]
+    >>> store.conversation('bob', before=4)
+    [(2, 'bob', 'b1')]
+    >>> restarted = MessageStore(path, ring=2)
+    >>> restarted.latest, restarted.recent(5)
+    (4, [(4, 'bob', 'b2'), (3, '', 'c')])
+
+    once the log holds 2 * `keep` messages, the oldest are forgotten
+
+    >>> small = MessageStore(path + '.small', ring=1, keep=2)
+    >>> [small.append(text, 'bob') for text in 'abcde']
+    [1, 2, 3, 4, 5]
+    >>> small.since(0) == small.conversation('bob')[::-1]
+    True
+    >>> small.since(0)
+    [(3, 'bob', 'c'), (4, 'bob', 'd'), (5, 'bob', 'e')]
+    >>> restarted = MessageStore(path + '.small', keep=2)
+    >>> restarted.since(0) == small.since(0), len(restarted.offsets)
+    (True, 3)
+    '''
+    def __init__(self, path, ring=RING, keep=KEEP):
+        '''
+        `path` is the log; None keeps only the ring, in memory
+        '''
+        self.path = path
+        self.ring = deque(maxlen=ring)
+        self.keep = keep
+        self.first = 1  # sequence number of the oldest message kept
+        self.offsets = array('Q')  # in the log, of message n at [n - first]
+        self.conversations = {}  # conversation: array of sequence numbers
+        self.lock = threading.Lock()
+        self.log = None  # opened for appending on the first message
+        self.loaded = False
+
+    @property
+    def latest(self):
+        '''
+        sequence number of the newest message, 0 if none
+        '''
+        self.load()
+        return self.ring[-1][0] if self.ring else 0
+
+    def load(self):
+        '''
+        read the log, once, dropping any last line left half written
+        '''
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            if self.path is not None and os.path.exists(self.path):
+                with open(self.path, 'r+b') as log:
+                    end = 0
+                    for line in log:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            break
+                        if not line.endswith(b'\n'):
+                            break
+                        if isinstance(entry, dict):  # left by compact()
+                            self.first = entry['first']
+                        else:
+                            self.add(end, *entry)
+                        end += len(line)
+                    if log.tell() > end:
+                        logging.warning('truncating %s at %d', self.path, end)
+                        log.truncate(end)
+            self.loaded = True
+
+    def add(self, offset, conversation, text):
+        '''
+        index a message logged at `offset`, returning its sequence
+        number; caller must hold the lock
+        '''
+        self.offsets.append(offset)
+        sequence = self.first + len(self.offsets) - 1
+        self.ring.append((sequence, conversation, text))
+        if conversation:
+            self.conversations.setdefault(
+                conversation, array('L')).append(sequence)
+        return sequence
+
+    def append(self, text, conversation=''):
+        '''
+        log a message, returning its sequence number
+        '''
+        self.load()
+        with self.lock:
+            offset = 0
+            if self.path is not None:
+                if self.log is None:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    # pylint: disable=consider-using-with
+                    self.log = open(self.path, 'ab')
+                offset = self.log.tell()
+                line = json.dumps([conversation, text], separators=(',', ':'))
+                self.log.write(line.encode() + b'\n')
+                self.log.flush()
+            sequence = self.add(offset, conversation, text)
+            if len(self.offsets) >= 2 * self.keep:
+                self.compact()
+            return sequence
+
+    def compact(self):
+        '''
+        forget all but the newest `keep` messages, rewriting the log if
+        there is one; caller must hold the lock
+        '''
+        dropped = len(self.offsets) - self.keep
+        self.first += dropped
+        if self.path is not None:
+            start = self.offsets[dropped]
+            header = json.dumps({'first': self.first}).encode() + b'\n'
+            self.log.close()
+            with open(self.path, 'rb') as log, \
+                    open(self.path + '.new', 'wb') as compacted:
+                compacted.write(header)
+                log.seek(start)
+                shutil.copyfileobj(log, compacted)
+            os.replace(self.path + '.new', self.path)
+            # pylint: disable=consider-using-with
+            self.log = open(self.path, 'ab')
+            self.offsets = array('Q', [offset - start + len(header)
+                                       for offset in self.offsets[dropped:]])
+        else:
+            self.offsets = self.offsets[dropped:]
+        for name, sequences in list(self.conversations.items()):
+            kept = sequences[bisect_left(sequences, self.first):]
+            if kept:
+                self.conversations[name] = kept
+            else:
+                del self.conversations[name]
+
+    def read(self, sequences):
+        '''
+        the messages numbered `sequences`, from the ring or the log
+        '''
+        with self.lock:
+            first = self.ring[0][0] if self.ring else 1
+            cached = {sequence: self.ring[sequence - first]
+                      for sequence in sequences if sequence >= first}
+            wanted = [(sequence, self.offsets[sequence - self.first])
+                      for sequence in sequences
+                      if self.first <= sequence < first]
+        if wanted and self.path is not None:
+            with open(self.path, 'rb') as log:
+                for sequence, offset in wanted:
+                    log.seek(offset)
+                    cached[sequence] = (sequence, *json.loads(log.readline()))
+        return [cached[sequence] for sequence in sequences
+                if sequence in cached]
+
+    def since(self, sequence, limit=RING):
+        '''
+        messages after `sequence`, oldest first, at most the newest `limit`
+        '''
+        latest = self.latest
+        return self.read(range(max(sequence, latest - limit) + 1, latest + 1))
+
+    def recent(self, count):
+        '''
+        the newest `count` messages, newest first
+        '''
+        self.load()
+        with self.lock:
+            return list(islice(reversed(self.ring), count))
+
+    def conversation(self, name, before=None, count=20):
+        '''
+        a page of `count` messages of a conversation, newest first,
+        those numbered before `before` if given
+        '''
+        self.load()
+        with self.lock:
+            sequences = self.conversations.get(name, [])
+            end = len(sequences) if before is None else \
+                bisect_left(sequences, before)
+            wanted = list(sequences[max(0, end - count):end])
+        return self.read(wanted[::-1])
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
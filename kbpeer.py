@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+'''
+direct peer to peer transfer of posts, by hash, on port KB_COMMS
+
+IRC is only used to announce that we have a post (see kbgossip);
+whoever wants it connects here (directly, or through Tor for .onion
+addresses) and asks for it by hash. requests are pipelined: a client
+sends all its requests without waiting, and replies come back in the
+same order.
+
+every frame is a one-byte type, a four-byte big-endian payload length,
+and the payload:
+
+    G hash      request the post stored under `hash`
+    D body      reply: the post's JSON
+    N hash      reply: no such post here
+
+other modules may add request types to a server's `handlers`, as kbsync
+does for set reconciliation.
+
+the server listens only on the host of KB_PEER_ADDRESS, if that is an IP
+address, or else on 127.0.0.1, where Tor hands over connections to an
+onion service. KB_PEER_LISTEN names another interface to listen on, or
+0.0.0.0 (or ::) for all of them.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, re, socket, struct, threading  # pylint: disable=multiple-imports
+import ipaddress
+from kbcommon import KYBYZ_HOME, logging
+
+PORT = int(os.getenv('KB_COMMS') or 26352)  # see linux.mk
+# host:port others can reach us at, e.g. our .onion address; unset means
+# we don't serve, and publish the old way, whole posts over IRC
+ADDRESS = os.getenv('KB_PEER_ADDRESS')
+LISTEN = os.getenv('KB_PEER_LISTEN')  # interface to serve on, if not ours
+SOCKS_PROXY = os.getenv('KB_SOCKS_PROXY', '127.0.0.1:9050')  # Tor's
+HEADER = struct.Struct('>cI')
+MAXFRAME = 16 * 1024 * 1024
+TIMEOUT = 60  # seconds
+# kbhash's prefix comes out as 'kby' for about a third of digests
+POSTHASH = re.compile(r'^kb[yz][1-9A-HJ-NP-Za-km-z]+$')
+
+def interface(address=ADDRESS, listen=LISTEN):
+    '''
+    host to listen on, for others to reach us at `address`
+
+    >>> interface('192.0.2.7:26352', None), interface('abc.onion:1', None)
+    ('192.0.2.7', '127.0.0.1')
+    >>> interface(None, None), interface('abc.onion:1', '0.0.0.0')
+    ('127.0.0.1', '0.0.0.0')
+    '''
+    if listen is not None:
+        return listen
+    host = (address or '').rsplit(':', 1)[0].strip('[]')
+    try:
+        return str(ipaddress.ip_address(host))
+    except ValueError:  # an onion or other name, or no address at all
+        return '127.0.0.1'
+
+def send_frame(connection, kind, payload):
+    '''
+    send one frame
+    '''
+    connection.sendall(HEADER.pack(kind, len(payload)) + payload)
+
+def recv_exactly(reader, count):
+    '''
+    read exactly `count` bytes from file-like `reader`
+    '''
+    data = reader.read(count)
+    if len(data) != count:
+        raise ConnectionError('peer closed connection mid-frame')
+    return data
+
+def recv_frame(reader):
+    '''
+    read one frame, returning (kind, payload), or (None, None) at EOF
+    '''
+    header = reader.read(HEADER.size)
+    if not header:
+        return None, None
+    if len(header) != HEADER.size:
+        raise ConnectionError('peer closed connection mid-frame')
+    kind, length = HEADER.unpack(header)
+    if length > MAXFRAME:
+        raise ValueError('frame of %d bytes too large' % length)
+    return kind, recv_exactly(reader, length)
+
+def lookup(directory, hashed):
+    '''
+    return contents of post `hashed` in `directory`, or None
+
+    >>> lookup('example.kybyz', 'kbztestmeme')[:9]
+    b'{"type":"'
+    >>> lookup('example.kybyz', '../kybyz.py') is None
+    True
+    '''
+    if not POSTHASH.match(hashed):
+        return None
+    path = os.path.join(directory, hashed)
+    try:
+        with open(path, 'rb') as infile:
+            return infile.read()
+    except OSError:
+        return None
+
+class PeerServer():
+    '''
+    serve posts by hash to other nodes, one thread per connection
+
+    >>> server = PeerServer('example.kybyz', port=0)
+    >>> fetched = fetch('127.0.0.1:%d' % server.port,
+    ...                 ['kbztestmeme', 'kbzmissing'])
+    >>> fetched  # doctest: +ELLIPSIS
+    {'kbztestmeme': b'{"type":"netmeme",...', 'kbzmissing': None}
+    >>> server.close()
+    '''
+    def __init__(self, directory=KYBYZ_HOME, host=None, port=PORT):
+        self.directory = directory
+        self.handlers = {b'G': self.get}  # kind: f(payload) -> (kind, payload)
+        host = interface() if host is None else host
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        self.listener = socket.create_server((host, port), family=family)
+        self.port = self.listener.getsockname()[1]
+        self.running = True
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        threading.Thread(target=self.accept, name='kbpeer',
+                         daemon=True).start()
+
+    def accept(self):
+        '''
+        hand each incoming connection to its own thread
+        '''
+        while self.running:
+            try:
+                connection, address = self.listener.accept()
+            except OSError:
+                break
+            logging.debug('peer connection from %s', address)
+            threading.Thread(target=self.handle, args=(connection,),
+                             name='kbpeer_client', daemon=True).start()
+
+    def handle(self, connection):
+        '''
+        answer requests until the peer hangs up
+        '''
+        connection.settimeout(TIMEOUT)
+        with connection, connection.makefile('rb') as reader:
+            try:
+                while True:
+                    kind, payload = recv_frame(reader)
+                    if kind is None:
+                        break
+                    if kind not in self.handlers:
+                        logging.warning('unknown peer request %r', kind)
+                        break
+                    kind, payload = self.handlers[kind](payload)
+                    send_frame(connection, kind, payload)
+                    with self.lock:
+                        self.bytes_sent += HEADER.size + len(payload)
+            except (OSError, ValueError, UnicodeDecodeError) as problem:
+                logging.warning('dropping peer connection: %s', problem)
+
+    def get(self, payload):
+        '''
+        reply to a request for a post
+        '''
+        body = lookup(self.directory, payload.decode())
+        return (b'N', payload) if body is None else (b'D', body)
+
+    def close(self):
+        '''
+        stop accepting connections
+        '''
+        self.running = False
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)  # wakes up accept()
+        except OSError:
+            pass
+        self.listener.close()
+
+def connect(address):
+    '''
+    connect to host:port, through Tor's SOCKS5 proxy for .onion hosts
+    '''
+    host, port = address.rsplit(':', 1)
+    if not host.endswith('.onion'):
+        return socket.create_connection((host, int(port)), TIMEOUT)
+    proxy_host, proxy_port = SOCKS_PROXY.rsplit(':', 1)
+    connection = socket.create_connection((proxy_host, int(proxy_port)),
+                                          TIMEOUT)
+    reader = connection.makefile('rb')
+    connection.sendall(b'\x05\x01\x00')  # version 5, no authentication
+    if recv_exactly(reader, 2) != b'\x05\x00':
+        raise ConnectionError('SOCKS proxy refused us')
+    connection.sendall(b'\x05\x01\x00\x03' + bytes([len(host)]) +
+                       host.encode() + struct.pack('>H', int(port)))
+    reply = recv_exactly(reader, 4)
+    if reply[1] != 0:
+        raise ConnectionError('SOCKS proxy failed with code %d' % reply[1])
+    recv_exactly(reader, 6 if reply[3] == 1 else 18 if reply[3] == 4
+                 else recv_exactly(reader, 1)[0] + 2)  # bound address
+    return connection
+
+def fetch(address, hashes):
+    '''
+    fetch posts by hash from the peer at `address`
+
+    returns dict of hash: body, or None for those the peer doesn't have
+    '''
+    hashes = list(hashes)
+    connection = connect(address)
+    fetched = {}
+    with connection, connection.makefile('rb') as reader:
+        # write all requests from another thread, so neither side can
+        # block with a full send buffer while the other waits to write
+        requests = threading.Thread(
+            target=lambda: [send_frame(connection, b'G', hashed.encode())
+                            for hashed in hashes],
+            name='kbpeer_requests', daemon=True)
+        requests.start()
+        for hashed in hashes:
+            kind, payload = recv_frame(reader)
+            if kind is None:
+                raise ConnectionError('peer hung up with requests pending')
+            fetched[hashed] = payload if kind == b'D' else None
+        requests.join()
+    return fetched
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+'''
+sampling profiler and timing spans, for finding out where a running
+kybyz spends its time
+
+the profiler samples the stacks of all threads every INTERVAL seconds,
+and on stopping writes them to LOGDIR in the "collapsed" format read by
+flamegraph.pl and speedscope, one line per distinct stack:
+
+    threadname;module:function;module:function samples
+
+functions wrapped by `traced(name)` add the time of each call under
+`name` while tracing is on; on stopping, a summary is written to LOGDIR.
+while it is off, a wrapped call costs one attribute lookup more.
+
+both are started and stopped at the kbz> prompt: `profile start`,
+`profile stop`, `trace start`, `trace stop`.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, sys, time, threading  # pylint: disable=multiple-imports
+from collections import Counter
+from functools import wraps
+from kbcommon import logging, LOGDIR
+
+INTERVAL = float(os.getenv('KB_PROFILE_INTERVAL') or .01)  # seconds
+
+def collapse(name, frame):
+    '''
+    a thread's stack as one line of collapsed stacks, outermost first
+
+    >>> def inner():
+    ...     return collapse('main', sys._getframe())
+    >>> inner().startswith('main;'), inner().endswith(':inner')
+    (True, True)
+    '''
+    calls = []
+    while frame is not None:
+        code = frame.f_code
+        calls.append('%s:%s' % (frame.f_globals.get('__name__', '?'),
+                                code.co_name))
+        frame = frame.f_back
+    return ';'.join([name.replace(' ', '_')] + calls[::-1])
+
+def logpath(prefix, suffix):
+    '''
+    where to write a profile or summary made now
+    '''
+    return os.path.join(LOGDIR, '%s-%s%s' % (
+        prefix, time.strftime('%Y%m%d-%H%M%S'), suffix))
+
+class Sampler():
+    '''
+    samples the stacks of all other threads until stopped
+
+    >>> sampler = Sampler(interval=.001)
+    >>> sampler.start()
+    True
+    >>> time.sleep(.1)
+    >>> stacks = sampler.stop()
+    >>> sampler.samples > 0, any(';' in stack for stack in stacks)
+    (True, True)
+    '''
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        '''
+        start sampling, unless already sampling
+        '''
+        if self.thread is not None:
+            return False
+        self.stacks.clear()
+        self.samples = 0
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='profiler',
+                                       daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self):
+        '''
+        take a sample every `interval` seconds
+        '''
+        myself = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name
+                     for thread in threading.enumerate()}
+            # pylint: disable=protected-access
+            for ident, frame in sys._current_frames().items():
+                if ident != myself:
+                    self.stacks[collapse(
+                        names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+
+    def stop(self):
+        '''
+        stop sampling, returning the stacks sampled
+        '''
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        return self.stacks
+
+class Spans():
+    '''
+    calls, total and worst time of traced functions, by name
+
+    >>> spans = Spans()
+    >>> spans.add('create', .002); spans.add('create', .004)
+    >>> print(spans.summary())
+    span          calls   seconds   mean ms    max ms
+    create            2     0.006     3.000     4.000
+    '''
+    def __init__(self):
+        self.active = False
+        self.totals = {}  # name: [calls, seconds, worst]
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        '''
+        count one call of `seconds`
+        '''
+        with self.lock:
+            totals = self.totals.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+
+    def summary(self):
+        '''
+        a table of the spans, those taking the most time first
+        '''
+        with self.lock:
+            totals = sorted(self.totals.items(), key=lambda item: -item[1][1])
+        return '\n'.join(['%-10s %8s %9s %9s %9s' % (
+            'span', 'calls', 'seconds', 'mean ms', 'max ms')] + [
+                '%-10s %8d %9.3f %9.3f %9.3f' % (
+                    name, calls, seconds, seconds / calls * 1000,
+                    worst * 1000)
+                for name, (calls, seconds, worst) in totals])
+
+PROFILER = Sampler()
+SPANS = Spans()
+
+def traced(name):
+    '''
+    decorator adding the time of each call to span `name` while tracing
+
+    for a function returning a generator, as serve() may, only the time
+    to return it is counted
+    '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not SPANS.active:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                SPANS.add(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def profile(action='start'):
+    '''
+    start the sampling profiler, or stop it and write what it found
+    '''
+    if action == 'start':
+        return 'started' if PROFILER.start() else 'already running'
+    if action != 'stop':
+        raise ValueError('profile start or profile stop')
+    stacks = PROFILER.stop()
+    path = logpath('profile', '.folded')
+    with open(path, 'w', encoding='utf-8') as outfile:
+        for stack, count in sorted(stacks.items()):
+            outfile.write('%s %d\n' % (stack, count))
+    logging.info('%d samples of %d stacks written to %s',
+                 PROFILER.samples, len(stacks), path)
+    return path
+
+def trace(action='start'):
+    '''
+    start timing the traced functions, or stop and write a summary
+    '''
+    if action == 'start':
+        with SPANS.lock:
+            SPANS.totals.clear()
+        SPANS.active = True
+        return 'tracing'
+    if action != 'stop':
+        raise ValueError('trace start or trace stop')
+    SPANS.active = False
+    path = logpath('spans', '.txt')
+    with open(path, 'w', encoding='utf-8') as outfile:
+        outfile.write(SPANS.summary() + '\n')
+    logging.info('span summary written to %s', path)
+    return path
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
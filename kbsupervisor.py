@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+'''
+supervisor for kybyz's helper processes (nginx, tor) and periodic tasks
+
+one thread does it all, sleeping until the next thing is due: a timer,
+or a helper exiting, which a thread blocked in its `wait()` reports.
+nothing wakes up just to find that nothing has happened.
+
+a helper that exits is restarted after BACKOFF seconds, doubling each
+time it fails again, up to MAXBACKOFF; one that has run for STABLE
+seconds starts over at BACKOFF. a helper whose health check fails
+FAILURES times in a row is terminated, and so restarted.
+
+on SIGTERM, or at exit, helpers are sent SIGTERM, and killed if they
+haven't gone after GRACE seconds.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, time, heapq, queue, socket  # pylint: disable=multiple-imports
+import atexit, signal, threading  # pylint: disable=multiple-imports
+import subprocess
+from itertools import count
+from kbcommon import logging
+
+BACKOFF = float(os.getenv('KB_RESTART_BACKOFF') or 1)  # seconds
+MAXBACKOFF = float(os.getenv('KB_RESTART_MAXBACKOFF') or 300)
+STABLE = 60  # seconds a helper must run for its backoff to be reset
+CHECK_INTERVAL = float(os.getenv('KB_HEALTH_INTERVAL') or 30)  # seconds
+FAILURES = 3  # failed health checks in a row before a restart
+GRACE = 5  # seconds helpers are given to exit
+
+class Helper():  # pylint: disable=too-few-public-methods
+    '''
+    a helper process, and its restart history
+    '''
+    def __init__(self, name, command, check=None, requires=None):
+        self.name = name
+        self.command = command
+        self.check = check  # returns False if the helper is unwell
+        self.requires = requires  # helper that must be running first
+        self.process = None
+        self.started = None
+        self.backoff = BACKOFF
+        self.restarts = 0
+        self.failures = 0
+
+class Supervisor():
+    '''
+    one thread running timers and restarting helpers
+
+    >>> supervisor = Supervisor()
+    >>> supervisor.start(signals=False)
+    >>> done, ticks = threading.Event(), []
+    >>> def tick():
+    ...     ticks.append(len(ticks))
+    ...     if len(ticks) == 3:
+    ...         done.set()
+    >>> supervisor.every(.01, tick, now=True)
+    >>> done.wait(5), ticks[:3]
+    (True, [0, 1, 2])
+    >>> supervisor.stop()
+    >>> supervisor.thread.join(5)
+    >>> supervisor.thread.is_alive()
+    False
+    '''
+    def __init__(self):
+        self.events = queue.Queue()  # actions for the supervisor thread
+        self.timers = []  # heap of (due, sequence, action)
+        self.sequence = count()  # breaks ties between timers
+        self.lock = threading.Lock()
+        self.helpers = {}
+        self.started = time.monotonic()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self, signals=True):
+        '''
+        start the supervisor thread, and stop helpers on SIGTERM
+        '''
+        self.thread = threading.Thread(target=self.run, name='supervisor',
+                                       daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        if signals and threading.current_thread() is threading.main_thread():
+            previous = signal.getsignal(signal.SIGTERM)
+            def terminate(signum, frame):
+                self.stop()
+                if callable(previous):
+                    previous(signum, frame)
+                else:
+                    signal.signal(signum, signal.SIG_DFL)
+                    os.kill(os.getpid(), signum)
+            signal.signal(signal.SIGTERM, terminate)
+
+    def uptime(self):
+        '''
+        seconds since the supervisor was made
+        '''
+        return time.monotonic() - self.started
+
+    def call(self, action):
+        '''
+        run `action()` in the supervisor thread
+        '''
+        self.events.put(action)
+
+    def after(self, delay, action):
+        '''
+        run `action()` in the supervisor thread in `delay` seconds
+        '''
+        with self.lock:
+            heapq.heappush(self.timers, (
+                time.monotonic() + delay, next(self.sequence), action))
+        self.events.put(None)  # so the wait is recalculated
+
+    def every(self, interval, action, now=False):
+        '''
+        run `action()` every `interval` seconds, first right away if `now`
+        '''
+        def repeat():
+            try:
+                action()
+            finally:
+                self.after(interval, repeat)
+        if now:
+            self.call(repeat)
+        else:
+            self.after(interval, repeat)
+
+    def run(self):
+        '''
+        wait for the next event or timer, and run it, until stopped
+        '''
+        while not self.stopping.is_set():
+            with self.lock:
+                timeout = max(0, self.timers[0][0] - time.monotonic()) \
+                    if self.timers else None
+            try:
+                actions = [self.events.get(timeout=timeout)]
+            except queue.Empty:
+                actions = []
+            with self.lock:
+                now = time.monotonic()
+                while self.timers and self.timers[0][0] <= now:
+                    actions.append(heapq.heappop(self.timers)[2])
+            for action in filter(None, actions):
+                if self.stopping.is_set():
+                    break
+                try:
+                    action()
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception('supervisor task %s failed', action)
+
+    def add(self, name, command, check=None, requires=None):
+        '''
+        start helper process `name` running `command`, and keep it running
+        '''
+        self.helpers[name] = Helper(name, command, check, requires)
+        self.call(lambda: self.launch(self.helpers[name]))
+
+    def running(self, name):
+        '''
+        process of helper `name`, if it is running
+        '''
+        helper = self.helpers.get(name)
+        return helper and helper.process
+
+    def launch(self, helper):
+        '''
+        start a helper process, and a thread to wait for it to exit
+        '''
+        if self.stopping.is_set():
+            return
+        if helper.requires and not helper.restarts and \
+                not self.running(helper.requires):
+            logging.error('not starting %s without %s',
+                          helper.name, helper.requires)
+            return
+        try:
+            # pylint: disable=consider-using-with
+            process = subprocess.Popen(helper.command)
+        except OSError as failed:  # not installed, so no use retrying
+            logging.error('error starting %s: %s', helper.name, failed)
+            return
+        helper.process, helper.started = process, time.monotonic()
+        helper.failures = 0
+        threading.Thread(target=self.wait, args=(helper, process),
+                         name=helper.name + '-wait', daemon=True).start()
+        if helper.check is not None:
+            self.after(CHECK_INTERVAL, lambda: self.examine(helper, process))
+
+    def wait(self, helper, process):
+        '''
+        block until a helper exits, then let the supervisor know
+        '''
+        status = process.wait()
+        self.call(lambda: self.exited(helper, process, status))
+
+    def exited(self, helper, process, status):
+        '''
+        schedule a restart of a helper that has exited
+        '''
+        if helper.process is not process:
+            return
+        helper.process = None
+        if self.stopping.is_set():
+            return
+        if time.monotonic() - helper.started >= STABLE:
+            helper.backoff = BACKOFF
+        logging.warning('%s exited with status %s, restarting in %.1fs',
+                        helper.name, status, helper.backoff)
+        helper.restarts += 1
+        self.after(helper.backoff, lambda: self.launch(helper))
+        helper.backoff = min(helper.backoff * 2, MAXBACKOFF)
+
+    def examine(self, helper, process):
+        '''
+        run a helper's health check, terminating it if it keeps failing
+        '''
+        if helper.process is not process or self.stopping.is_set():
+            return
+        if helper.check():
+            helper.failures = 0
+        else:
+            helper.failures += 1
+            logging.warning('%s failed health check %d of %d', helper.name,
+                            helper.failures, FAILURES)
+            if helper.failures >= FAILURES:
+                process.terminate()  # `exited` will restart it
+                return
+        self.after(CHECK_INTERVAL, lambda: self.examine(helper, process))
+
+    def stop(self, grace=GRACE):
+        '''
+        stop the supervisor, and the helpers with it
+        '''
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        self.events.put(None)
+        processes = [helper.process for helper in self.helpers.values()
+                     if helper.process is not None]
+        for process in processes:
+            process.terminate()
+        deadline = time.monotonic() + grace
+        for process in processes:
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        if processes:
+            logging.warning('program stopped, helpers terminated')
+
+def listening(port, host='127.0.0.1'):
+    '''
+    health check: whether something accepts connections on `port`
+    '''
+    def check():
+        try:
+            socket.create_connection((host, port), timeout=2).close()
+            return True
+        except OSError:
+            return False
+    return check
+
+SUPERVISOR = Supervisor()
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
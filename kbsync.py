@@ -0,0 +1,359 @@
+#!/usr/bin/python3
+'''
+catch up on posts missed while offline, by anti-entropy sync with peers
+
+every so often, each node compares the set of posts it has with that of
+a peer, and fetches whatever it lacks over the kbpeer connection. the
+comparison is a range-based set reconciliation:
+
+posts are keyed by day and hash, `2021-09-13:kbz...`, so keys sort by
+time and the posts missed during an outage fall in a few neighbouring
+ranges. the nodes trade fingerprints (count, and a 64-bit sum of key
+digests) of ranges of keys. a range whose fingerprints match is in
+sync; one that differs is split into BRANCHES subranges and compared
+again, until it holds few enough keys to simply list. so the metadata
+exchanged grows with the differences, not with the number of posts.
+
+a reconciliation message, frame type R, is a JSON list of
+[upper, mode, payload] ranges, each starting where the one before it
+ended. the first starts at '', and an upper bound of null is the end.
+
+    f [count, fingerprint]  my fingerprint for this range
+    k [key, ...]            all my keys in this range; send what I lack
+    x [key, ...]            the keys in this range that you lack
+    s null                  nothing (more) to do in this range
+
+>>> ours, theirs = PostSet(), PostSet()
+>>> ours.update(('kbz%d' % n, '2021-09-%02d' % (n % 28 + 1))
+...             for n in range(1000))
+>>> theirs.update(('kbz%d' % n, '2021-09-%02d' % (n % 28 + 1))
+...               for n in range(3, 1003))
+>>> message, wanted = ours.start(), set()
+>>> while message:
+...     reply = theirs.reconcile(message)[0]
+...     message, needed = ours.reconcile(reply)
+...     wanted.update(needed)
+>>> sorted(key.rsplit(':', 1)[1] for key in wanted)
+['kbz1000', 'kbz1001', 'kbz1002']
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, json, time, threading  # pylint: disable=multiple-imports
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from hashlib import sha256
+from kbcommon import logging, read
+from kbpeer import POSTHASH, ADDRESS, connect, send_frame, recv_frame, fetch
+from kbutils import create, post_hash
+
+BRANCHES = 16  # subranges to split a differing range into
+THRESHOLD = 16  # list keys, rather than split, in ranges no bigger
+MODULUS = 1 << 64
+REFRESH = 10  # seconds, at most, between rescans of the post directory
+BATCH = 256  # posts to fetch per connection
+INTERVAL = int(os.getenv('KB_SYNC_INTERVAL') or 300)  # seconds
+MAXPEERS = 64
+# host:port of peers to sync with, besides those heard announcing posts
+PEERS = OrderedDict.fromkeys(
+    filter(None, os.getenv('KB_SYNC_PEERS', '').split(',')))
+COMPACT = {'separators': (',', ':')}
+
+def remember(address):
+    '''
+    add a peer to those we sync with, forgetting the least recently seen
+    '''
+    if address != ADDRESS:
+        PEERS[address] = None
+        PEERS.move_to_end(address)
+        while len(PEERS) > MAXPEERS:
+            PEERS.popitem(last=False)
+
+def wellformed(message):
+    '''
+    whether a reconciliation message from a peer is a list of ranges as
+    described above
+
+    >>> wellformed([['2021', 'k', ['2021-09-13:kbz1']], [None, 's', None]])
+    True
+    >>> wellformed({}), wellformed([[None, 'x', [1]]]), wellformed([[1]])
+    (False, False, False)
+    '''
+    if not isinstance(message, list):
+        return False
+    for entry in message:
+        if not isinstance(entry, list) or len(entry) != 3:
+            return False
+        upper, mode, payload = entry
+        if upper is not None and not isinstance(upper, str):
+            return False
+        if mode in ('k', 'x'):
+            if not isinstance(payload, list) or not all(
+                    isinstance(key, str) for key in payload):
+                return False
+        elif mode not in ('f', 's'):
+            return False
+    return True
+
+class PostSet():
+    '''
+    sorted keys of the posts a node has, with prefix sums of their digests
+    for constant-time range fingerprints
+
+    `directory`, if given, is rescanned now and then for new posts
+    '''
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.keys = []
+        self.known = {}  # hash: key
+        self.digests = {}  # key: int
+        self.sums = None  # rebuilt only when needed after a change
+        self.lock = threading.Lock()
+        self.refreshed = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self, posts):
+        '''
+        add (hash, timestamp) pairs, or rekey posts present
+
+        the hash doesn't cover the timestamp, so copies of one post may
+        differ in it; a post is keyed by the earliest day it comes with,
+        so that peers holding different copies come to agree on its key
+
+        >>> posts = PostSet()
+        >>> posts.update([('kbz1', '2021-09-14T10:00:00')])
+        >>> posts.update([('kbz1', '2021-09-13'), ('kbz1', '2021-09-15')])
+        >>> posts.keys, posts.known
+        (['2021-09-13:kbz1'], {'kbz1': '2021-09-13:kbz1'})
+        '''
+        with self.lock:
+            changed, replaced = {}, set()
+            for hashed, timestamp in posts:
+                key = '%s:%s' % (timestamp[:10], hashed)
+                old = self.known.get(hashed)
+                if old is not None and old <= key:
+                    continue
+                if old is not None:
+                    replaced.add(old)
+                    self.digests.pop(old, None)
+                self.known[hashed] = changed[hashed] = key
+            added = list(changed.values())
+            if replaced:
+                self.keys = [key for key in self.keys if key not in replaced]
+            if len(added) < BRANCHES:
+                for key in added:
+                    insort(self.keys, key)
+            else:
+                self.keys = sorted(set(self.keys).union(added))
+            self.sums = None if added else self.sums
+
+    def refresh(self, force=False):
+        '''
+        pick up posts added to (or removed from) our directory
+        '''
+        now = time.monotonic()
+        if self.directory is None or not force and \
+                self.refreshed is not None and now - self.refreshed < REFRESH:
+            return
+        self.refreshed = now
+        present = {name for name in os.listdir(self.directory)
+                   if POSTHASH.match(name) and
+                   os.path.islink(os.path.join(self.directory, name))}
+        with self.lock:
+            gone = set(self.known).difference(present)
+            if gone:
+                self.keys = [key for key in self.keys
+                             if key.rsplit(':', 1)[1] not in gone]
+                for hashed in gone:
+                    self.digests.pop(self.known.pop(hashed), None)
+                self.sums = None
+        posts = []
+        for hashed in present.difference(self.known):
+            try:
+                post = json.loads(read(os.path.join(self.directory, hashed)))
+                posts.append((hashed, post.get('timestamp', '')))
+            except (OSError, ValueError) as problem:
+                logging.warning('cannot sync unreadable post %s: %s',
+                                hashed, problem)
+        self.update(posts)
+
+    def span(self, lower, upper):
+        '''
+        index range of keys from `lower` up to, not including, `upper`
+        '''
+        return (bisect_left(self.keys, lower),
+                len(self.keys) if upper is None
+                else bisect_left(self.keys, upper))
+
+    def fingerprint(self, start, end):
+        '''
+        [count, fingerprint] of keys[start:end]
+
+        caller must hold the lock
+        '''
+        if self.sums is None:
+            self.sums = [0]
+            for key in self.keys:
+                if key not in self.digests:
+                    self.digests[key] = int.from_bytes(
+                        sha256(key.encode()).digest()[:8], 'big')
+                self.sums.append((self.sums[-1] + self.digests[key]) % MODULUS)
+        return [end - start,
+                '%016x' % ((self.sums[end] - self.sums[start]) % MODULUS)]
+
+    def start(self):
+        '''
+        first message of a reconciliation
+        '''
+        with self.lock:
+            return [[None, 'f', self.fingerprint(0, len(self.keys))]]
+
+    def reconcile(self, message):
+        '''
+        process a peer's message, returning (reply, keys we lack)
+
+        an empty reply means we are done; raises ValueError if the
+        message is not one
+
+        >>> PostSet().reconcile([[None, 'k', 5]])
+        Traceback (most recent call last):
+          ...
+        ValueError: malformed reconciliation message
+        '''
+        if not wellformed(message):
+            raise ValueError('malformed reconciliation message')
+        reply, needed, lower = [], [], ''
+        with self.lock:
+            for upper, mode, payload in message:
+                start, end = self.span(lower, upper)
+                if mode == 'f' and payload != self.fingerprint(start, end):
+                    if end - start <= THRESHOLD:
+                        reply.append([upper, 'k', self.keys[start:end]])
+                    else:
+                        reply.extend(self.split(start, end, upper))
+                elif mode == 'k':
+                    theirs, mine = set(payload), set(self.keys[start:end])
+                    needed.extend(theirs - mine)
+                    if mine - theirs:
+                        reply.append([upper, 'x', sorted(mine - theirs)])
+                elif mode == 'x':
+                    needed.extend(payload)
+                if not reply or reply[-1][0] != upper:
+                    if reply and reply[-1][1] == 's':
+                        reply[-1][0] = upper
+                    else:
+                        reply.append([upper, 's', None])
+                lower = upper
+                if upper is None:
+                    break
+        while reply and reply[-1][1] == 's':
+            reply.pop()
+        return reply, needed
+
+    def split(self, start, end, upper):
+        '''
+        fingerprints for BRANCHES subranges of keys[start:end]
+
+        caller must hold the lock
+        '''
+        count = end - start
+        cuts = [start + count * branch // BRANCHES
+                for branch in range(BRANCHES + 1)]
+        return [[self.bound(cuts[index + 1]) if index + 1 < BRANCHES
+                 else upper,
+                 'f', self.fingerprint(cuts[index], cuts[index + 1])]
+                for index in range(BRANCHES)]
+
+    def bound(self, index):
+        '''
+        shortest prefix of keys[index] that still sorts after keys[index - 1]
+
+        caller must hold the lock
+        '''
+        key, previous = self.keys[index], self.keys[index - 1]
+        length = 0
+        while length < len(previous) and key[length] == previous[length]:
+            length += 1
+        return key[:length + 1]
+
+def serve(server, postset):
+    '''
+    answer reconciliation requests on a kbpeer.PeerServer
+    '''
+    def handle(payload):
+        postset.refresh()
+        reply = postset.reconcile(json.loads(payload))[0]
+        return b'R', json.dumps(reply, **COMPACT).encode()
+    server.handlers[b'R'] = handle
+
+def sync(address, postset, deliver=None):
+    '''
+    reconcile with the peer at `address`, and fetch the posts we lack
+
+    `deliver(hash, body)` is called for each fetched post matching its
+    hash. returns counts of rounds, metadata bytes, and posts needed
+    '''
+    stats = {'rounds': 0, 'bytes_sent': 0, 'bytes_received': 0}
+    postset.refresh()
+    message, needed = postset.start(), set()
+    connection = connect(address)
+    with connection, connection.makefile('rb') as reader:
+        while message:
+            payload = json.dumps(message, **COMPACT).encode()
+            send_frame(connection, b'R', payload)
+            kind, reply = recv_frame(reader)
+            if kind != b'R':
+                raise ConnectionError('%s cannot sync' % address)
+            stats['rounds'] += 1
+            stats['bytes_sent'] += len(payload)
+            stats['bytes_received'] += len(reply)
+            message, wanted = postset.reconcile(json.loads(reply))
+            needed.update(wanted)
+    hashes = sorted(key.rsplit(':', 1)[1] for key in needed)
+    stats['needed'] = len(hashes)
+    for index in range(0, len(hashes) if deliver else 0, BATCH):
+        fetched = fetch(address, hashes[index:index + BATCH])
+        for hashed, body in fetched.items():
+            if body is not None and post_hash(body) == hashed:
+                deliver(hashed, body)
+            else:
+                logging.warning('%s failed to send %s', address, hashed)
+    return stats
+
+class Synchronizer():
+    '''
+    sync with known peers every INTERVAL seconds, in the background
+    '''
+    def __init__(self, server, interval=INTERVAL):
+        self.postset = PostSet(server.directory)
+        self.interval = interval
+        self.stopping = threading.Event()
+        serve(server, self.postset)
+        threading.Thread(target=self.run, name='kbsync', daemon=True).start()
+
+    def ingest(self, hashed, body):
+        '''
+        store a post fetched during sync
+        '''
+        create(None, body.decode())
+        self.postset.update([(hashed, json.loads(body).get('timestamp', ''))])
+
+    def run(self):
+        '''
+        sync with each peer in turn until stopped
+        '''
+        while not self.stopping.wait(self.interval):
+            for address in list(PEERS):
+                try:
+                    stats = sync(address, self.postset, self.ingest)
+                    logging.info('synced with %s: %s', address, stats)
+                except (OSError, ValueError) as problem:
+                    logging.warning('sync with %s failed: %s',
+                                    address, problem)
+
+    def stop(self):
+        '''
+        stop syncing
+        '''
+        self.stopping.set()
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+'''
+HTML templates, read and compiled once, then rendered from memory
+
+templates use str.format syntax. a template is split once into its
+literal text and its replacement fields, each field becoming a getter,
+so rendering is a join with no parsing and no file I/O.
+
+fields of `post` are escaped, since posts come from strangers; any
+other arguments are taken to be HTML already.
+
+with KB_DEBUG set, a template is reloaded when its file changes.
+
+since posts never change, their rendered HTML is kept in FRAGMENTS,
+keyed by post hash and the version of the templates that rendered it.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, html, threading  # pylint: disable=multiple-imports
+from collections import OrderedDict
+from hashlib import sha256
+from operator import attrgetter
+from string import Formatter
+from kbcommon import CACHE, logging
+
+RELOAD = bool(os.getenv('KB_DEBUG'))
+ESCAPED = 'post'  # argument whose fields are escaped
+FRAGMENT_CACHE = int(os.getenv('KB_FRAGMENT_CACHE') or 32 * 1024 * 1024)
+# where to keep fragments dropped from memory, if anywhere
+SPILL = os.path.join(CACHE, 'fragments') if os.getenv('KB_FRAGMENT_SPILL') \
+    else None
+
+def getter(field, conversion, spec):
+    '''
+    compile one replacement field into a function of the render arguments
+
+    >>> post = type('Post', (), {'text': '<b>hi</b>'})
+    >>> getter('post.text', None, '')({'post': post})
+    '&lt;b&gt;hi&lt;/b&gt;'
+    >>> getter('posts', None, '')({'posts': '<div></div>'})
+    '<div></div>'
+    >>> getter('count', None, '03d')({'count': 7})
+    '007'
+    '''
+    name, dot, attributes = field.partition('.')
+    if '[' in field:
+        def lookup(arguments):
+            return Formatter().get_field(field, (), arguments)[0]
+    elif dot:
+        fetch = attrgetter(attributes)
+        def lookup(arguments):
+            return fetch(arguments[name])
+    else:
+        def lookup(arguments):
+            return arguments[name]
+    convert = {'r': repr, 's': str, 'a': ascii}.get(conversion)
+    escape = html.escape if name == ESCAPED else None
+    def get(arguments):
+        value = lookup(arguments)
+        if convert:
+            value = convert(value)
+        value = format(value, spec) if spec else str(value)
+        return escape(value) if escape else value
+    return get
+
+class Template():
+    '''
+    one compiled template
+
+    >>> template = Template.from_string('<p>{post.text}</p>{extra}')
+    >>> post = type('Post', (), {'text': 'fish & chips'})
+    >>> template.render(post=post, extra='<hr>')
+    '<p>fish &amp; chips</p><hr>'
+    >>> Template.from_string('{{literal}} braces').render()
+    '{literal} braces'
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.mtime = None
+        self.steps = []
+        self.digest = ''  # identifies the template's contents
+        if path is not None:
+            self.load()
+
+    @classmethod
+    def from_string(cls, text):
+        '''
+        compile a template held in memory
+        '''
+        template = cls()
+        template.steps = cls.compile(text)
+        template.digest = sha256(text.encode()).hexdigest()[:16]
+        return template
+
+    @staticmethod
+    def compile(text):
+        '''
+        list of literal strings and getters, in order
+        '''
+        steps = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if literal:
+                steps.append(literal)
+            if field is not None:
+                steps.append(getter(field, conversion, spec))
+        return steps
+
+    def load(self):
+        '''
+        read and compile the template file
+        '''
+        with open(self.path, encoding='utf-8') as infile:
+            self.mtime = os.fstat(infile.fileno()).st_mtime
+            text = infile.read()
+        self.steps = self.compile(text)
+        self.digest = sha256(text.encode()).hexdigest()[:16]
+        logging.debug('compiled template %s', self.path)
+
+    def fresh(self):
+        '''
+        reload if the file has changed since loaded
+
+        returns True if it did
+        '''
+        if self.path is not None and \
+                os.stat(self.path).st_mtime != self.mtime:
+            self.load()
+            return True
+        return False
+
+    def render(self, **arguments):
+        '''
+        fill in the template
+        '''
+        return ''.join([step if step.__class__ is str else step(arguments)
+                        for step in self.steps])
+
+class Registry():
+    '''
+    templates by filename, each loaded on first use
+
+    >>> post = type('Post', (), {'text': '<3'})
+    >>> print(TEMPLATES.render('kybyz.html', post=post))
+    <div class="kybyz">
+      <span class="icon" title="&lt;3">&lt;3</span>
+    </div>
+    <BLANKLINE>
+    '''
+    def __init__(self, directory='', reload=RELOAD):
+        self.directory = directory
+        self.reload = reload
+        self.templates = {}
+        self.lock = threading.Lock()
+        self.version = ''  # changes whenever any template does
+
+    def get(self, name):
+        '''
+        compiled template for file `name`
+        '''
+        template = self.templates.get(name)
+        if template is None:
+            with self.lock:
+                if name not in self.templates:
+                    self.templates[name] = Template(
+                        os.path.join(self.directory, name))
+                    self.update()
+                template = self.templates[name]
+        elif self.reload and template.fresh():
+            with self.lock:
+                self.update()
+        return template
+
+    def update(self):
+        '''
+        recompute the version after a template is loaded
+
+        caller must hold the lock
+        '''
+        self.version = sha256(' '.join(
+            '%s:%s' % (name, self.templates[name].digest)
+            for name in sorted(self.templates)).encode()).hexdigest()[:16]
+
+    def render(self, name, **arguments):
+        '''
+        fill in the template from file `name`
+        '''
+        return self.get(name).render(**arguments)
+
+    def preload(self):
+        '''
+        compile every template in the directory now
+        '''
+        for name in os.listdir(self.directory or os.curdir):
+            if name.endswith('.html'):
+                try:
+                    self.get(name)
+                except ValueError as problem:
+                    logging.debug('%s is not a template: %s', name, problem)
+
+class FragmentCache():
+    '''
+    rendered HTML by key, least recently used dropped first, once there
+    is more than `maxbytes` of it; to disk if `spill` names a directory
+
+    >>> cache = FragmentCache(maxbytes=10)
+    >>> cache.get(('kbz1', 'v1'), lambda: b'<p>one</p>')
+    b'<p>one</p>'
+    >>> cache.get(('kbz1', 'v1'), lambda: b'not rendered again')
+    b'<p>one</p>'
+    >>> cache.get(('kbz2', 'v1'), lambda: b'<p>two</p>')
+    b'<p>two</p>'
+    >>> list(cache.fragments), cache.stats()['misses']
+    ([('kbz2', 'v1')], 2)
+    '''
+    def __init__(self, maxbytes=FRAGMENT_CACHE, spill=SPILL):
+        self.maxbytes = maxbytes
+        self.spill = spill
+        self.fragments = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'spilled': 0, 'unspilled': 0}
+
+    def path(self, key):
+        '''
+        file a fragment is spilled to: by version, then by name
+        '''
+        return os.path.join(self.spill, key[-1], *key[:-1])
+
+    def get(self, key, render):
+        '''
+        fragment for `key`, as bytes, calling `render()` to make it if need be
+
+        keys are tuples of strings, such as (post hash, template version)
+        '''
+        with self.lock:
+            fragment = self.fragments.get(key)
+            if fragment is not None:
+                self.fragments.move_to_end(key)
+                self.counts['hits'] += 1
+                return fragment
+        fragment = None
+        if self.spill is not None:
+            try:
+                with open(self.path(key), 'rb') as infile:
+                    fragment = infile.read()
+                self.counts['unspilled'] += 1
+            except OSError:
+                pass
+        if fragment is None:
+            fragment = render()
+            self.counts['misses'] += 1
+        with self.lock:
+            if key not in self.fragments:
+                self.fragments[key] = fragment
+                self.size += len(fragment)
+            evicted = []
+            while self.size > self.maxbytes and len(self.fragments) > 1:
+                evicted.append(self.fragments.popitem(last=False))
+                self.size -= len(evicted[-1][1])
+        for evicted_key, evicted_fragment in evicted:
+            self.store(evicted_key, evicted_fragment)
+        return fragment
+
+    def store(self, key, fragment):
+        '''
+        spill a fragment dropped from memory to disk, if so configured
+        '''
+        if self.spill is None:
+            return
+        path = self.path(key)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as outfile:
+                    outfile.write(fragment)
+                self.counts['spilled'] += 1
+            except OSError as problem:
+                logging.warning('cannot spill fragment to %s: %s',
+                                path, problem)
+
+    def stats(self):
+        '''
+        size and hit counts
+        '''
+        with self.lock:
+            return dict(self.counts, fragments=len(self.fragments),
+                        bytes=self.size)
+
+TEMPLATES = Registry()
+FRAGMENTS = FragmentCache()
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
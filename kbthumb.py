@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+'''
+thumbnails of post images, so the timeline needn't pull full-size
+pictures, which over Tor is most of the page weight
+
+a thumbnail is made in the background the first time it's asked for,
+and the original is sent meanwhile. thumbnails are kept in THUMBDIR by
+size and by hash of the source image, so a changed source gets a new
+one.
+
+making them needs PIL (python3-pil); without it, posts link to the
+original images as before.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, threading  # pylint: disable=multiple-imports
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
+from kbcommon import CACHE, KYBYZ_HOME, logging
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+THUMBDIR = os.path.join(CACHE, 'thumbs')
+SIZES = tuple(map(int, os.getenv('KB_THUMB_SIZES', '240 480 960').split()))
+SIZE = int(os.getenv('KB_THUMB_SIZE') or SIZES[len(SIZES) // 2])
+QUALITY = int(os.getenv('KB_THUMB_QUALITY') or 70)
+WORKERS = int(os.getenv('KB_THUMB_WORKERS') or 2)
+MAXAGE = {  # seconds browsers may keep a thumbnail
+    'ipfs': 365 * 24 * 60 * 60,  # content-addressed, never changes
+    None: 24 * 60 * 60,
+}
+
+class Thumbnailer():
+    '''
+    thumbnails by image path and size, made by a pool of worker threads
+
+    >>> thumbs = Thumbnailer(None, enabled=True)
+    >>> thumbs.url('ipfs/QmW2WQi7j6c7UgJTarActp7tDNikE4B2q/cat.jpg')
+    'thumb/480/ipfs/QmW2WQi7j6c7UgJTarActp7tDNikE4B2q/cat.jpg'
+    >>> thumbs.url('https://example.com/a.jpg'), thumbs.url('')
+    ('https://example.com/a.jpg', '')
+    >>> thumbs.source('../../etc/passwd') is None
+    True
+    >>> Thumbnailer(None, enabled=False).url('ipfs/Qm/a.jpg')
+    'ipfs/Qm/a.jpg'
+    '''
+    def __init__(self, directory=THUMBDIR, sizes=SIZES, workers=WORKERS,
+                 enabled=Image is not None):
+        self.directory = directory
+        self.sizes = sizes
+        self.workers = workers
+        self.enabled = enabled
+        self.pool = None  # started on first use
+        self.pending = {}
+        self.digests = {}  # source path to (mtime, size, hash)
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'fallbacks': 0, 'made': 0, 'failed': 0}
+
+    def url(self, image, size=SIZE):
+        '''
+        where a post should link to `image` at `size`
+
+        only images we serve ourselves can be thumbnailed
+        '''
+        if not self.enabled or not image or ':' in image.split('/')[0]:
+            return image
+        return 'thumb/%d/%s' % (size, image.lstrip('/'))
+
+    @staticmethod
+    def source(path):
+        '''
+        local file holding the original image, if we have it yet
+        '''
+        for directory in (KYBYZ_HOME, os.curdir):
+            base = os.path.realpath(directory)
+            fullpath = os.path.realpath(os.path.join(base, path))
+            if fullpath.startswith(base + os.sep) and \
+                    os.path.isfile(fullpath):
+                return fullpath
+        return None
+
+    def digest(self, source):
+        '''
+        hash of the source image's contents, remembered while unchanged
+        '''
+        status = os.stat(source)
+        key = (status.st_mtime, status.st_size)
+        known = self.digests.get(source)
+        if known is None or known[:2] != key:
+            with open(source, 'rb') as infile:
+                known = key + (sha256(infile.read()).hexdigest(),)
+            self.digests[source] = known
+        return known[2]
+
+    def path(self, digest, size):
+        '''
+        file a thumbnail is kept in
+        '''
+        return os.path.join(self.directory, str(size), digest[:2],
+                            digest + '.jpg')
+
+    def get(self, path, size):
+        '''
+        thumbnail of image `path` at `size`, as JPEG bytes
+
+        None if it isn't ready, in which case it is queued to be made
+        and the caller should send the original
+        '''
+        source = self.source(path) if self.enabled else None
+        if source is None or size not in self.sizes:
+            self.counts['fallbacks'] += 1
+            return None
+        target = self.path(self.digest(source), size)
+        try:
+            with open(target, 'rb') as infile:
+                thumbnail = infile.read()
+            self.counts['hits'] += 1
+            return thumbnail
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            if target not in self.pending:
+                if self.pool is None:
+                    self.pool = ThreadPoolExecutor(
+                        self.workers, thread_name_prefix='kbthumb')
+                self.pending[target] = self.pool.submit(
+                    self.make, source, size, target)
+        self.counts['fallbacks'] += 1
+        return None
+
+    def make(self, source, size, target):
+        '''
+        shrink and recompress one image (in a worker thread)
+        '''
+        try:
+            with Image.open(source) as image:
+                image.thumbnail((size, size))
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                partial = target + '.partial'
+                image.save(partial, 'JPEG', quality=QUALITY, optimize=True,
+                           progressive=True)
+            os.replace(partial, target)
+            self.counts['made'] += 1
+            logging.debug('made thumbnail %s of %s', target, source)
+        except (OSError, ValueError) as problem:  # PIL errors are OSErrors
+            self.counts['failed'] += 1
+            logging.warning('cannot make thumbnail of %s: %s', source, problem)
+        finally:
+            with self.lock:
+                self.pending.pop(target, None)
+
+    @staticmethod
+    def lifetime(path):
+        '''
+        Cache-Control header value for a thumbnail of `path`
+        '''
+        return 'public, max-age=%d' % MAXAGE.get(
+            path.split('/')[0], MAXAGE[None])
+
+    def stats(self):
+        '''
+        counts, and thumbnails still being made
+        '''
+        with self.lock:
+            return dict(self.counts, pending=len(self.pending))
+
+THUMBS = Thumbnailer()
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
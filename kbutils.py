@@ -3,18 +3,32 @@
 Kybyz utilities
 '''
 # pylint: disable=bad-option-value, consider-using-f-string
-import os, re, subprocess, json  # pylint: disable=multiple-imports
+import os, re, subprocess, json, zlib  # pylint: disable=multiple-imports
 from hashlib import sha256
 from base58 import b58encode, b58decode
 from canonical_json import canonicalize
-from kbcommon import CACHE, CACHED, EXAMPLE, KYBYZ_HOME, COMMAND, ARGS, logging
+from kbcommon import CACHE, EXAMPLE, KYBYZ_HOME, COMMAND, ARGS, logging
 from kbcommon import REGISTRATION, read, CHANNEL, POSTS_QUEUE, JSON
+from kbcommon import PAGESIZE, REGISTERED, STATE, TO_PAGE
 from post import BasePost
+from kbindex import ingest, SEARCH, FIELDS
+from kbtemplate import TEMPLATES, FRAGMENTS
+from kbprofile import traced
+from kbwire import PREFIX as WIRE_PREFIX, ENCRYPTED, frame, unframe, expand
 
-try:
-    from gnupg import GPG
-except ImportError:
-    from kbgpg import GPG
+def GPG(*args, **kwargs):  # pylint: disable=invalid-name
+    '''
+    python-gnupg's GPG, or ours if it isn't installed
+
+    imported only when first needed, since nothing that serves a page
+    needs it
+    '''
+    # pylint: disable=import-outside-toplevel
+    try:
+        from gnupg import GPG as gpg
+    except ImportError:
+        from kbgpg import GPG as gpg
+    return gpg(*args, **kwargs)
 
 def kbhash(message):
     '''
@@ -28,6 +42,21 @@ def kbhash(message):
     hashed = sha256(canonical).digest()
     return b58encode(prefix + hashed).decode()
 
+def post_hash(body):
+    '''
+    return the hash a post's JSON is stored under, that of its canonical
+    form, or None if it isn't a valid post
+
+    >>> post_hash(read('example.kybyz/testmeme.json'))
+    'kbz3U9W4UpB22yxnBbUsZFevUJ5FEfKuJpvPFptEGpxgDcy'
+    '''
+    try:
+        newpost = BasePost(None, **json.loads(body))
+        return kbhash(newpost.to_json(for_hashing=True))
+    except (ValueError, TypeError, KeyError, AttributeError, AssertionError):
+        logging.debug('not a valid post: %r...', body[:64])
+        return None
+
 def verify_key(email):
     '''
     fetch user's GPG key and make sure it matches given email address
@@ -60,10 +89,45 @@ def publish(post_id, publish_to='all'):
     for recipient in recipients:
         logging.debug('recipient: %s', recipient)
         if recipient == 'all':
-            send(CHANNEL, '-', read(posts[0]))
+            # if we can serve it directly, just tell everyone we have it
+            announced = STATE.ircbot.gossip.publish(
+                os.path.basename(posts[0]), os.path.getsize(posts[0]),
+                os.path.splitext(os.path.realpath(posts[0]))[1][1:])
+            send(CHANNEL, '-', announced or read(posts[0]))
         else:
             send(recipient, recipient, read(posts[0]))
 
+def summary(post):
+    '''
+    the text of a post, all of it, as a search result shows it
+
+    >>> summary({'type': 'netmeme', 'toptext': '', 'bottomtext': 'only'})
+    'only'
+    '''
+    return ' '.join(filter(None, (
+        post.get(field) for field in ('toptext', 'bottomtext', 'text'))))
+
+def search(*words):
+    '''
+    find posts containing all the given words, best matches first
+
+    returns list of (hash, summary) for one page of results;
+    a word `page=N` asks for page N
+
+    >>> search('page=2')
+    []
+    '''
+    page = 1
+    for word in [word for word in words if re.match(r'^page=\d+$', word)]:
+        page = max(1, int(word.split('=')[1]))
+    words = [word for word in words if not re.match(r'^page=\d+$', word)]
+    hashes = SEARCH.search(' '.join(words), (page - 1) * PAGESIZE, PAGESIZE)
+    results = []
+    for hashed in hashes:
+        post = json.loads(read(os.path.join(KYBYZ_HOME, hashed)))
+        results.append((hashed, summary(post)))
+    return results
+
 def send(recipient, email, *words):
     '''
     encrypt, sign, and send a private message to recipient
@@ -73,6 +137,9 @@ def send(recipient, email, *words):
     find the GPG key of the recipient.
 
     use `-` instead of email to send plain text
+
+    the message goes as a compact frame (see kbwire) if the recipient
+    has said it can read them
     '''
     if len(words) > 1 or isinstance(words[0], str):
         text = ' '.join(words).encode()
@@ -80,29 +147,41 @@ def send(recipient, email, *words):
         text = words[0]  # as when called by `publish`
     logging.debug('words: %s', words)
     encoded = None
+    compact = STATE.ircbot.wire.accepts(recipient)
     if email != '-':
         user = "%s <%s>" % (recipient, email)
         gpg = GPG()
         logging.debug('message before encrypting: %s', text)
-        encrypted = gpg.encrypt(
-            text,  # pylint: disable=no-member
-            [user],
-            sign=True,
-            armor=False)
-        logging.debug('encrypted: %r...', encrypted.data[:64])
-        encoded = b58encode(encrypted.data).decode()
+        def encrypt(data):
+            encrypted = gpg.encrypt(
+                data,  # pylint: disable=no-member
+                [user],
+                sign=True,
+                armor=False)
+            logging.debug('encrypted: %r...', encrypted.data[:64])
+            return encrypted.data
+        if compact:
+            encoded = frame(text, encrypt)
+        else:
+            encoded = b58encode(encrypt(text)).decode()
         logging.debug('encoded: %s', encoded)
     if text and not encoded:
         if email == '-' or os.getenv('KB_SEND_PLAINTEXT_OK'):
             logging.warning('encryption %s, sending plaintext',
                             'bypassed' if email == '-' else 'failed')
             encoded = text.decode()
+            if compact:  # unless framing made it no smaller
+                encoded = min(encoded, frame(text), key=len)
         else:
             logging.warning('encryption failed, run with '
                             'KB_SEND_PLAINTEXT_OK=1 to send anyway')
             logging.warning('setting message to "(encryption failed)"')
             encoded = '(encryption failed)'
-    CACHED['ircbot'].privmsg(recipient, encoded)
+    STATE.ircbot.privmsg(recipient, encoded)
+    if recipient != CHANNEL:
+        logging.info('private message to %s: %s', recipient,
+                     text.decode().replace('<', '&lt;').replace('>', '&gt;'),
+                     extra=dict(TO_PAGE['extra'], conversation=recipient))
 
 def registration():
     '''
@@ -123,7 +202,8 @@ def registration():
             gpgkey = os.path.basename(links[-1])
             logging.debug('links found: %s', links)
         except OSError:
-            logging.exception('Bad registration at %s', links[-1])
+            logging.exception('Bad registration at %s',
+                              (links or [KYBYZ_HOME])[-1])
     return REGISTRATION(username, email, gpgkey)
 
 def register(username=None, email=None, gpgkey=None):
@@ -147,13 +227,14 @@ def register(username=None, email=None, gpgkey=None):
         os.symlink(os.path.join(CACHE, email), os.path.join(CACHE, username))
         os.symlink(os.path.join(CACHE, username), KYBYZ_HOME)
         logging.info('Now registered as %s %s %s', username, email, gpgkey)
-        if CACHED.get('ircbot', None):
-            CACHED['ircbot'].nick(username)
-            CACHED['ircbot'].leave()  # rejoin to freshen CACHED['irc_id']
-            CACHED['ircbot'].join()
+        if STATE.ircbot:
+            STATE.ircbot.nick(username)
+            STATE.ircbot.leave()  # rejoin to freshen STATE.irc_id
+            STATE.ircbot.join()
         else:
             logging.info('registering outside of running application')
 
+@traced('create')
 def create(post_type, *args, returned='hashed', **kwargs):
     '''
     make a new post from the command line or from another subroutine
@@ -197,6 +278,7 @@ def create(post_type, *args, returned='hashed', **kwargs):
                 os.symlink(cached, unadorned)
             else:
                 logging.debug('%s already symlinked to %s', unadorned, cached)
+        ingest(hashed, newpost.__dict__)
         return hashed if returned == 'hashed' else newpost
     except AttributeError:
         logging.exception('Post failed: attribute error')
@@ -205,6 +287,7 @@ def create(post_type, *args, returned='hashed', **kwargs):
         logging.exception('Post failed with kwargs: %s', kwargs)
         return None
 
+@traced('cachewrite')
 def cachewrite(path, data):
     '''
     store data in cache for later retrieval
@@ -259,7 +342,8 @@ def find_posts(directory, suffix):
     posts = get_posts(directory, '^kbz[0-9A-Za-z]*%s$' % suffix)
     return posts
 
-def loadposts(to_html=True, tries=0):
+@traced('loadposts')
+def loadposts(to_html=True):
     '''
     fetch and return all posts from KYBYZ_HOME or, if empty, from EXAMPLE
 
@@ -267,19 +351,65 @@ def loadposts(to_html=True, tries=0):
     '''
     logging.debug('running loadposts(%s)', to_html)
     if not get_posts(KYBYZ_HOME):
-        if tries > 1:
-            raise ValueError('No posts found after example posts cached')
         # populate KYBYZ_HOME from EXAMPLE
         for example in get_posts(EXAMPLE):
             create(None, read(example).decode())
-        return loadposts(to_html, tries=tries + 1)
-    # now cache any that came in over the wire
-    for index in range(len(POSTS_QUEUE)):  # pylint: disable=unused-variable
-        create(None, POSTS_QUEUE.popleft())
-    get_post = BasePost if to_html else read
-    posts = [get_post(p) for p in get_posts(KYBYZ_HOME)]
+        if not get_posts(KYBYZ_HOME):
+            raise ValueError('No posts found after example posts cached')
+    receive()
+    if not to_html:  # raw JSON, sorted by its timestamp
+        return sorted([read(p) for p in get_posts(KYBYZ_HOME)],
+                      key=lambda p: json.loads(p).get('timestamp', ''),
+                      reverse=True)
+    posts = [BasePost(p) for p in get_posts(KYBYZ_HOME)]
     return sorted(filter(None, posts), key=lambda p: p.timestamp, reverse=True)
 
+def receive():
+    '''
+    cache any posts that came in over the wire
+    '''
+    for index in range(len(POSTS_QUEUE)):  # pylint: disable=unused-variable
+        try:
+            message = POSTS_QUEUE.popleft()
+        except IndexError:  # another request has taken the rest
+            break
+        create(None, message)
+
+def timeline():
+    '''
+    hashes of all posts, newest first
+
+    like loadposts(), but from the index, without reading any post
+    '''
+    if not FIELDS:
+        loadposts(to_html=False)  # caches the examples if we have nothing
+    else:
+        receive()
+    return FIELDS.recent()
+
+def fragment(hashed):
+    '''
+    rendered HTML of a post, as bytes, rendered only if not cached
+    '''
+    return FRAGMENTS.get(
+        (hashed, TEMPLATES.version),
+        lambda: str(BasePost(os.path.join(KYBYZ_HOME, hashed))).encode())
+
+def stream(head, hashes, tail):
+    '''
+    a page as it is sent: `head`, each post in turn, then `tail`
+
+    only one post need be in memory at a time, and the first bytes go
+    out before the last post is rendered
+
+    >>> list(stream(b'<body>', [], b'</body>'))
+    [b'<body>', b'</body>']
+    '''
+    yield head
+    for hashed in hashes:
+        yield b'<div>%s</div>' % fragment(hashed)
+    yield tail
+
 def ipfs_add(filepath):
     '''
     add a file to IPFS
@@ -292,23 +422,42 @@ def ipfs_add(filepath):
     words = output.split()
     return words[1]
 
+@traced('decrypt')
 def decrypt(message):
     '''
     decrypt a message sent to me, and verify sender email
+
+    `message` is base58 of GPG's output, or a compact frame of it
     '''
-    gpg = GPG()
     verified = decoded = b''
+    flags = 0
     logging.debug('decoding %s...', message[:64])
     try:
-        decoded = b58decode(message)
+        if message.startswith(WIRE_PREFIX.encode()):
+            unframed = unframe(message.decode())
+            if unframed is None:
+                return b'', 'incomplete frame'
+            flags, decoded = unframed
+            if not flags & ENCRYPTED:
+                return expand(flags, decoded), 'unencrypted frame'
+        else:
+            decoded = b58decode(message)
         logging.debug('decrypting %r...', decoded[:64])
-        decrypted = gpg.decrypt(decoded)
+        # only now, since plaintext such as announcements is common,
+        # and GPG() may run a subprocess
+        decrypted = GPG().decrypt(decoded)
         # pylint: disable=no-member
         verified = 'trust level %s' % decrypted.trust_text
+        if flags and decrypted.data:
+            decrypted.data = expand(flags, decrypted.data)
     except ValueError:
         logging.warning('%r... not base58 encoded', message[:32])
         decrypted = type('', (), {'data': message})
         verified = 'unencoded'
+    except (zlib.error, RecursionError) as problem:
+        logging.warning('cannot expand frame %r...: %s', message[:32], problem)
+        decrypted = type('', (), {'data': message})
+        verified = 'unencoded'
     except subprocess.CalledProcessError as problem:
         logging.exception(problem)
         decrypted = type('', (), {'data': b''})
@@ -316,9 +465,9 @@ def decrypt(message):
 
 def check_username(identifier):
     '''
-    identifier is :bleah!bleah@bleah.com' and CACHED['username'] == 'bleah'
+    identifier is :bleah!bleah@bleah.com' and our username is 'bleah'
 
-    >>> CACHED['username'] = 'bleah'
+    >>> registered = REGISTERED.replace(username='bleah')
     >>> check_username(':bleah!bleah@bleah.com')
     ('bleah', True)
     >>> check_username(':blah!bleah@bleah.com')
@@ -332,7 +481,7 @@ def check_username(identifier):
         nickname = identifier[start:end]
         logging.debug('identifier: %s, start: %s, end: %s, check: %s',
                       identifier, start, end, nickname)
-        matched = CACHED.get('username', None) == nickname
+        matched = REGISTERED.value.username == nickname
     except ValueError:
         # ignore failure, because PINGs don't have username anyway
         #logging.error('cannot find nickname in %s', identifier)
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+'''
+check that the post store holds what its names say, and repair what a
+crash or a failing disk has left behind
+
+each post is cached twice, as `<hash>.<type>`: once as it was posted
+and once in canonical form, each named for the kbhash of its contents;
+the hash of the canonical form, unadorned, is a symlink to the first.
+
+`verify` rehashes every cached file in a pool of WORKERS processes, and
+reports files whose contents no longer match their names, symlinks to
+missing or other posts, and posts left without a symlink. `verify
+repair` also moves the bad files to QUARANTINE, relinks each post to a
+sound copy of it or removes its symlink if there is none, and rebuilds
+the indexes from what is left. `reindex` only rebuilds the indexes.
+
+run these while no other kybyz is using the same store, since the
+indexes of one already running would not know of the changes.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, re, json, time  # pylint: disable=multiple-imports
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from kbcommon import CACHE, KYBYZ_HOME, LOGSTREAM_HANDLER, logging, read
+from kbutils import kbhash, post_hash
+from kbindex import rebuild
+from kbpeer import POSTHASH
+
+QUARANTINE = os.path.join(CACHE, 'quarantine')
+WORKERS = int(os.getenv('KB_VERIFY_WORKERS') or os.cpu_count() or 1)
+CHUNKSIZE = 64  # files handed to a worker at once
+PROGRESS = 10  # seconds between progress reports
+CACHED = re.compile(r'^(kb[yz][1-9A-HJ-NP-Za-km-z]+)\.\w+$')
+
+def worker():
+    '''
+    in a pool process, log warnings straight to stderr: the parent's
+    log listener isn't running here, so its queue would only grow
+    '''
+    logging.getLogger().handlers = [LOGSTREAM_HANDLER]
+    logging.getLogger().setLevel(logging.WARNING)
+
+def check(path):
+    '''
+    whether a cached file's contents hash to its name and, if it is a
+    post, the hash of its canonical form and its fields
+    '''
+    try:
+        body = read(path)
+        if kbhash(body.decode()) != CACHED.match(
+                os.path.basename(path)).group(1):
+            return False, None, None
+    except (OSError, ValueError, AttributeError) as problem:
+        logging.warning('cannot check %s: %s', path, problem)
+        return False, None, None
+    canonical = post_hash(body)
+    return True, canonical, json.loads(body) if canonical else None
+
+def rehash(directory, names, workers=WORKERS):
+    '''
+    check the named files, in parallel if there are enough of them,
+    logging progress; returns {name: check(name)}
+    '''
+    paths = [os.path.join(directory, name) for name in names]
+    start = reported = time.monotonic()
+    results = {}
+    if workers > 1 and len(paths) > CHUNKSIZE:
+        executor = ProcessPoolExecutor(workers, initializer=worker)
+        checked = executor.map(check, paths, chunksize=CHUNKSIZE)
+    else:
+        executor, checked = None, map(check, paths)
+    try:
+        for name, result in zip(names, checked):
+            results[name] = result
+            if time.monotonic() - reported > PROGRESS:
+                reported = time.monotonic()
+                logging.info('checked %d of %d files, %.0f per second',
+                             len(results), len(paths),
+                             len(results) / (reported - start))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return results
+
+def audit(directory=KYBYZ_HOME, repair=False, reindex=False,
+          workers=WORKERS, indexes=None):
+    '''
+    check, and optionally repair, the store, and rebuild its indexes if
+    asked to or if it was repaired; returns counts of what was found
+
+    >>> import tempfile
+    >>> store = tempfile.mkdtemp()
+    >>> body = read('example.kybyz/testmeme.json')
+    >>> def cache(name, body):
+    ...     with open(os.path.join(store, name), 'wb') as outfile:
+    ...         return outfile.write(body) and None
+    >>> cache(kbhash(body.decode()) + '.netmeme', body)
+    >>> cache('kbzNotTheHash.netmeme', body)
+    >>> os.symlink(os.path.join(store, 'kbzGone.netmeme'),
+    ...            os.path.join(store, post_hash(body)))
+    >>> found = audit(store, workers=1)
+    >>> found['files'], found['corrupt'], found['posts'], found['bad links']
+    (2, 1, 0, 1)
+    >>> os.remove(os.path.join(store, 'kbzNotTheHash.netmeme'))
+    >>> found = audit(store, repair=True, workers=1, indexes=[])
+    >>> found['unlinked'], found['relinked'], found['reindexed']
+    (1, 1, 1)
+    >>> audit(store, workers=1)['posts']
+    1
+    '''
+    # pylint: disable=too-many-locals, too-many-branches
+    start = time.monotonic()
+    names = os.listdir(directory)
+    home = os.path.realpath(directory)
+    results = rehash(directory, [
+        name for name in names if CACHED.match(name) and
+        not os.path.islink(os.path.join(directory, name))], workers)
+    found = Counter(files=len(results))
+    copies = defaultdict(list)  # canonical hash: names of sound copies
+    for name, (sound, canonical, fields) in sorted(results.items()):
+        if not sound:
+            found['corrupt'] += 1
+            logging.warning('%s does not match its hash', name)
+            if repair:
+                os.makedirs(QUARANTINE, exist_ok=True)
+                os.replace(os.path.join(directory, name),
+                           os.path.join(QUARANTINE, name))
+                found['quarantined'] += 1
+            continue
+        found['sound'] += 1
+        if canonical:
+            copies[canonical].append(name)
+    posts = {}  # canonical hash: fields, of posts soundly linked
+    for name in [name for name in names if POSTHASH.match(name)]:
+        path = os.path.join(directory, name)
+        if not os.path.islink(path):
+            continue
+        target = os.path.relpath(os.path.realpath(path), home)
+        sound, canonical, fields = results.get(target, (False, None, None))
+        if sound and canonical == name:
+            posts[name] = fields
+            continue
+        found['bad links'] += 1
+        logging.warning('%s links to %s, not a sound copy of it',
+                        name, os.readlink(path))
+        if repair:
+            os.unlink(path)
+            found['unlinked'] += 1
+    for canonical, sound_copies in sorted(copies.items()):
+        if canonical in posts:
+            continue
+        if not repair:
+            if not os.path.islink(os.path.join(directory, canonical)):
+                found['missing links'] += 1
+            continue
+        # link to the copy as posted, as create() does, if it is sound
+        name = sorted(sound_copies,
+                      key=lambda name: name.startswith(canonical))[0]
+        os.symlink(os.path.join(home, name),
+                   os.path.join(directory, canonical))
+        posts[canonical] = results[name][2]
+        found['relinked'] += 1
+    found['posts'] = len(posts)
+    if reindex or repair and (found['quarantined'] or found['unlinked'] or
+                              found['relinked']):
+        rebuild(posts, indexes)
+        found['reindexed'] = len(posts)
+    found['seconds'] = round(time.monotonic() - start, 3)
+    found['files_per_second'] = round(
+        found['files'] / max(found['seconds'], .001))
+    logging.info('%s: %s', directory, dict(found))
+    return dict(found)
+
+def verify(action='check'):
+    '''
+    check the post store, or check and repair it
+    '''
+    if action not in ('check', 'repair'):
+        raise ValueError('verify check or verify repair')
+    return audit(repair=action == 'repair')
+
+def reindex():
+    '''
+    rebuild the indexes from the soundly linked posts in the store
+    '''
+    return audit(reindex=True)
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
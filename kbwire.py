@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+'''
+compact wire format for posts and messages sent over IRC
+
+a post normally goes out as its JSON, and an encrypted message as the
+base58 of GPG's output, a third again as big. a compact frame is PREFIX
+and the base85 of:
+
+    one byte: FORMAT in the high four bits, and the flags below
+    one byte: TABLE, naming the table of field numbers used
+    the length of the payload, as a varint
+    the payload
+
+base85 adds a quarter, and its alphabet has no space or colon, so a
+frame passes through IRC unchanged. the payload is a post in the binary
+encoding of `pack` if POST is set, otherwise the message as it was; it
+is zlib-compressed if COMPRESSED is set, which it is only if that made
+it smaller, or GPG's output if ENCRYPTED is set (GPG compresses what it
+encrypts itself).
+
+`pack` is msgpack-like, but a post's attribute names, as listed in
+BasePost.versions, are sent as their numbers in FIELDS. a frame from a
+peer with another table is refused, and shown as the text it is.
+
+a peer that reads compact frames says so with ADVERTISEMENT, on the
+channel on joining it, and privately in reply to another's; only to
+those do we send them, and to the channel only if KB_WIRE_CHANNEL is
+set, since everyone there must be able to read them.
+'''
+# pylint: disable=bad-option-value, consider-using-f-string
+import os, json, zlib, struct  # pylint: disable=multiple-imports
+from base64 import b85encode, b85decode
+from hashlib import sha256
+from kbcommon import CHANNEL, SeenSet, logging
+from post import BasePost
+
+PREFIX = 'kbw:'
+FORMAT = 1
+ADVERTISEMENT = 'kbz:wire %d' % FORMAT
+POST, COMPRESSED, ENCRYPTED = 1, 2, 4  # flags
+FIELDS = sorted({name for version in BasePost.versions.values()
+                 for schema in version.values() for name in schema})
+TABLE = sha256('\n'.join(FIELDS).encode()).digest()[0]
+NUMBERS = {name: number for number, name in enumerate(FIELDS, 1)}
+COMPACT_CHANNEL = bool(os.getenv('KB_WIRE_CHANNEL'))
+PEERS = 4096  # nicknames remembered as reading compact frames
+MAXSIZE = 1024 * 1024  # largest message a frame may expand to, as ircbot's
+# type tags of `pack`
+NONE, FALSE, TRUE, INTEGER, FLOAT, STRING, LIST, DICT = range(8)
+
+def varint(number):
+    '''
+    unsigned integer as 7-bit groups, least significant first
+
+    >>> varint(1), varint(300)
+    (b'\\x01', b'\\xac\\x02')
+    '''
+    encoded = bytearray()
+    while number > 0x7f:
+        encoded.append(number & 0x7f | 0x80)
+        number >>= 7
+    encoded.append(number)
+    return bytes(encoded)
+
+def unvarint(data, offset):
+    '''
+    the varint at `offset`, and the offset after it
+    '''
+    number = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        number |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return number, offset
+
+def pack(value):
+    '''
+    binary encoding of a JSON value; dict keys that are post attributes
+    are sent as their numbers
+
+    >>> post = {'type': 'post', 'toptext': 'hi', 'in-reply-to': [],
+    ...         'likes': 3, 'score': -1.5, 'signed': None, 'x': True}
+    >>> len(pack(post)) < len(json.dumps(post)) / 2
+    True
+    >>> unpack(pack(post)) == post
+    True
+    '''
+    # pylint: disable=too-many-return-statements
+    if value is None:
+        return bytes([NONE])
+    if isinstance(value, bool):
+        return bytes([TRUE if value else FALSE])
+    if isinstance(value, int):
+        return bytes([INTEGER]) + varint(
+            value << 1 if value >= 0 else (-value << 1) - 1)
+    if isinstance(value, float):
+        return bytes([FLOAT]) + struct.pack('>d', value)
+    if isinstance(value, str):
+        encoded = value.encode()
+        return bytes([STRING]) + varint(len(encoded)) + encoded
+    if isinstance(value, list):
+        return bytes([LIST]) + varint(len(value)) + b''.join(
+            pack(item) for item in value)
+    if isinstance(value, dict):
+        packed = [bytes([DICT]), varint(len(value))]
+        for key, item in value.items():
+            number = NUMBERS.get(key, 0)
+            packed.append(varint(number))
+            if not number:
+                packed.append(pack(key)[1:])  # a string, without its tag
+            packed.append(pack(item))
+        return b''.join(packed)
+    raise TypeError('cannot pack %r' % value)
+
+def unpack(data):
+    '''
+    the value packed in `data`
+
+    raises ValueError if it is not a packed value, or too deeply nested
+
+    >>> unpack(bytes([LIST, 1]) * 100000 + bytes([NONE]))
+    Traceback (most recent call last):
+      ...
+    ValueError: not a packed value: maximum recursion depth exceeded
+    '''
+    try:
+        value, offset = unpacked(data, 0)
+    except RecursionError as bad:
+        raise ValueError('not a packed value: %s' % (
+            'maximum recursion depth exceeded')) from bad
+    except (IndexError, KeyError, struct.error, UnicodeDecodeError) as bad:
+        raise ValueError('not a packed value: %s' % bad) from bad
+    if offset != len(data):
+        raise ValueError('%d bytes left over' % (len(data) - offset))
+    return value
+
+def unstring(data, offset):
+    '''
+    the string, length first, at `offset`, and the offset after it
+    '''
+    length, offset = unvarint(data, offset)
+    if offset + length > len(data):
+        raise IndexError('string runs past the end')
+    return bytes(data[offset:offset + length]).decode(), offset + length
+
+def unpacked(data, offset):
+    '''
+    the value packed at `offset`, and the offset after it
+    '''
+    tag, offset = data[offset], offset + 1
+    if tag == STRING:
+        return unstring(data, offset)
+    if tag in (NONE, FALSE, TRUE):
+        return (None, False, True)[tag], offset
+    if tag == FLOAT:
+        return struct.unpack_from('>d', data, offset)[0], offset + 8
+    if tag not in (INTEGER, LIST, DICT):
+        raise KeyError('unknown tag %d' % tag)
+    number, offset = unvarint(data, offset)
+    if tag == INTEGER:
+        return (number >> 1) if number & 1 == 0 else -(number + 1 >> 1), offset
+    items = [] if tag == LIST else {}
+    for index in range(number):  # pylint: disable=unused-variable
+        if tag == LIST:
+            item, offset = unpacked(data, offset)
+            items.append(item)
+            continue
+        key, offset = unvarint(data, offset)
+        if key:
+            key = FIELDS[key - 1]
+        else:
+            key, offset = unstring(data, offset)
+        items[key], offset = unpacked(data, offset)
+    return items, offset
+
+def frame(data, encrypt=None):
+    '''
+    compact frame of `data`, a post's JSON or any other message, as
+    bytes; `encrypt`, if given, is called on the payload and returns
+    GPG's output
+
+    >>> body = json.dumps({'type': 'post', 'toptext': 'hello ' * 20})
+    >>> framed = frame(body.encode())
+    >>> framed.startswith(PREFIX), len(framed) < len(body) / 2
+    (True, True)
+    >>> unwrap(framed) == json.dumps(json.loads(body))
+    True
+    >>> unwrap(frame(b'just words')), unwrap(framed[:20]) == framed[:20]
+    ('just words', True)
+    '''
+    try:
+        post = json.loads(data)
+    except ValueError:
+        post = None
+    payload, flags = (pack(post), POST) if isinstance(post, dict) else (
+        data, 0)
+    if encrypt is not None:
+        payload, flags = encrypt(payload), flags | ENCRYPTED
+    else:
+        squeezed = zlib.compress(payload, 9)
+        if len(squeezed) < len(payload):
+            payload, flags = squeezed, flags | COMPRESSED
+    return PREFIX + b85encode(bytes([FORMAT << 4 | flags, TABLE]) +
+                              varint(len(payload)) + payload).decode()
+
+def unframe(message):
+    '''
+    flags and payload of a compact frame, or None while only part of it
+    has arrived
+
+    raises ValueError if it is not one we can read
+    '''
+    text = message[len(PREFIX):]
+    try:
+        start = b85decode(text[:len(text) // 5 * 5][:10])
+        if len(start) < 3:
+            return None
+        length, offset = unvarint(start, 2)
+    except IndexError:
+        return None
+    size = offset + length
+    expected = size // 4 * 5 + (size % 4 + 1 if size % 4 else 0)
+    if len(text) < expected:
+        return None
+    if len(text) > expected:
+        raise ValueError('frame longer than its header says')
+    if start[0] >> 4 != FORMAT or start[1] != TABLE:
+        raise ValueError('frame of format %d, table %d' % (
+            start[0] >> 4, start[1]))
+    return start[0] & 0xf, b85decode(text)[offset:]
+
+def expand(flags, payload):
+    '''
+    the message in a frame's payload, once decrypted if need be, as sent
+
+    raises ValueError if it would expand to more than MAXSIZE bytes
+
+    >>> bomb = frame(bytes(MAXSIZE + 1))
+    >>> len(bomb) < 2000, unwrap(bomb) == bomb
+    (True, True)
+    '''
+    if flags & COMPRESSED:
+        inflater = zlib.decompressobj()
+        payload = inflater.decompress(payload, MAXSIZE)
+        if inflater.unconsumed_tail:
+            raise ValueError('frame expands to over %d bytes' % MAXSIZE)
+        if not inflater.eof:
+            raise ValueError('compressed payload cut short')
+    if flags & POST:
+        payload = json.dumps(unpack(payload)).encode()
+    return payload
+
+def unwrap(message):
+    '''
+    the message in a whole unencrypted frame, or `message` as it is
+    '''
+    if not message.startswith(PREFIX):
+        return message
+    try:
+        unframed = unframe(message)
+        if unframed is None or unframed[0] & ENCRYPTED:
+            return message
+        return expand(*unframed).decode()
+    except (ValueError, zlib.error) as bad:
+        logging.warning('cannot read frame %s...: %s', message[:32], bad)
+        return message
+
+class Wire():
+    '''
+    the peers that have said they read compact frames
+
+    >>> replies = []
+    >>> wire = Wire(reply=lambda target, message: replies.append(target))
+    >>> wire.accepts('bob'), wire.heard('bob', ADVERTISEMENT, False)
+    (False, True)
+    >>> wire.accepts('bob'), replies
+    (True, ['bob'])
+    >>> wire.heard('bob', ADVERTISEMENT, True), replies  # known already
+    (True, ['bob'])
+    >>> wire.heard('bob', 'hello', True), wire.accepts(CHANNEL)
+    (False, False)
+    '''
+    def __init__(self, reply=None):
+        '''
+        `reply(target, message)` sends a private message, as IRCBot's
+        privmsg does; set by the owner, as Gossip's `announce` is
+        '''
+        self.peers = SeenSet(PEERS)
+        self.reply = reply
+
+    def heard(self, sender, message, privately):
+        '''
+        note a peer's advertisement, answering one made on the channel
+        with our own; returns False for other messages
+        '''
+        if message != ADVERTISEMENT:
+            return False
+        if self.peers.add(sender) and not privately and self.reply:
+            logging.debug('%s reads compact frames', sender)
+            self.reply(sender, ADVERTISEMENT)
+        return True
+
+    def accepts(self, target):
+        '''
+        whether to send compact frames to `target`
+        '''
+        if target == CHANNEL:
+            return COMPACT_CHANNEL
+        return target in self.peers
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -29,6 +29,17 @@ com.kybyz.app.updateCheck = function(elementId) {
             newContent = xhr.response.body.firstChild;
             if (newContent.getAttribute("id") == elementId)
                 oldContent.replaceWith(newContent);
+            else if (newContent.getAttribute("id") == elementId + "-new") {
+                // only the messages not yet shown, newest first
+                oldContent.prepend(...newContent.children);
+                // drop the oldest, to show as many as a whole column does
+                const shown = parseInt(oldContent.getAttribute("data-shown"));
+                Array.from(oldContent.children).filter(
+                    child => child.id != "kbz-js-warning"
+                ).slice(shown).forEach(child => child.remove());
+                contentHash = newContent.getAttribute("data-version");
+                oldContent.setAttribute("data-version", contentHash);
+            }
             else console.log("wrong replacement element ID " +
                              newContent.getAttribute("id") +
                              " for " + elementId);
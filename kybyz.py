@@ -4,36 +4,52 @@ Version 0.1 of Kybyz, a peer to peer (p2p) social media platform
 '''
 # pylint: disable=bad-option-value, consider-using-f-string
 import sys, os, math, time, threading  # pylint: disable=multiple-imports
-import shlex, re, subprocess  # pylint: disable=multiple-imports
-import readline
+STARTED = time.perf_counter()  # for --startup-profile
+# pylint: disable=wrong-import-position
+import shlex, re, subprocess, html, atexit  # pylint: disable=multiple-imports
 from socket import fromfd, AF_INET, SOCK_STREAM
 from io import BytesIO
-from urllib.request import Request, urlopen
 from urllib.error import HTTPError
-from urllib.parse import parse_qsl
+from urllib.parse import parse_qsl, quote, unquote
 from hashlib import md5
-from ircbot import IRCBot
-from kbutils import loadposts, registration, cachewrite, guess_mimetype
+from kbutils import timeline, fragment, stream, registration, cachewrite
+from kbutils import guess_mimetype
 from kbutils import send, publish, create  # pylint: disable=unused-import
+from kbutils import search  # pylint: disable=unused-import
 from kbutils import register  # pylint: disable=unused-import
-from kbcommon import CACHE, CACHED, logging, MESSAGE_QUEUE, TO_PAGE
+from kbcommon import CACHE, logging, MESSAGE_STORE, TO_PAGE
+from kbcommon import PAGESIZE, REGISTERED, STATE, Tally
 from kbcommon import COMMAND, ARGS, read
-
-readline.read_init_file('kybyz_readline.rc')
-RUNNING = threading.Event()
+from kbtemplate import TEMPLATES
+from kbthumb import THUMBS
+from kbpeer import PeerServer, ADDRESS
+from kbsync import Synchronizer
+from kbsupervisor import SUPERVISOR, listening
+from kbindex import THREADS, FIELDS, SEARCH, load as load_indexes
+from kbindex import save as save_indexes, SNAPSHOT_INTERVAL
+from kbprofile import traced
+from kbprofile import profile, trace  # pylint: disable=unused-import
 CURDIR = os.path.abspath(os.curdir)
-REQUEST_COUNT = 0
+REQUEST_COUNT = Tally()
 LOGTIME = int(os.getenv('KB_DELAY', '600'))  # seconds
-COMMANDS = ['create', 'register', 'send', 'publish']
+COMMANDS = ['create', 'register', 'send', 'publish', 'search',
+            'profile', 'trace', 'verify', 'reindex']
+SPLIT = '\0posts\0'  # placeholder where the posts chunks go
 NAVIGATION = '<div class="column" id="kbz-navigation">{navigation}</div>'
 POSTS = '''<div class="column" id="kbz-posts" data-version="{posts_hash}">
   {posts}
 </div>'''
 MESSAGES = '''<div class="column" id="kbz-messages"
-  data-version="{messages_hash}">
+  data-version="{messages_version}" data-shown="{messages_shown}">
     {messages}
   <div id="kbz-js-warning">webpage:{javascript}</div>
 </div>'''
+# only the messages a page hasn't shown, to go at the top of its column
+NEW_MESSAGES = '''<div id="kbz-messages-new"
+  data-version="{messages_version}">
+    {messages}
+</div>'''
+MESSAGES_SHOWN = int(os.getenv('KB_MESSAGES_SHOWN') or 100)  # in the column
 EXPECTED_ERRORS = (  # for repl loop
     RuntimeError,
     KeyError,
@@ -49,36 +65,71 @@ REMOTE_PORT = int(os.getenv('EXTERNAL_PORT', '-1'))  # request via nginx/tor
 KB_USERNAME = os.getenv('KB_USERNAME')
 KB_EMAIL = os.getenv('KB_EMAIL')
 HELPERS = {}
+STARTUP = []  # (stage, seconds since STARTED), for --startup-profile
+PROFILE = bool(os.getenv('KB_STARTUP_PROFILE'))
+if '--startup-profile' in ARGS:
+    ARGS.remove('--startup-profile')
+    PROFILE = True
+SERVED = threading.Event()  # set once the first page has gone out
 
 def init():
     '''
     initialize application
+
+    only what the web pages need is done before returning; everything
+    else is started in the background by `start_helpers`
     '''
     logging.debug('beginning kybyz initialization')
+    startup('imports')
     os.makedirs(CACHE, 0o700, exist_ok=True)
-    CACHED.update(registration()._asdict())
-    if not CACHED['gpgkey']:
+    REGISTERED.set(registration())
+    load_indexes()
+    atexit.register(snapshot)
+    startup('indexes')
+    TEMPLATES.preload()
+    startup('templates')
+    STATE.uptime = 0
+    STATE.javascript = 'ERROR:javascript disabled or incompatible'
+    logging.debug('registered: %s, state: %s', REGISTERED.value, STATE)
+    SUPERVISOR.start()
+    startup('ready')
+    helpers = threading.Thread(target=start_helpers, name='helpers',
+                               daemon=True)
+    helpers.start()
+
+def start_helpers():
+    '''
+    start what can wait until the web handler is ready: registration,
+    which may run gpg, the IRC connection, the peer server, nginx and tor
+    '''
+    if not REGISTERED.value.gpgkey:
         if KB_USERNAME and KB_EMAIL:
             register(KB_USERNAME, KB_EMAIL)
-            CACHED.update(registration()._asdict())
+            REGISTERED.set(registration())
         else:
             logging.error('need to set envvars KB_USERNAME and KB_EMAIL')
-    CACHED['uptime'] = 0
-    CACHED['javascript'] = 'ERROR:javascript disabled or incompatible'
-    logging.debug('CACHED: %s', CACHED)
-    RUNNING.set()
+    startup('registration')
     kybyz = threading.Thread(target=background, name='kybyz', daemon=True)
     kybyz.start()
-    external_server = threading.Thread(
-        target=nginx, name='nginx', daemon=True
-    )
-    external_server.start()
-    if HELPERS.get('nginx'):  # will be non-null if Popen was successful
-        punchthrough = threading.Thread(target=tor, name='tor', daemon=True)
-        punchthrough.start()
+    if ADDRESS:
+        HELPERS['kbpeer'] = PeerServer()
+        HELPERS['kbsync'] = Synchronizer(HELPERS['kbpeer'])
     else:
-        logging.error('not starting tor without nginx')
+        logging.info('set KB_PEER_ADDRESS to serve posts directly to peers')
+    startup('peers')
+    nginx()
+    tor()
+    startup('helpers')
 
+def startup(stage):
+    '''
+    note the time a stage of startup is done, reporting it if profiling
+    '''
+    STARTUP.append((stage, time.perf_counter() - STARTED))
+    logging.log(logging.INFO if PROFILE else logging.DEBUG,
+                'startup: %s done at %.3fs', *STARTUP[-1])
+
+@traced('serve')
 def serve(env=None, start_response=None):
     '''
     handle web requests
@@ -94,12 +145,24 @@ def serve(env=None, start_response=None):
     (and should?) show its own newsfeed to the world. but should still be
     selective about what it accepts from the world. and rate-limited to avoid
     denial of (service|disk space) attacks.
+
+    >>> def show(status, headers):
+    ...     print(status)
+    >>> page = serve({'REQUEST_URI': '/author'}, show)  # but whose?
+    404 Not Found
+    >>> for number in ('abc', '0', '-1'):  # all taken as the first page
+    ...     b'no posts found' in b''.join(serve(
+    ...         {'REQUEST_URI': '/search?q=kybyz&page=%s' % number}, show))
+    200 OK
+    True
+    200 OK
+    True
+    200 OK
+    True
     '''
     # pylint: disable=too-many-locals, too-many-statements
-    global REQUEST_COUNT  # pylint: disable=global-statement
-    REQUEST_COUNT += 1
     env = env or {}
-    if REQUEST_COUNT < 1000000:
+    if REQUEST_COUNT.increment() < 1000000:
         logging.debug('env: %s', env)
     # wsgi.input now (as of 2024-12-30 or before) returns bytes object
     wsgi_input = env.get('wsgi.input', BytesIO(b'')).read().decode()
@@ -112,20 +175,63 @@ def serve(env=None, start_response=None):
     logging.debug('requested: "%s"', requested)
     status = '200 OK'
     headers = [('Content-type', 'text/html')]
-    template = read('timeline.html').decode()
-    messages = ''.join(['<div>%s</div>' % message for message in
-                        reversed(MESSAGE_QUEUE)])
-    messages_hash = md5(messages.encode()).hexdigest()
-    messages = MESSAGES.format(
-        messages=messages,
-        messages_hash=messages_hash,
-        javascript=CACHED['javascript'])
-    posts = ''.join(['<div>%s</div>' % post for post in loadposts()])
-    posts_hash = md5(posts.encode()).hexdigest()
-    posts = POSTS.format(posts=posts, posts_hash=posts_hash)
     navigation = NAVIGATION.format(navigation=''.join(['<h3>Navigation</h3>']))
 
     # make helper functions for dispatcher
+    def timeline_posts(head=b'', tail=b''):
+        '''
+        version hash of the timeline, and a generator of the posts column
+        as byte chunks, wrapped in `head` and `tail`
+        '''
+        hashes = timeline()
+        posts_hash = md5(' '.join(
+            [TEMPLATES.version] + hashes).encode()).hexdigest()
+        before, after = POSTS.format(
+            posts=SPLIT, posts_hash=posts_hash).encode().split(SPLIT.encode())
+        return posts_hash, stream(head + before, hashes, after + tail)
+
+    def message_column():
+        '''
+        the messages column, newest first, with the number of the newest
+        as its version
+        '''
+        entries = MESSAGE_STORE.recent(MESSAGES_SHOWN)
+        return MESSAGES.format(
+            messages=message_divs(entries),
+            messages_version=entries[0][0] if entries else 0,
+            messages_shown=MESSAGES_SHOWN,
+            javascript=STATE.javascript)
+
+    def new_messages(since):
+        '''
+        number of the newest message, and the messages after `since` for
+        the page to add to its column; the whole column if `since` is not
+        a number we can continue from
+        '''
+        latest = MESSAGE_STORE.latest
+        if not since.isdigit() or not \
+                latest - MESSAGES_SHOWN <= int(since) <= latest:
+            return str(latest), message_column().encode()
+        entries = MESSAGE_STORE.since(int(since), MESSAGES_SHOWN)
+        version = str(entries[-1][0]) if entries else since
+        return version, NEW_MESSAGES.format(
+            messages=message_divs(entries[::-1]),
+            messages_version=version).encode()
+
+    def thumbnail(size, path):
+        '''
+        smaller copy of an image, or a redirect to the original while
+        the copy is being made
+        '''
+        if not size.isdigit() or int(size) not in THUMBS.sizes:
+            return '404 Not Found', headers, b'<div>no such size</div>'
+        page = THUMBS.get(path, int(size))
+        if page is None:
+            return '307 Temporary Redirect', [
+                ('Location', '/' + path), ('Cache-Control', 'no-store')], b''
+        return status, [('Content-type', 'image/jpeg'),
+                        ('Cache-Control', THUMBS.lifetime(path))], page
+
     def update():
         '''
         process xhr request for update to posts or messages
@@ -133,15 +239,13 @@ def serve(env=None, start_response=None):
         name, hashed = args.get('name', None), args.get('hash', None)
         update_status = status  # default from outer variable
         if name in ('messages', 'posts'):
-            # pylint: disable=eval-used
-            # check outer variables
-            # must be done before eval or it will fail
-            logging.debug('messages: ...%s', messages[-128:])
-            logging.debug('messages_hash: %s', messages_hash)
-            logging.debug('posts: %s...', posts[:128])
-            logging.debug('posts_hash: %s', posts_hash)
-            if hashed and hashed != eval(name + '_hash'):
-                update_page = eval(name).encode()
+            if name == 'posts':
+                current_hash, update_page = timeline_posts()
+            else:
+                current_hash, update_page = new_messages(hashed or '')
+            logging.debug('%s_hash: %s', name, current_hash)
+            if hashed and hashed != current_hash:
+                pass  # send the page as it is
             elif hashed:
                 logging.debug('%s unchanged', name)
                 update_page = b''
@@ -157,27 +261,133 @@ def serve(env=None, start_response=None):
             update_status = '404 Not Found'
         return update_status, update_page
 
+    def listing(entries, more=''):
+        '''
+        page with the given posts, [(hash, depth), ...], in place of the
+        timeline, and `more` HTML (such as a link to the next page) after
+        '''
+        return column(''.join([
+            '<div class="reply" style="margin-left: %dem">%s</div>' % (
+                depth * 2, fragment(post).decode())
+            for post, depth in entries]) + more)
+
+    def column(shown):
+        '''
+        page with `shown` HTML in place of the timeline
+        '''
+        return TEMPLATES.render(
+            'timeline.html',
+            posts=POSTS.format(
+                posts=shown,
+                posts_hash=md5(shown.encode()).hexdigest()),
+            messages=message_column(),
+            navigation=navigation,
+        ).encode()
+
+    def thread(hashed):
+        '''
+        show a whole conversation, indented by depth of reply
+        '''
+        entries = [(post, depth) for post, depth in THREADS.thread(hashed)
+                   if post in THREADS]
+        if not entries:
+            return '404 Not Found', b'<div>no such thread</div>'
+        return status, listing(entries)
+
+    def matching(field, value, query):
+        '''
+        show a page of posts by an author, fingerprint, or of a type,
+        newest first
+
+        `?before=<timestamp>` continues from an earlier page
+        '''
+        value = unquote(value)
+        before = dict(parse_qsl(query)).get('before')
+        hashes = FIELDS.query(field, value, before, PAGESIZE)
+        if not hashes and before is None:
+            return '404 Not Found', b'<div>no posts with %s %s</div>' % (
+                field.encode(), html.escape(value).encode())
+        more = ''
+        if len(hashes) == PAGESIZE:
+            more = '<a class="more" href="%s/%s?before=%s">older</a>' % (
+                field, quote(value), quote(FIELDS.timestamp(hashes[-1])))
+        return status, listing([(post, 0) for post in hashes], more)
+
+    def conversation(name, query):
+        '''
+        show a page of the messages with someone, or on a channel, newest
+        first
+
+        `?before=<number>` continues from an earlier page
+        '''
+        name = unquote(name)
+        before = dict(parse_qsl(query)).get('before', '')
+        entries = MESSAGE_STORE.conversation(
+            name, int(before) if before.isdigit() else None, PAGESIZE)
+        if not entries and not before:
+            return '404 Not Found', b'<div>no messages with %s</div>' % (
+                html.escape(name).encode())
+        more = ''
+        if len(entries) == PAGESIZE:
+            more = '<a class="more" href="messages/%s?before=%d">older</a>' % (
+                quote(name, safe=''), entries[-1][0])
+        return status, column(message_divs(entries) + more)
+
+    def found(query):
+        '''
+        show a page of posts matching a search, best first
+
+        `?q=<words>&page=<n>`
+        '''
+        query = dict(parse_qsl(query))
+        words, number = query.get('q', ''), query.get('page', '')
+        number = max(1, int(number) if number.isdigit() else 1)
+        hashes = SEARCH.search(words, (number - 1) * PAGESIZE, PAGESIZE)
+        more = ''
+        if len(hashes) == PAGESIZE:
+            more = '<a class="more" href="search?q=%s&amp;page=%d">%s</a>' % (
+                quote(words), number + 1, 'more')
+        if not hashes:
+            more = '<div>no %sposts found matching %s</div>' % (
+                'more ' if number > 1 else '', html.escape(words))
+        return status, listing([(post, 0) for post in hashes], more)
+
     if requested is not None and start_response:
         if server_port == REMOTE_PORT and KB_USERNAME != 'kybyzdotcom':
             logging.warning('remote request received, env: %s', env)
             status = '501 Not Implemented'
             page = b'<div>Not yet serving remote requests</div>'
         elif requested == '':
-            page = template.format(
-                posts=posts,
-                messages=messages,
+            head, tail = TEMPLATES.render(
+                'timeline.html',
+                posts=SPLIT,
+                messages=message_column(),
                 navigation=navigation,
-                posts_hash=posts_hash,
-                messages_hash=messages_hash,
-            ).encode()
+            ).encode().split(SPLIT.encode())
+            page = timeline_posts(head, tail)[1]
         elif os.path.exists(requested):
             page = read(requested)
             headers = [('Content-type', guess_mimetype(requested, page))]
+        elif requested.startswith('thumb/') and requested.count('/') > 1:
+            status, headers, page = thumbnail(*requested.split('/', 2)[1:])
+        elif requested.startswith('thread/'):
+            status, page = thread(requested.split('/')[1])
+        elif requested.split('?')[0] == 'search':
+            status, page = found((requested.split('?', 1) + [''])[1])
+        elif requested.startswith('messages/'):
+            path, query = (requested.split('?', 1) + [''])[:2]
+            status, page = conversation(path.split('/', 1)[1], query)
+        elif requested.split('/')[0] in FIELDS.FIELDS and \
+                requested.split('?')[0].partition('/')[2]:  # has a value
+            path, query = (requested.split('?', 1) + [''])[:2]
+            status, page = matching(*path.split('/', 1), query)
         elif requested.startswith('update/'):
             # assume called by javascript, and thus that it's working
-            CACHED['javascript'] = 'INFO:found compatible javascript engine'
+            STATE.javascript = 'INFO:found compatible javascript engine'
             status, page = update()
         elif requested.startswith('ipfs/'):
+            # pylint: disable=import-outside-toplevel
+            from urllib.request import Request, urlopen
             url = 'https://ipfs.io/' + requested
             urlrequest = Request(url)
             urlrequest.add_header('user-agent', USER_AGENT)
@@ -199,11 +409,17 @@ def serve(env=None, start_response=None):
             logging.warning('%s not found', requested)
             status = '404 Not Found'
             page = b'<div>not yet implemented</div>'
-        # NOTE: page must be a bytestring at this point!
-        logging.debug('starting response with status %s and page %s...',
-                      status, page[:128])
+        # NOTE: page must be a bytestring, or generator of them, by now!
         start_response(status, headers)
-        return [page]
+        if not SERVED.is_set():
+            SERVED.set()
+            startup('first page')
+        if isinstance(page, bytes):
+            logging.debug('started response with status %s and page %s...',
+                          status, page[:128])
+            return [page]
+        logging.debug('streaming response with status %s', status)
+        return page
     logging.warning('serve: failing with env=%s and start_response=%s',
                     env, start_response)
     return [b'']
@@ -224,60 +440,69 @@ def get_posts(directory, pattern=None, convert=None):
 
 def background():
     '''
-    load and maintain cache
+    connect to IRC, and schedule the housekeeping
 
     communicate with other kybyz servers
     '''
-    CACHED['ircbot'] = IRCBot(nickname=CACHED.get('username', None))
-    # delay must be less than nginx's, and more than 1s
-    # (otherwise the `kybyz active %s seconds` display will be doubled)
-    delay = 1.1
-    while RUNNING.is_set():
-        if math.floor(CACHED['uptime']) % LOGTIME == 0:
-            logging.info('kybyz active %s seconds',
-                         math.floor(CACHED['uptime']), **TO_PAGE)
-            logging.debug('CACHED: %s, threads: %s',
-                          CACHED, threading.enumerate())
-        time.sleep(delay)  # releases the GIL for `serve`
-        CACHED['uptime'] += delay
-    logging.warning('program stopped, cleaning up...')
+    from ircbot import IRCPool  # pylint: disable=import-outside-toplevel
+    STATE.ircbot = IRCPool(nickname=REGISTERED.value.username)
+    SUPERVISOR.every(LOGTIME, report, now=True)
+    SUPERVISOR.every(SNAPSHOT_INTERVAL, snapshot)
+
+def report():
+    '''
+    log how long kybyz has been running
+    '''
+    STATE.uptime = SUPERVISOR.uptime()
+    logging.info('kybyz active %s seconds',
+                 math.floor(STATE.uptime), **TO_PAGE)
+    logging.debug('state: %s, threads: %s', STATE, threading.enumerate())
+
+def snapshot():
+    '''
+    save the indexes, so that the next start needn't rebuild them
+    '''
+    try:
+        save_indexes()
+    except OSError as problem:
+        logging.warning('cannot save index snapshot: %s', problem)
+
+def message_divs(entries):
+    '''
+    messages, [(number, conversation, text), ...], as HTML
+
+    >>> message_divs([(2, 'bob', 'INFO:hi'), (1, '', 'INFO:ready')])
+    '<div>INFO:hi</div><div>INFO:ready</div>'
+    '''
+    return ''.join(['<div>%s</div>' % text for number, conversation, text
+                    in entries])
 
 def nginx():
     '''
     start nginx to handle external requests via tor
     '''
-    # pylint: disable=consider-using-with
     configuration = os.path.join(CURDIR, 'kybyz.conf')
-    try:
-        HELPERS['nginx'] = subprocess.Popen([
-            'nginx',
-            '-c', configuration,
-            '-e', 'stderr',
-            '-g', 'daemon off;'
-        ])
-        while RUNNING.is_set():
-            time.sleep(1.3)  # must be less than tor's
-    except FileNotFoundError as failed:
-        logging.error('Failed launching nginx: %s', failed)
-    logging.warning('program stopped, nginx terminating...')
+    SUPERVISOR.add('nginx', [
+        'nginx',
+        '-c', configuration,
+        '-e', 'stderr',
+        '-g', 'daemon off;'
+    ], check=listening(REMOTE_PORT) if REMOTE_PORT > 0 else None)
 
 def tor():
     '''
     start tor for receiving external requests
     '''
-    # pylint: disable=consider-using-with
-    try:
-        HELPERS['tor'] = subprocess.Popen(['tor', '-f', 'kybyz.torrc'])
-        while RUNNING.is_set():
-            time.sleep(1.5)
-    except FileNotFoundError as failed:
-        logging.error('error starting tor: %s', failed)
-    logging.warning('program stopped, tor terminating...')
+    SUPERVISOR.add('tor', ['tor', '-f', 'kybyz.torrc'], requires='nginx')
 
 def process(args):
     '''
     process a kybyz command
     '''
+    if args and args[0] in ('verify', 'reindex'):
+        # rarely used, so not loaded at startup
+        # pylint: disable=import-outside-toplevel, unused-import
+        from kbverify import verify, reindex
     if args and args[0] in COMMANDS:
         print(
             ('result of %s%s:' % (args[0], str(tuple(args[1:])))),
@@ -328,7 +553,10 @@ def commandloop():
     '''
     simple repl (read-evaluate-process-loop) for command-line testing
     '''
-    time.sleep(10)  # give page a chance to load before starting repl
+    # pylint: disable=import-outside-toplevel
+    import readline
+    readline.read_init_file('kybyz_readline.rc')
+    SERVED.wait(10)  # give page a chance to load before starting repl
     args = []
     logging.info('Ready to accept commands; `quit` to terminate input loop')
     while args[0:1] != ['quit']:
@@ -4,9 +4,11 @@ kybyz post
 '''
 # pylint: disable=bad-option-value, consider-using-f-string
 import os, json, re  # pylint: disable=multiple-imports
-from kbcommon import read, make_timestamp, tuplify, logging, CACHED, \
+from kbcommon import read, make_timestamp, tuplify, logging, REGISTERED, \
  doctestdebug
 from canonical_json import canonicalize
+from kbtemplate import TEMPLATES
+from kbthumb import THUMBS
 LIKE = '\N{THUMBS UP SIGN}'
 LOVE = '\N{BLACK HEART SUIT}'
 
@@ -242,10 +244,11 @@ class BasePost():
             # pylint: disable=no-value-for-parameter  # (why? dunno)
             instance = super().__new__(subclass)
             # fill in defaults from things unknown at script load time
+            registered = REGISTERED.value
             instance.versions[version][post_type]['author'].required = \
-                CACHED.get('username', True)
+                registered.username or True
             instance.versions[version][post_type]['fingerprint'].required = \
-                CACHED.get('gpgkey', '')[-16:] or True
+                (registered.gpgkey or '')[-16:] or True
         except TypeError:
             logging.exception('Unknown post type %s', subclass)
             instance = None
@@ -286,7 +289,7 @@ class BasePost():
         if not self.__doc__:
             raise RuntimeError('Must not run with optimization')
         # why doesn't 'author' have default value from cache?
-        doctestdebug('BasePost.validate: CACHED: %s', CACHED)
+        doctestdebug('BasePost.validate: registered: %s', REGISTERED.value)
         assert (getattr(self, 'type', None) == self.classname or
                 getattr(self, 'filename', '').endswith('.' + self.classname))
         schema = self.versions[self.version][self.type]
@@ -299,8 +302,14 @@ class BasePost():
         '''
         output contents as HTML
         '''
-        template = read(self.classname + '.html').decode()
-        return template.format(post=self)
+        return TEMPLATES.render(self.classname + '.html', post=self)
+
+    @property
+    def thumbnail(self):
+        '''
+        URL of the post's image as shown in the timeline
+        '''
+        return THUMBS.url(getattr(self, 'image', ''))
 
     def to_json(self, for_hashing=False):
         '''